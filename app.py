@@ -1,10 +1,25 @@
 from flask import Flask
 from flask_login import LoginManager
 from flask_mail import Mail
-from database import init_db, get_user_by_id
+from storage import storage
+from credentials import credential_cipher
+from database import init_db, encrypt_stored_credentials, get_user_by_id
+from issuance import recover_issuance_orders
+from retention import run_from_config as run_email_retention
+from ocsp import refresh_from_config as refresh_ocsp_responses
+from ari import run_from_config as run_renewals
+from tasks import start_periodic_task
+from http_cache import fragment_cache
+from profiling import init_profiling
+from scheduler import issuance_scheduler
+from deploy import deployer
+from passwords import password_hasher
 from routes.auth import auth_bp
 from routes.main import main_bp
 from routes.email import email_bp
+from routes.metrics import metrics_bp
+from routes.assets import assets_bp
+from assets import asset_manifest, static_url
 
 # 创建Flask应用
 app = Flask(__name__)
@@ -33,6 +48,26 @@ login_manager.login_message_category = 'error'
 
 mail = Mail(app)
 
+# 请求耗时与数据库访问统计（Server-Timing、慢查询日志、管理员采样分析）
+init_profiling(app)
+
+fragment_cache.maxsize = app.config.get('FRAGMENT_CACHE_SIZE', 256)
+issuance_scheduler.configure(
+    workers=app.config.get('ISSUANCE_WORKERS', 8),
+    interactive_boost=app.config.get('INTERACTIVE_WEIGHT_BOOST', 4)
+)
+password_hasher.configure(
+    method=app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000'),
+    workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+    queue_timeout=app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 5)
+)
+deployer.configure(
+    max_workers=app.config.get('DEPLOY_MAX_WORKERS', 16),
+    max_attempts=app.config.get('DEPLOY_MAX_ATTEMPTS', 3),
+    retry_delay=app.config.get('DEPLOY_RETRY_DELAY', 2),
+    timeout=app.config.get('DEPLOY_TIMEOUT', 30)
+)
+
 @login_manager.user_loader
 def load_user(user_id):
     return get_user_by_id(int(user_id))
@@ -41,10 +76,59 @@ def load_user(user_id):
 app.register_blueprint(auth_bp, url_prefix='/auth')
 app.register_blueprint(main_bp)
 app.register_blueprint(email_bp)
+app.register_blueprint(metrics_bp)
+app.register_blueprint(assets_bp)
+
+# 模板通过static_url()引用构建后带哈希的静态资源
+asset_manifest.load()
+app.add_template_global(static_url)
+
+# 数据库中保存的凭据（ACME账户私钥、Cloudflare API密钥）以SECRET_KEY派生的密钥加密
+credential_cipher.configure(app.config.get('SECRET_KEY') or app.secret_key)
 
 # 初始化数据库
+storage.configure(app.config.get('DATABASE_URL', 'sqlite:///ssl_certificates.db'))
+print(f"数据库: {storage.backend}")
 with app.app_context():
     init_db()
+    encrypt_stored_credentials()
+
+# 启动后台任务：恢复进程中断时未完成的签发订单并清理残留的DNS验证记录
+# 多个副本同时运行时，每个任务每个周期只在持有租约的一个副本中执行
+if app.config.get('BACKGROUND_TASKS_ENABLED', True):
+    start_periodic_task(
+        'issuance-recovery',
+        app.config.get('ORDER_RECOVERY_INTERVAL', 60),
+        lambda: recover_issuance_orders(
+            stale_seconds=app.config.get('ORDER_STALE_SECONDS', 300),
+            max_attempts=app.config.get('ORDER_MAX_RECOVERY_ATTEMPTS', 3)
+        ),
+        lease_ttl=app.config.get('LEASE_TTL', 30)
+    )
+    # 邮件日志保留策略：清理过期记录、压缩较早的内容、回收数据库空闲页
+    start_periodic_task(
+        'email-retention',
+        app.config.get('EMAIL_RETENTION_INTERVAL', 86400),
+        lambda: run_email_retention(app.config),
+        initial_delay=60,
+        lease_ttl=app.config.get('LEASE_TTL', 30)
+    )
+    # 刷新到期的证书OCSP状态缓存
+    start_periodic_task(
+        'ocsp-refresh',
+        app.config.get('OCSP_REFRESH_INTERVAL', 600),
+        lambda: refresh_ocsp_responses(app.config),
+        initial_delay=30,
+        lease_ttl=app.config.get('LEASE_TTL', 30)
+    )
+    # 按ARI续期窗口安排续期，并为到期的自动续期证书重新签发
+    start_periodic_task(
+        'certificate-renewal',
+        app.config.get('ARI_POLL_INTERVAL', 900),
+        lambda: run_renewals(app.config),
+        initial_delay=45,
+        lease_ttl=app.config.get('LEASE_TTL', 30)
+    )
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,239 @@
+# ACME续期信息（ARI，RFC 9773）
+# 按证书的授权密钥标识和序列号计算ARI证书标识，向CA的renewalInfo接口查询建议的续期时间窗口，
+# 遵循Retry-After决定下一次查询时间；在窗口内随机选取续期时间，使续期请求均匀分散。
+# CA不支持ARI时以证书有效期的后1/3作为续期窗口。
+# 开启了自动续期的证书到达续期时间后，通过签发调度器重新签发。
+
+import base64
+import random
+import threading
+from concurrent.futures import wait
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from cryptography import x509
+from cert_utils import load_certificate_chain
+from database import (
+    get_certificates_due_for_ari, save_renewal_window, save_renewal_poll_error,
+    get_due_renewals, finish_renewal, save_renewal_failure
+)
+from issuance import schedule_certificate
+from scheduler import QuotaExceeded
+from ssl_generator import ACME_DIRECTORY_URL
+
+# 没有Retry-After时的查询间隔，以及Retry-After的上下限
+DEFAULT_POLL_INTERVAL = timedelta(hours=6)
+MIN_POLL_INTERVAL = timedelta(minutes=1)
+MAX_POLL_INTERVAL = timedelta(days=1)
+# 查询失败后的重试间隔
+ERROR_RETRY = timedelta(hours=1)
+# 续期失败后的重试间隔（按失败次数递增，最长1天）
+RENEWAL_RETRY = timedelta(hours=1)
+
+class ARIError(Exception):
+    """ARI查询失败"""
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def ari_certificate_id(certificate):
+    """ARI证书标识：base64url(授权密钥标识).base64url(序列号的DER整数编码)"""
+    try:
+        aki = certificate.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value
+    except x509.ExtensionNotFound:
+        raise ARIError('证书没有授权密钥标识扩展')
+    if not aki.key_identifier:
+        raise ARIError('证书的授权密钥标识为空')
+
+    serial = certificate.serial_number
+    # DER整数编码：最高位为1时需要前导零字节
+    serial_bytes = serial.to_bytes((serial.bit_length() + 8) // 8, 'big')
+    return f"{b64url(aki.key_identifier)}.{b64url(serial_bytes)}"
+
+def parse_rfc3339(value):
+    """解析RFC 3339时间，返回UTC的naive datetime"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00').replace('z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_retry_after(value, now):
+    """解析Retry-After（秒数或HTTP日期），并限制在合理范围内"""
+    if not value:
+        return DEFAULT_POLL_INTERVAL
+    try:
+        interval = timedelta(seconds=int(value))
+    except ValueError:
+        try:
+            interval = parsedate_to_datetime(value).replace(tzinfo=None) - now
+        except (TypeError, ValueError):
+            return DEFAULT_POLL_INTERVAL
+    return min(max(interval, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+def fallback_window(certificate):
+    """CA不支持ARI时的续期窗口：有效期的后1/3的前半段"""
+    lifetime = certificate.not_valid_after - certificate.not_valid_before
+    start = certificate.not_valid_after - lifetime / 3
+    return start, start + lifetime / 6
+
+def choose_renewal_time(window_start, window_end, now, rng=random):
+    """在续期窗口内均匀随机选取续期时间，窗口已经开始时从当前时间起选取，已经结束时立即续期"""
+    if window_end <= now:
+        return now
+    start = max(window_start, now)
+    return start + (window_end - start) * rng.random()
+
+class ARIClient:
+    """查询CA的renewalInfo接口
+
+    每次后台检查创建一个客户端：ACME目录只获取一次，获取失败时本次检查的其余证书直接记为失败，不再重复请求。
+    """
+
+    def __init__(self, directory_url=None, timeout=10):
+        self.directory_url = directory_url or ACME_DIRECTORY_URL
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._renewal_info_url = None
+        self._directory_loaded = False
+        self._directory_error = None
+
+    def renewal_info_url(self):
+        """ACME目录中的renewalInfo地址，CA不支持ARI时返回None"""
+        if self._directory_error:
+            raise self._directory_error
+        if not self._directory_loaded:
+            try:
+                response = self.session.get(self.directory_url, timeout=self.timeout)
+                response.raise_for_status()
+                self._renewal_info_url = response.json().get('renewalInfo')
+            except (requests.RequestException, ValueError) as e:
+                self._directory_error = ARIError(f'获取ACME目录失败: {e}')
+                raise self._directory_error
+            self._directory_loaded = True
+        return self._renewal_info_url
+
+    def fetch(self, ari_cert_id, now):
+        """查询续期窗口，返回 (window_start, window_end, explanation_url, 下次查询间隔)"""
+        url = f"{self.renewal_info_url().rstrip('/')}/{ari_cert_id}"
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ARIError(f'查询续期信息失败: {e}')
+        if response.status_code != 200:
+            raise ARIError(f'查询续期信息失败: HTTP {response.status_code}')
+
+        try:
+            data = response.json()
+            window = data['suggestedWindow']
+            window_start = parse_rfc3339(window['start'])
+            window_end = parse_rfc3339(window['end'])
+        except (ValueError, KeyError, TypeError):
+            raise ARIError('续期信息格式无效')
+        if window_end < window_start:
+            raise ARIError('续期窗口的结束时间早于开始时间')
+        return window_start, window_end, data.get('explanationURL'), parse_retry_after(response.headers.get('Retry-After'), now)
+
+    def update(self, record, now=None):
+        """查询并保存一张证书的续期窗口，返回窗口来源（ari/fallback），失败时返回error"""
+        now = now or datetime.utcnow()
+        try:
+            chain = load_certificate_chain(record['certificate'])
+            if not chain:
+                raise ARIError('证书内容为空')
+            certificate = chain[0]
+
+            if self.renewal_info_url():
+                ari_cert_id = ari_certificate_id(certificate)
+                window_start, window_end, explanation_url, poll_interval = self.fetch(ari_cert_id, now)
+                source = 'ari'
+            else:
+                ari_cert_id, explanation_url = None, None
+                window_start, window_end = fallback_window(certificate)
+                poll_interval = MAX_POLL_INTERVAL
+                source = 'fallback'
+        except (ARIError, ValueError) as e:
+            print(f"证书 {record['id']} 续期信息查询失败: {e}")
+            save_renewal_poll_error(record['id'], str(e), now + ERROR_RETRY)
+            return 'error'
+
+        save_renewal_window(record['id'], ari_cert_id, source, window_start, window_end, explanation_url,
+                            choose_renewal_time(window_start, window_end, now), now + poll_interval)
+        return source
+
+def poll_renewal_windows(client, batch_size=500):
+    """更新所有到期证书的续期窗口，返回各来源的数量"""
+    report = {}
+    while True:
+        records = get_certificates_due_for_ari(datetime.utcnow(), limit=batch_size)
+        for record in records:
+            source = client.update(record)
+            report[source] = report.get(source, 0) + 1
+        if len(records) < batch_size:
+            break
+    return report
+
+# 已提交、尚未完成的续期（证书ID）：等待超时的续期在后台完成前，之后的检查不会重复提交
+renewals_in_flight = set()
+renewals_lock = threading.Lock()
+
+def complete_renewal(renewal, future):
+    """续期任务完成时（签发调度器的工作线程中）记录结果"""
+    try:
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'success': False, 'message': str(e)}
+
+        if result['success']:
+            finish_renewal(renewal['certificate_id'], result['certificate_id'])
+            print(f"证书 {renewal['certificate_id']} 已续期为证书 {result['certificate_id']}")
+        else:
+            record_renewal_failure(renewal, result['message'])
+    finally:
+        with renewals_lock:
+            renewals_in_flight.discard(renewal['certificate_id'])
+
+def renew_due_certificates(limit=50, timeout=600):
+    """为到达续期时间的自动续期证书重新签发，返回 (成功数, 失败数)
+
+    最多等待 timeout 秒；届时仍在排队或签发的续期不计入返回值，完成后由回调记录结果。
+    """
+    renewals = get_due_renewals(datetime.utcnow(), limit=limit)
+    futures = []
+    for renewal in renewals:
+        with renewals_lock:
+            if renewal['certificate_id'] in renewals_in_flight:
+                continue
+            renewals_in_flight.add(renewal['certificate_id'])
+        try:
+            future = schedule_certificate(renewal['user_id'], renewal['domains'], renewal['email'],
+                                          renewal['cf_email'], renewal['cf_api_key'], kind='bulk')
+        except (ValueError, QuotaExceeded) as e:
+            with renewals_lock:
+                renewals_in_flight.discard(renewal['certificate_id'])
+            record_renewal_failure(renewal, str(e))
+            continue
+        future.add_done_callback(lambda future, renewal=renewal: complete_renewal(renewal, future))
+        futures.append(future)
+
+    done, pending = wait(futures, timeout=timeout)
+    if pending:
+        print(f"{len(pending)} 张证书的续期在 {timeout} 秒内未完成，完成后记录结果")
+
+    succeeded = sum(1 for future in done if future.exception() is None and future.result()['success'])
+    return succeeded, len(done) - succeeded
+
+def record_renewal_failure(renewal, message):
+    retry = min(RENEWAL_RETRY * (2 ** renewal['renewal_attempts']), MAX_POLL_INTERVAL)
+    print(f"证书 {renewal['certificate_id']} 续期失败: {message}，{retry} 后重试")
+    save_renewal_failure(renewal['certificate_id'], message, datetime.utcnow() + retry)
+
+def run_from_config(config):
+    """按应用配置更新续期窗口并续期到期的证书"""
+    client = ARIClient(timeout=config.get('ARI_TIMEOUT', 10))
+    report = poll_renewal_windows(client, batch_size=config.get('ARI_BATCH_SIZE', 500))
+    renewed, failed = renew_due_certificates(limit=config.get('RENEWAL_BATCH_SIZE', 50),
+                                             timeout=config.get('RENEWAL_WAIT_TIMEOUT', 600))
+    if report or renewed or failed:
+        print(f"续期检查完成: 续期窗口 {report}，续期成功 {renewed}，失败 {failed}")
+    return {'windows': report, 'renewed': renewed, 'failed': failed}
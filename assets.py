@@ -0,0 +1,113 @@
+# 静态资源构建
+# 将static目录下的CSS/JS按内容哈希重命名输出到static/dist，并预先生成gzip和brotli压缩版本；
+# 运行时模板通过 static_url() 引用带哈希的文件名，由 /assets/ 路由以长期缓存返回
+#
+# 构建：python assets.py（Dockerfile中在安装依赖后执行）
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from flask import url_for
+
+try:
+    import brotli
+except ImportError:
+    # 未安装brotli时只生成gzip版本
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# 需要构建的资源类型
+ASSET_EXTENSIONS = ('.css', '.js')
+
+# 预压缩版本：(Content-Encoding, 文件后缀)，按优先级排列
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+def hashed_name(filename, content):
+    """css/common.css -> css/common.<内容哈希>.css"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+def build_assets():
+    """构建静态资源，返回清单 {原文件名: 带哈希的文件名}"""
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+
+    manifest = {}
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != DIST_DIR]
+        for name in sorted(files):
+            if not name.endswith(ASSET_EXTENSIONS):
+                continue
+
+            source = os.path.join(root, name)
+            filename = os.path.relpath(source, STATIC_DIR).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                content = f.read()
+
+            output = hashed_name(filename, content)
+            target = os.path.join(DIST_DIR, output)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(content)
+            # mtime固定为0，相同内容每次构建得到相同的压缩文件
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, compresslevel=9, mtime=0))
+            if brotli:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(content, quality=11))
+
+            manifest[filename] = output
+            print(f"{filename} -> dist/{output}")
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    if not brotli:
+        print("未安装brotli，只生成了gzip压缩版本")
+    return manifest
+
+def load_manifest():
+    """读取构建清单，未构建时返回空清单"""
+    try:
+        with open(MANIFEST_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def manifest_digest(files):
+    """资源清单的摘要，重新构建后带哈希的文件名变化时随之变化"""
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+class AssetManifest:
+    """运行时的资源清单，应用启动时加载一次"""
+
+    def __init__(self):
+        self.files = {}
+        self.built = set()
+        self.digest = manifest_digest(self.files)
+
+    def load(self):
+        self.files = load_manifest()
+        self.built = set(self.files.values())
+        self.digest = manifest_digest(self.files)
+        if not self.files:
+            print("未找到静态资源构建清单，使用未压缩的原始文件（可执行 python assets.py 构建）")
+
+asset_manifest = AssetManifest()
+
+def static_url(filename):
+    """静态资源地址：已构建的资源返回带哈希的 /assets/ 地址，否则回退到Flask默认的静态文件地址"""
+    output = asset_manifest.files.get(filename)
+    if output:
+        return url_for('assets.asset', filename=output)
+    return url_for('static', filename=filename)
+
+if __name__ == '__main__':
+    build_assets()
@@ -0,0 +1,162 @@
+# 批量签发
+# 一批证书共用ACME邮箱和Cloudflare凭据，以批量任务提交到公平调度器，同时排队和执行的数量有上限；
+# 每张证书完成后立即产出一行结果，调用方可以逐行以NDJSON返回
+#
+# 命令行：python bulk.py domains.csv --user admin@example.com --email acme@example.com --cf-email cf@example.com
+# （Cloudflare密钥通过 --cf-api-key 或环境变量 CF_API_KEY 提供）
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import queue
+import sys
+from issuance import schedule_certificate
+from scheduler import QuotaExceeded
+from ssl_generator import normalize_domains
+
+# 没有新事件时每隔多少秒产出一行心跳，避免代理断开空闲连接
+HEARTBEAT_SECONDS = 15
+
+def parse_json_items(items):
+    """JSON请求中的证书列表：每项为域名字符串（多个SAN以逗号分隔）、域名列表或 {"domains": ...}
+
+    items不是列表时抛出ValueError；单项的类型在 run_batch 中校验，不合法的项产出失败结果。
+    """
+    if not isinstance(items, list):
+        raise ValueError('证书列表应为JSON数组，每项为一张证书的域名')
+    for item in items:
+        if isinstance(item, dict):
+            item = item.get('domains') or item.get('domain')
+        yield item
+
+def item_domains(item):
+    """单张证书的域名：字符串或字符串列表，其他类型抛出ValueError"""
+    if isinstance(item, str):
+        return item
+    if isinstance(item, list) and all(isinstance(name, str) for name in item):
+        return item
+    raise ValueError(f"证书域名应为字符串或字符串列表: {json.dumps(item, ensure_ascii=False)}")
+
+def parse_csv_items(text):
+    """CSV每行一张证书，每一列为证书包含的一个域名；空行、#开头的行和domain(s)表头被忽略"""
+    for row in csv.reader(io.StringIO(text)):
+        names = [cell.strip() for cell in row if cell.strip()]
+        if not names or names[0].startswith('#') or names[0].lower() in ('domain', 'domains'):
+            continue
+        yield names
+
+def run_batch(user_id, items, email, cf_email, cf_api_key, max_workers=4, **issue_options):
+    """批量签发，按完成顺序逐个产出事件
+
+    - {'type': 'progress', 'index', 'phase', 'message'}: 单张证书的签发进度
+    - {'type': 'result', 'index', 'domains', 'success', ...}: 单张证书的结果，字段与 /generate 一致
+    - {'type': 'heartbeat'}: 一段时间内没有新事件
+    - {'type': 'summary', 'total', 'succeeded', 'failed'}: 最后一行汇总
+
+    同时提交到调度器的证书不超过 max_workers 张，items按需读取，产出后的结果不再保留。
+    issue_options 原样传给 issue_certificate（reuse_min_days、admission_max_wait）。
+    """
+    events = queue.Queue()
+    pending_items = enumerate(items)
+    in_flight = 0
+    exhausted = False
+    total = succeeded = 0
+
+    def on_done(index, names, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'success': False, 'message': f"生成证书时发生错误: {str(e)}"}
+
+        event = {'type': 'result', 'index': index, 'domains': names}
+        event.update(result)
+        events.put(event)
+
+    def progress_listener(index):
+        def on_progress(phase, message):
+            events.put({'type': 'progress', 'index': index, 'phase': phase, 'message': message})
+        return on_progress
+
+    while True:
+        # 补满提交窗口
+        while not exhausted and in_flight < max_workers:
+            try:
+                index, item = next(pending_items)
+            except StopIteration:
+                exhausted = True
+                break
+
+            total += 1
+            try:
+                names = normalize_domains(item_domains(item or []))
+                future = schedule_certificate(user_id, names, email, cf_email, cf_api_key, kind='bulk',
+                                              on_progress=progress_listener(index), **issue_options)
+            except (ValueError, QuotaExceeded) as e:
+                yield {'type': 'result', 'index': index, 'domains': item, 'success': False, 'message': str(e)}
+                continue
+
+            future.add_done_callback(lambda future, index=index, names=names: on_done(index, names, future))
+            in_flight += 1
+
+        if exhausted and in_flight == 0:
+            break
+
+        try:
+            event = events.get(timeout=HEARTBEAT_SECONDS)
+        except queue.Empty:
+            yield {'type': 'heartbeat'}
+            continue
+
+        if event['type'] == 'result':
+            in_flight -= 1
+            if event['success']:
+                succeeded += 1
+        yield event
+
+    yield {'type': 'summary', 'total': total, 'succeeded': succeeded, 'failed': total - succeeded}
+
+def main():
+    parser = argparse.ArgumentParser(description='批量签发SSL证书，结果以NDJSON逐行输出到标准输出')
+    parser.add_argument('file', help='域名列表文件：.json（列表）或CSV（每行一张证书），- 表示从标准输入读取CSV')
+    parser.add_argument('--user', required=True, help='证书记录所属的用户邮箱')
+    parser.add_argument('--email', required=True, help='ACME账户邮箱')
+    parser.add_argument('--cf-email', required=True, help='Cloudflare账户邮箱')
+    parser.add_argument('--cf-api-key', default=os.environ.get('CF_API_KEY'), help='Cloudflare Global API Key（默认读取环境变量CF_API_KEY）')
+    parser.add_argument('--workers', type=int, default=4, help='同时进行的签发数量')
+    parser.add_argument('--reuse-days', type=int, help='复用剩余有效期不少于该天数的现有证书')
+    parser.add_argument('--max-wait', type=int, default=60, help='预计触发CA限流时最多排队等待的秒数')
+    args = parser.parse_args()
+
+    if not args.cf_api_key:
+        parser.error('请通过 --cf-api-key 或环境变量 CF_API_KEY 提供Cloudflare密钥')
+
+    # 签发过程的日志输出到标准错误，标准输出只保留NDJSON结果
+    output = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        from database import init_db, get_user_by_email
+        init_db()
+        user = get_user_by_email(args.user)
+        if not user:
+            parser.error(f'用户不存在: {args.user}')
+
+        if args.file == '-':
+            items = list(parse_csv_items(sys.stdin.read()))
+        else:
+            with open(args.file, encoding='utf-8-sig') as f:
+                text = f.read()
+            try:
+                items = list(parse_json_items(json.loads(text))) if args.file.endswith('.json') else list(parse_csv_items(text))
+            except ValueError as e:
+                parser.error(str(e))
+
+        for event in run_batch(user.id, items, args.email, args.cf_email, args.cf_api_key,
+                               max_workers=args.workers, reuse_min_days=args.reuse_days,
+                               admission_max_wait=args.max_wait):
+            output.write(json.dumps(event, ensure_ascii=False) + '\n')
+            output.flush()
+
+if __name__ == '__main__':
+    main()
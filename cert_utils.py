@@ -0,0 +1,37 @@
+# 证书解析工具
+# 从PEM格式的证书链中提取有效期、域名等信息
+
+from cryptography import x509
+
+def load_certificate_chain(fullchain_pem):
+    """解析PEM格式的证书链，返回证书列表（第一个为服务器证书）"""
+    if isinstance(fullchain_pem, str):
+        fullchain_pem = fullchain_pem.encode('utf-8')
+
+    certificates = []
+    marker = b'-----END CERTIFICATE-----'
+    for block in fullchain_pem.split(marker):
+        if b'-----BEGIN CERTIFICATE-----' in block:
+            certificates.append(x509.load_pem_x509_certificate(block + marker))
+    return certificates
+
+def certificate_not_after(fullchain_pem):
+    """返回服务器证书的过期时间（UTC，不带时区），解析失败返回None"""
+    try:
+        chain = load_certificate_chain(fullchain_pem)
+    except ValueError:
+        return None
+    if not chain:
+        return None
+    return chain[0].not_valid_after
+
+def certificate_dns_names(fullchain_pem):
+    """返回服务器证书SAN扩展中的全部域名"""
+    chain = load_certificate_chain(fullchain_pem)
+    if not chain:
+        return []
+    try:
+        san = chain[0].extensions.get_extension_for_class(x509.SubjectAlternativeName)
+    except x509.ExtensionNotFound:
+        return []
+    return san.value.get_values_for_type(x509.DNSName)
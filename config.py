@@ -18,6 +18,98 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD') or 'your-authorization-code'
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER') or 'your-email@163.com'
     
+    # 数据库地址：sqlite:///相对路径、sqlite:////绝对路径，或 memory://（进程内内存数据库，用于测试和压测）
+    DATABASE_URL = os.environ.get('DATABASE_URL') or 'sqlite:///ssl_certificates.db'
+    
+    # Prometheus指标接口(/metrics)访问令牌，为空时不校验
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    
+    # 签发进度事件流的重连间隔（毫秒）：每次请求返回已有事件后立即结束，浏览器按该间隔重连获取新事件
+    PROGRESS_RETRY_MS = int(os.environ.get('PROGRESS_RETRY_MS') or 1000)
+    
+    # 证书复用：相同用户、ACME账户和域名集合已有剩余有效期足够的证书时直接返回，不重新签发
+    CERT_REUSE_ENABLED = os.environ.get('CERT_REUSE_ENABLED', 'false').lower() in ['true', 'on', '1']
+    CERT_REUSE_MIN_DAYS = int(os.environ.get('CERT_REUSE_MIN_DAYS') or 30)
+    
+    # 预计触发Let's Encrypt限流时最多排队等待的秒数，超过则直接返回429和Retry-After
+    RATE_LIMIT_MAX_WAIT = int(os.environ.get('RATE_LIMIT_MAX_WAIT') or 60)
+    
+    # 签发任务调度：工作线程数，以及交互式单证书申请相对批量任务的权重倍数
+    # 每个用户的调度权重、并发上限和每日配额保存在users表中
+    ISSUANCE_WORKERS = int(os.environ.get('ISSUANCE_WORKERS') or 8)
+    INTERACTIVE_WEIGHT_BOOST = float(os.environ.get('INTERACTIVE_WEIGHT_BOOST') or 4)
+    
+    # 批量签发：单次最多的证书数量、同时提交到调度器的证书数量和上传CSV文件的最大字节数
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS') or 200)
+    BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS') or 4)
+    BATCH_MAX_UPLOAD_BYTES = int(os.environ.get('BATCH_MAX_UPLOAD_BYTES') or 1024 * 1024)
+    
+    # 后台任务（签发订单恢复等），在只导入应用的脚本中可以关闭
+    BACKGROUND_TASKS_ENABLED = os.environ.get('BACKGROUND_TASKS_ENABLED', 'true').lower() in ['true', 'on', '1']
+    
+    # 请求性能分析：超过SLOW_QUERY_MS毫秒的查询记录慢查询日志；
+    # ADMIN_EMAILS（逗号分隔）中的用户请求带 X-Profile 头时采样调用栈，保存到PROFILE_DIR
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS') or 100)
+    ADMIN_EMAILS = os.environ.get('ADMIN_EMAILS') or ''
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or 'profiles'
+    PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS') or 5)
+    
+    # 后台任务租约的有效期（秒）：多个副本时每个任务只由持有租约的进程执行，
+    # 持有者中断后最迟约LEASE_TTL秒由其他副本接管
+    LEASE_TTL = int(os.environ.get('LEASE_TTL') or 30)
+    
+    # 签发订单恢复：超过ORDER_STALE_SECONDS秒没有更新检查点的订单视为进程已中断，
+    # 每ORDER_RECOVERY_INTERVAL秒检查一次，单个订单最多恢复ORDER_MAX_RECOVERY_ATTEMPTS次
+    # 签发进行中的订单每30秒写入一次心跳，ORDER_STALE_SECONDS应为心跳间隔的数倍
+    ORDER_STALE_SECONDS = int(os.environ.get('ORDER_STALE_SECONDS') or 300)
+    ORDER_RECOVERY_INTERVAL = int(os.environ.get('ORDER_RECOVERY_INTERVAL') or 60)
+    ORDER_MAX_RECOVERY_ATTEMPTS = int(os.environ.get('ORDER_MAX_RECOVERY_ATTEMPTS') or 3)
+    
+    # 证书OCSP状态：每OCSP_REFRESH_INTERVAL秒检查一次到期的缓存，最多同时查询OCSP_MAX_WORKERS张证书，
+    # 对同一个响应者最多OCSP_PER_RESPONDER个并发请求
+    OCSP_REFRESH_INTERVAL = int(os.environ.get('OCSP_REFRESH_INTERVAL') or 600)
+    OCSP_MAX_WORKERS = int(os.environ.get('OCSP_MAX_WORKERS') or 8)
+    OCSP_PER_RESPONDER = int(os.environ.get('OCSP_PER_RESPONDER') or 4)
+    OCSP_TIMEOUT = int(os.environ.get('OCSP_TIMEOUT') or 10)
+    OCSP_BATCH_SIZE = int(os.environ.get('OCSP_BATCH_SIZE') or 500)
+    
+    # 证书续期：每ARI_POLL_INTERVAL秒查询到期证书的ARI续期窗口（CA的Retry-After决定每张证书的查询间隔），
+    # 并为开启了自动续期且到达计划续期时间的证书重新签发，单次最多续期RENEWAL_BATCH_SIZE张，
+    # 最多等待RENEWAL_WAIT_TIMEOUT秒，未完成的续期在后台完成后记录结果
+    # （ACME目录地址由环境变量ACME_DIRECTORY_URL设置，默认为Let's Encrypt正式环境）
+    ARI_POLL_INTERVAL = int(os.environ.get('ARI_POLL_INTERVAL') or 900)
+    ARI_TIMEOUT = int(os.environ.get('ARI_TIMEOUT') or 10)
+    ARI_BATCH_SIZE = int(os.environ.get('ARI_BATCH_SIZE') or 500)
+    RENEWAL_BATCH_SIZE = int(os.environ.get('RENEWAL_BATCH_SIZE') or 50)
+    RENEWAL_WAIT_TIMEOUT = int(os.environ.get('RENEWAL_WAIT_TIMEOUT') or 600)
+    
+    # 证书部署：一张证书最多同时部署到DEPLOY_MAX_WORKERS个目标，单个目标最多尝试DEPLOY_MAX_ATTEMPTS次，
+    # 第n次重试前等待DEPLOY_RETRY_DELAY * 2^(n-1)秒；DEPLOY_TIMEOUT为连接、请求和重新加载命令的超时时间（秒）
+    DEPLOY_MAX_WORKERS = int(os.environ.get('DEPLOY_MAX_WORKERS') or 16)
+    DEPLOY_MAX_ATTEMPTS = int(os.environ.get('DEPLOY_MAX_ATTEMPTS') or 3)
+    DEPLOY_RETRY_DELAY = float(os.environ.get('DEPLOY_RETRY_DELAY') or 2)
+    DEPLOY_TIMEOUT = int(os.environ.get('DEPLOY_TIMEOUT') or 30)
+    
+    # 密码哈希：新哈希使用的算法和参数（werkzeug格式，如 pbkdf2:sha256:600000、scrypt:32768:8:1），
+    # 已有用户登录成功时按新配置重新计算；最多同时计算PASSWORD_HASH_WORKERS个哈希，
+    # 排队超过PASSWORD_HASH_QUEUE_TIMEOUT秒的登录和注册请求直接返回“请稍后再试”
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT') or 5)
+    
+    # 服务端缓存的页面片段数量上限（按用户和数据版本缓存历史记录、邮件记录等）
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 256)
+    
+    # 邮件日志保留策略，每EMAIL_RETENTION_INTERVAL秒执行一次
+    # EMAIL_RETENTION_DAYS按类型设置保留天数，如 "verification=30,general=365"，0表示永久保留
+    EMAIL_RETENTION_INTERVAL = int(os.environ.get('EMAIL_RETENTION_INTERVAL') or 86400)
+    EMAIL_RETENTION_DAYS = os.environ.get('EMAIL_RETENTION_DAYS') or ''
+    EMAIL_RETENTION_DEFAULT_DAYS = int(os.environ.get('EMAIL_RETENTION_DEFAULT_DAYS') or 180)
+    EMAIL_COMPRESS_AFTER_DAYS = int(os.environ.get('EMAIL_COMPRESS_AFTER_DAYS') or 7)
+    EMAIL_RETENTION_BATCH_SIZE = int(os.environ.get('EMAIL_RETENTION_BATCH_SIZE') or 500)
+    # 单次incremental_vacuum最多回收的页数，为空时回收全部空闲页
+    VACUUM_MAX_PAGES = int(os.environ.get('VACUUM_MAX_PAGES') or 0) or None
+    
     # 其他邮件服务器配置示例：
     
     # QQ邮箱配置
@@ -0,0 +1,58 @@
+# 凭据加密
+# 需要保存在数据库中的凭据（ACME账户私钥、自动续期和进行中订单的Cloudflare API密钥）
+# 以由应用SECRET_KEY派生的密钥加密（Fernet：AES-128-CBC + HMAC-SHA256），数据库文件泄露时不会直接暴露。
+# 加密后的值带有 enc:v1: 前缀，没有前缀的旧数据按明文读取，应用启动时统一加密。
+
+import base64
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+PREFIX = 'enc:v1:'
+
+class CredentialError(Exception):
+    """凭据无法解密（SECRET_KEY已更改或数据损坏）或加密密钥未配置"""
+
+def derive_key(secret_key):
+    """由SECRET_KEY派生Fernet密钥"""
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'ssl-certificates stored credentials v1'
+    ).derive(secret_key.encode('utf-8'))
+    return base64.urlsafe_b64encode(key)
+
+def is_encrypted(value):
+    return isinstance(value, str) and value.startswith(PREFIX)
+
+class CredentialCipher:
+    """加密和解密保存在数据库中的凭据，应用启动时以SECRET_KEY配置"""
+
+    def __init__(self):
+        self._fernet = None
+
+    def configure(self, secret_key):
+        self._fernet = Fernet(derive_key(secret_key))
+
+    def _cipher(self):
+        if self._fernet is None:
+            raise CredentialError('凭据加密密钥未配置（credential_cipher.configure）')
+        return self._fernet
+
+    def encrypt(self, value):
+        """加密凭据，None和已加密的值原样返回"""
+        if value is None or is_encrypted(value):
+            return value
+        return PREFIX + self._cipher().encrypt(value.encode('utf-8')).decode('ascii')
+
+    def decrypt(self, value):
+        """解密凭据，None和旧的明文值原样返回"""
+        if not is_encrypted(value):
+            return value
+        try:
+            return self._cipher().decrypt(value[len(PREFIX):].encode('ascii')).decode('utf-8')
+        except InvalidToken:
+            raise CredentialError('保存的凭据无法解密，SECRET_KEY可能已更改')
+
+credential_cipher = CredentialCipher()
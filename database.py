@@ -1,10 +1,92 @@
 import sqlite3
 import hashlib
 import secrets
+import json
+import time
+import zlib
 from datetime import datetime
+from cryptography import x509
 from flask_login import UserMixin
 from flask_mail import Message
 from flask import url_for, current_app
+from cert_utils import certificate_not_after, certificate_dns_names
+from profiling import record_connection, record_query_time, log_slow_query
+from passwords import password_hasher, PasswordHashingBusy
+from storage import storage
+from credentials import credential_cipher, CredentialError
+
+class ProfiledCursor(sqlite3.Cursor):
+    """统计语句执行和结果读取耗时的游标，慢查询按语句累计的耗时记录"""
+
+    def execute(self, sql, parameters=()):
+        return self._timed(sql, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(sql, super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._timed(sql_script, super().executescript, sql_script)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+    def _timed(self, sql, method, *args):
+        self._sql = sql
+        self._elapsed = 0.0
+        self._logged = False
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._add_time(time.perf_counter() - started, statement=True)
+
+    def _timed_fetch(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._add_time(time.perf_counter() - started)
+
+    def _add_time(self, duration, statement=False):
+        record_query_time(duration, statement)
+        if getattr(self, '_sql', None) is None:
+            return
+        self._elapsed += duration
+        if not self._logged:
+            self._logged = log_slow_query(self._sql, self._elapsed)
+
+class ProfiledConnection(sqlite3.Connection):
+    """返回 ProfiledCursor 的数据库连接"""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def get_connection():
+    """打开当前存储后端（DATABASE_URL）的数据库连接，连接数、查询数和查询耗时计入当前请求的统计"""
+    record_connection()
+    return storage.connect(ProfiledConnection)
+
+# 与SQLite CURRENT_TIMESTAMP一致的时间格式（UTC）
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def format_timestamp(value):
+    """将datetime格式化为数据库中的时间字符串"""
+    return value.strftime(TIMESTAMP_FORMAT) if value else None
 
 class User(UserMixin):
     def __init__(self, id, email, password_hash, is_verified=False):
@@ -15,7 +97,7 @@ class User(UserMixin):
 
 def init_db():
     """初始化数据库"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     # 创建用户表
@@ -46,6 +128,28 @@ def init_db():
         )
     ''')
     
+    # 签发任务的调度参数：调度权重、同时执行的签发任务上限、每天的签发次数配额（0表示不限制）
+    add_missing_columns(cursor, 'users', {
+        'schedule_weight': 'REAL DEFAULT 1.0',
+        'max_concurrent_issuance': 'INTEGER DEFAULT 2',
+        'daily_issuance_quota': 'INTEGER DEFAULT 0'
+    })
+    
+    # 较早的邮件内容以zlib压缩保存，content_compressed标记content是否为压缩后的BLOB
+    add_missing_columns(cursor, 'email_logs', {
+        'content_compressed': 'BOOLEAN DEFAULT FALSE'
+    })
+    
+    # 邮件保留策略按类型和发送时间清理、压缩
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_logs_type_sent_at
+        ON email_logs (email_type, sent_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_logs_sent_at
+        ON email_logs (sent_at)
+    ''')
+    
     # 检查certificates表是否存在user_id列
     cursor.execute("PRAGMA table_info(certificates)")
     columns = [column[1] for column in cursor.fetchall()]
@@ -96,14 +200,369 @@ def init_db():
             )
         ''')
     
+    # 为已有表补充新增的列
+    add_missing_columns(cursor, 'certificates', {
+        'timings': 'TEXT',
+        'not_after': 'TIMESTAMP',
+        'san_domains': 'TEXT'  # 排序后的SAN域名JSON数组
+    })
+    
+    # 证书包含的域名，由certificates表上的触发器维护
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS certificate_domains (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            certificate_id INTEGER NOT NULL,
+            domain TEXT NOT NULL,
+            FOREIGN KEY (certificate_id) REFERENCES certificates (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_certificate_domains_domain ON certificate_domains (domain)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_certificate_domains_certificate ON certificate_domains (certificate_id)')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS certificates_domains_insert AFTER INSERT ON certificates
+        BEGIN
+            INSERT INTO certificate_domains (certificate_id, domain)
+            SELECT NEW.id, value FROM json_each(COALESCE(NEW.san_domains, json_array(NEW.domain)));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS certificates_domains_update AFTER UPDATE OF domain, san_domains ON certificates
+        BEGIN
+            DELETE FROM certificate_domains WHERE certificate_id = OLD.id;
+            INSERT INTO certificate_domains (certificate_id, domain)
+            SELECT NEW.id, value FROM json_each(COALESCE(NEW.san_domains, json_array(NEW.domain)));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS certificates_domains_delete AFTER DELETE ON certificates
+        BEGIN
+            DELETE FROM certificate_domains WHERE certificate_id = OLD.id;
+        END
+    ''')
+    
+    # 域名搜索索引：certificate_domains上的FTS5全文索引（trigram分词），
+    # 支持对域名做子串和后缀（如 *.shop.example.com）的LIKE查询，由certificate_domains上的触发器维护。
+    # SQLite不支持FTS5或trigram分词时不创建，搜索退化为扫描certificate_domains
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'certificate_domain_search'")
+    if not cursor.fetchone():
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE certificate_domain_search USING fts5(
+                    domain, content='certificate_domains', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+            cursor.execute("INSERT INTO certificate_domain_search (certificate_domain_search) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            print(f"无法创建域名搜索索引，搜索将扫描全部域名: {e}")
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'certificate_domain_search'")
+    if cursor.fetchone():
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS certificate_domains_search_insert AFTER INSERT ON certificate_domains
+            BEGIN
+                INSERT INTO certificate_domain_search (rowid, domain) VALUES (NEW.id, NEW.domain);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS certificate_domains_search_delete AFTER DELETE ON certificate_domains
+            BEGIN
+                INSERT INTO certificate_domain_search (certificate_domain_search, rowid, domain)
+                VALUES ('delete', OLD.id, OLD.domain);
+            END
+        ''')
+    
+    # 按过期时间筛选用户的证书
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_certificates_user_not_after
+        ON certificates (user_id, not_after)
+    ''')
+    
+    # 证书复用查询按用户、SAN集合和状态过滤
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_certificates_user_sans
+        ON certificates (user_id, san_domains, status)
+    ''')
+    
+    # 限流调度按时间窗口统计申请记录
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_certificates_created_at
+        ON certificates (created_at)
+    ''')
+    
+    # 为已有证书补充过期时间
+    cursor.execute('''
+        SELECT id, certificate FROM certificates
+        WHERE status = 'success' AND certificate IS NOT NULL AND not_after IS NULL
+    ''')
+    for cert_id, certificate in cursor.fetchall():
+        cursor.execute('UPDATE certificates SET not_after = ? WHERE id = ?',
+                       (format_timestamp(certificate_not_after(certificate)), cert_id))
+    
+    # 为已有证书补充SAN集合（更新触发器会同步certificate_domains）
+    cursor.execute('SELECT id, domain, certificate FROM certificates WHERE san_domains IS NULL')
+    for cert_id, domain, certificate in cursor.fetchall():
+        try:
+            names = certificate_dns_names(certificate) if certificate else []
+        except (ValueError, TypeError, x509.DuplicateExtension) as e:
+            # 无法解析的证书内容不影响启动，以记录中的主域名作为SAN集合
+            print(f"证书 {cert_id} 的内容无法解析，按主域名补充SAN集合: {e}")
+            names = []
+        if not names:
+            names = [domain]
+            if domain.startswith('*.'):
+                names.append(domain[2:])
+        cursor.execute('UPDATE certificates SET san_domains = ? WHERE id = ?',
+                       (san_domains_key(names), cert_id))
+
+    # ACME账户：同一ACME邮箱和目录复用同一个账户，不再每次签发都注册新账户（CA限制每个IP的注册数）
+    # account_key为加密后的账户私钥
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS acme_accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL,
+            directory_url TEXT NOT NULL,
+            account_key TEXT NOT NULL,
+            account_uri TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (email, directory_url)
+        )
+    ''')
+    
+    # 实际发生的CA操作（账户注册、订单结果），只由真正向CA发出请求的签发写入，
+    # 合并签发中为其他用户保存的证书记录不计入，限流统计以此为准
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS acme_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            email TEXT NOT NULL,
+            san_domains TEXT,
+            status TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_acme_events_kind_created
+        ON acme_events (kind, created_at)
+    ''')
+
+    # 签发订单检查点：每完成一个阶段写入一次，进程重启后据此恢复
+    # state为签发状态（ACME账户、订单URL、证书私钥、已添加的DNS记录等）的JSON
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS issuance_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            domains TEXT NOT NULL,
+            email TEXT NOT NULL,
+            cf_email TEXT NOT NULL,
+            cf_api_key TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            phase TEXT NOT NULL DEFAULT 'created',
+            state TEXT,
+            certificate_id INTEGER,
+            error_message TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (certificate_id) REFERENCES certificates (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_issuance_orders_status
+        ON issuance_orders (status, updated_at)
+    ''')
+
+    # 用户数据版本：证书记录、邮件记录每次变化时由触发器递增，
+    # 用于生成页面的ETag和服务端片段缓存的key。user_id为0表示不属于任何用户的邮件记录
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_id INTEGER NOT NULL,
+            scope TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, scope)
+        )
+    ''')
+    for table, scope in (('certificates', 'certificates'), ('email_logs', 'emails')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO user_data_versions (user_id, scope, version, updated_at)
+                    VALUES (COALESCE({row}.user_id, 0), '{scope}', 1, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id, scope) DO UPDATE
+                    SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+                END
+            ''')
+    # 已有数据以最后一次写入时间作为初始版本的修改时间
+    cursor.execute('''
+        INSERT OR IGNORE INTO user_data_versions (user_id, scope, version, updated_at)
+        SELECT COALESCE(user_id, 0), 'certificates', 1, MAX(created_at) FROM certificates GROUP BY COALESCE(user_id, 0)
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO user_data_versions (user_id, scope, version, updated_at)
+        SELECT COALESCE(user_id, 0), 'emails', 1, MAX(sent_at) FROM email_logs GROUP BY COALESCE(user_id, 0)
+    ''')
+    
+    # 证书的OCSP状态缓存：response为响应者返回的DER，缓存到next_update，
+    # 在refresh_at之后由后台任务刷新；证书中没有OCSP地址时status为unavailable且不再刷新
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ocsp_responses (
+            certificate_id INTEGER PRIMARY KEY,
+            responder_url TEXT,
+            status TEXT NOT NULL,
+            revoked_at TIMESTAMP,
+            revocation_reason TEXT,
+            this_update TIMESTAMP,
+            next_update TIMESTAMP,
+            response BLOB,
+            checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            refresh_at TIMESTAMP,
+            error_message TEXT,
+            FOREIGN KEY (certificate_id) REFERENCES certificates (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ocsp_responses_refresh_at
+        ON ocsp_responses (refresh_at)
+    ''')
+    # OCSP状态显示在历史记录页面，变化时递增证书所属用户的数据版本
+    for event in ('INSERT', 'UPDATE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS ocsp_responses_version_{event.lower()} AFTER {event} ON ocsp_responses
+            BEGIN
+                INSERT INTO user_data_versions (user_id, scope, version, updated_at)
+                SELECT COALESCE(user_id, 0), 'certificates', 1, CURRENT_TIMESTAMP FROM certificates WHERE id = NEW.certificate_id
+                ON CONFLICT (user_id, scope) DO UPDATE
+                SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+            END
+        ''')
+    
+    # 证书续期计划：window为CA通过ARI（ACME Renewal Information）建议的续期时间窗口，
+    # scheduled_at为在窗口内随机选取的续期时间，next_poll_at为下一次查询ARI的时间（遵循Retry-After）。
+    # auto_renew由用户开启，开启时保存续期所需的Cloudflare密钥；renewed_certificate_id为续期得到的新证书
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS renewal_info (
+            certificate_id INTEGER PRIMARY KEY,
+            ari_cert_id TEXT,
+            source TEXT,
+            window_start TIMESTAMP,
+            window_end TIMESTAMP,
+            explanation_url TEXT,
+            scheduled_at TIMESTAMP,
+            next_poll_at TIMESTAMP,
+            checked_at TIMESTAMP,
+            auto_renew BOOLEAN DEFAULT FALSE,
+            cf_api_key TEXT,
+            renewal_attempts INTEGER DEFAULT 0,
+            renewed_certificate_id INTEGER,
+            error_message TEXT,
+            FOREIGN KEY (certificate_id) REFERENCES certificates (id),
+            FOREIGN KEY (renewed_certificate_id) REFERENCES certificates (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_renewal_info_next_poll_at
+        ON renewal_info (next_poll_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_renewal_info_scheduled_at
+        ON renewal_info (auto_renew, scheduled_at)
+    ''')
+    
+    # 证书部署目标：按用户和SAN集合配置，该域名集合签发（含续期）得到的每张证书都部署到这些目标。
+    # kind为local（本机目录）、sftp或webhook，config为目标参数的JSON（含密码等密钥）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deployment_targets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            san_domains TEXT NOT NULL,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            config TEXT NOT NULL,
+            enabled BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deployment_targets_user_sans
+        ON deployment_targets (user_id, san_domains)
+    ''')
+    
+    # 部署记录：每个目标每个证书指纹一条，已成功部署的指纹不再重复部署；
+    # status为running/success/failed，result为deployed（已写入并重新加载）或unchanged（目标上已是该证书）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deployments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target_id INTEGER NOT NULL,
+            certificate_id INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status TEXT NOT NULL,
+            result TEXT,
+            attempts INTEGER DEFAULT 0,
+            error_message TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            UNIQUE (target_id, fingerprint),
+            FOREIGN KEY (target_id) REFERENCES deployment_targets (id),
+            FOREIGN KEY (certificate_id) REFERENCES certificates (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deployments_certificate
+        ON deployments (certificate_id)
+    ''')
+    
+    # 租约：多个副本共用数据库时，后台任务只在持有租约的进程中执行
+    # expires_at、heartbeat_at为Unix时间戳（秒），token为fencing token，每次换持有者时递增，
+    # last_slot为最后一次执行的周期编号，保证每个周期只执行一次
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            token INTEGER NOT NULL DEFAULT 0,
+            expires_at REAL NOT NULL DEFAULT 0,
+            heartbeat_at REAL,
+            last_slot INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
     conn.commit()
+    
+    enable_incremental_vacuum(conn)
     conn.close()
 
+def enable_incremental_vacuum(conn):
+    """将数据库切换为增量回收模式（auto_vacuum=INCREMENTAL）
+
+    已有数据库切换模式需要执行一次完整的VACUUM，之后由保留策略定期执行
+    PRAGMA incremental_vacuum 归还空闲页。
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    
+    print("切换数据库为增量回收模式，执行VACUUM...")
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+def san_domains_key(domains):
+    """SAN集合的规范形式（小写、去重、排序后的JSON数组），相同域名集合得到相同的值"""
+    return json.dumps(sorted(set(domain.lower() for domain in domains)))
+
+def add_missing_columns(cursor, table, columns):
+    """为已存在的表补充缺失的列"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = [column[1] for column in cursor.fetchall()]
+    
+    for name, definition in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+
 def create_user(email, password):
     """创建新用户"""
-    from werkzeug.security import generate_password_hash
-    
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -113,7 +572,7 @@ def create_user(email, password):
             return {'success': False, 'message': '该邮箱已被注册。'}
         
         # 生成密码哈希和验证令牌
-        password_hash = generate_password_hash(password)
+        password_hash = password_hasher.hash(password)
         verification_token = secrets.token_urlsafe(32)
         
         # 插入用户
@@ -129,16 +588,16 @@ def create_user(email, password):
         
         return {'success': True, 'message': '注册成功，请检查邮箱验证。'}
         
+    except PasswordHashingBusy as e:
+        return {'success': False, 'message': str(e)}
     except Exception as e:
         return {'success': False, 'message': f'注册失败: {str(e)}'}
     finally:
         conn.close()
 
 def verify_user(email, password):
-    """验证用户登录"""
-    from werkzeug.security import check_password_hash
-    
-    conn = sqlite3.connect('ssl_certificates.db')
+    """验证用户登录，同时计算的密码哈希过多时抛出PasswordHashingBusy"""
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -149,12 +608,24 @@ def verify_user(email, password):
         
         user_data = cursor.fetchone()
         if user_data:
-            # 确保password_hash是字符串类型
-            password_hash = user_data[2]
-            if isinstance(password_hash, bytes):
-                password_hash = password_hash.decode('utf-8')
-            
-            if check_password_hash(password_hash, password):
+            stored_hash = user_data[2]
+            if password_hasher.verify(stored_hash, password):
+                # 确保password_hash是字符串类型
+                password_hash = stored_hash.decode('utf-8') if isinstance(stored_hash, bytes) else stored_hash
+                
+                # 旧算法、旧参数或以bytes保存的哈希按当前配置重新计算；繁忙时跳过，下次登录再升级
+                if password_hasher.needs_rehash(stored_hash):
+                    try:
+                        new_hash = password_hasher.hash(password)
+                    except PasswordHashingBusy:
+                        new_hash = None
+                    if new_hash:
+                        cursor.execute('''
+                            UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?
+                        ''', (new_hash, user_data[0], stored_hash))
+                        conn.commit()
+                        password_hash = new_hash
+                
                 return User(user_data[0], user_data[1], password_hash, user_data[3])
         
         return None
@@ -164,7 +635,7 @@ def verify_user(email, password):
 
 def get_user_by_id(user_id):
     """根据ID获取用户"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -187,9 +658,73 @@ def get_user_by_id(user_id):
     finally:
         conn.close()
 
+def get_user_by_email(email):
+    """根据邮箱获取用户"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT id, email, password_hash, is_verified
+            FROM users WHERE email = ?
+        ''', (email,))
+        
+        user_data = cursor.fetchone()
+        if user_data:
+            password_hash = user_data[2]
+            if isinstance(password_hash, bytes):
+                password_hash = password_hash.decode('utf-8')
+            
+            return User(user_data[0], user_data[1], password_hash, user_data[3])
+        
+        return None
+        
+    finally:
+        conn.close()
+
+def get_user_schedule_policy(user_id):
+    """获取用户的签发调度参数"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT schedule_weight, max_concurrent_issuance, daily_issuance_quota
+            FROM users WHERE id = ?
+        ''', (user_id,))
+        
+        row = cursor.fetchone()
+        if row:
+            return {
+                'weight': row[0] if row[0] is not None else 1.0,
+                'max_concurrent': row[1] if row[1] is not None else 2,
+                'daily_quota': row[2] or 0
+            }
+        
+        return None
+        
+    finally:
+        conn.close()
+
+def count_user_certificates_since(user_id, since):
+    """统计用户在since之后的证书申请次数"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT COUNT(*) FROM certificates
+            WHERE user_id = ? AND created_at >= ?
+        ''', (user_id, format_timestamp(since)))
+        
+        return cursor.fetchone()[0]
+        
+    finally:
+        conn.close()
+
 def verify_email_token(token):
     """验证邮箱令牌"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -222,7 +757,7 @@ def send_verification_email(email, token):
     
     # 获取用户ID（如果存在）
     user_id = None
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
@@ -239,6 +774,9 @@ def send_email_with_log(user_id, recipient_email, subject, content, email_type='
     """发送邮件并记录到数据库，包含重试机制"""
     import time
     import socket
+    from metrics import EMAIL_SEND_SECONDS
+    
+    started = time.perf_counter()
     
     # 先记录邮件到数据库
     email_log_id = log_email(user_id, recipient_email, subject, content, email_type, 'pending')
@@ -262,6 +800,7 @@ def send_email_with_log(user_id, recipient_email, subject, content, email_type='
             
             # 更新邮件状态为成功
             update_email_status(email_log_id, 'sent')
+            EMAIL_SEND_SECONDS.labels(email_type=email_type, status='sent').observe(time.perf_counter() - started)
             print(f"邮件发送成功: {recipient_email}")
             return
             
@@ -288,16 +827,19 @@ def send_email_with_log(user_id, recipient_email, subject, content, email_type='
             # 对于认证错误等不需要重试的错误，直接失败
             if 'authentication' in str(e).lower() or 'login' in str(e).lower():
                 update_email_status(email_log_id, 'failed', f"认证失败: {str(e)}")
+                EMAIL_SEND_SECONDS.labels(email_type=email_type, status='failed').observe(time.perf_counter() - started)
                 return
                 
             if attempt == max_retries - 1:
                 update_email_status(email_log_id, 'failed', f"发送失败: {error_msg}")
             else:
                 time.sleep(retry_delay)
+    
+    EMAIL_SEND_SECONDS.labels(email_type=email_type, status='failed').observe(time.perf_counter() - started)
 
 def log_email(user_id, recipient_email, subject, content, email_type, status, error_message=None):
     """记录邮件到数据库"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -315,7 +857,7 @@ def log_email(user_id, recipient_email, subject, content, email_type, status, er
 
 def update_email_status(email_log_id, status, error_message=None):
     """更新邮件发送状态"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -332,7 +874,7 @@ def update_email_status(email_log_id, status, error_message=None):
 
 def get_user_email_logs(user_id, limit=50):
     """获取用户的邮件发送记录"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -361,14 +903,24 @@ def get_user_email_logs(user_id, limit=50):
     finally:
         conn.close()
 
+def compress_email_content(content):
+    """压缩邮件内容"""
+    return zlib.compress(content.encode('utf-8'), 9)
+
+def decompress_email_content(content, compressed):
+    """读取邮件内容，压缩保存的内容自动解压"""
+    if compressed:
+        return zlib.decompress(content).decode('utf-8')
+    return content
+
 def get_email_log_detail(log_id, user_id):
     """获取邮件记录详情"""
-    conn = sqlite3.connect('ssl_certificates.db')
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute('''
-            SELECT id, recipient_email, subject, content, email_type, status, sent_at, error_message
+            SELECT id, recipient_email, subject, content, email_type, status, sent_at, error_message, content_compressed
             FROM email_logs 
             WHERE id = ? AND (user_id = ? OR user_id IS NULL)
         ''', (log_id, user_id))
@@ -379,7 +931,7 @@ def get_email_log_detail(log_id, user_id):
                 'id': row[0],
                 'recipient_email': row[1],
                 'subject': row[2],
-                'content': row[3],
+                'content': decompress_email_content(row[3], row[8]),
                 'email_type': row[4],
                 'status': row[5],
                 'sent_at': row[6],
@@ -391,16 +943,24 @@ def get_email_log_detail(log_id, user_id):
     finally:
         conn.close()
 
-def save_certificate_record(user_id, domain, email, cf_email, status, private_key=None, certificate=None, ca_certificate=None, error_message=None):
-    """保存证书记录"""
-    conn = sqlite3.connect('ssl_certificates.db')
+def save_certificate_record(user_id, domain, email, cf_email, status, private_key=None, certificate=None, ca_certificate=None, error_message=None, timings=None, san_domains=None):
+    """保存证书记录
+
+    domain为证书主域名，san_domains为证书包含的全部域名（默认只有主域名），
+    timings为各签发阶段的耗时记录。
+    """
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
+        not_after = format_timestamp(certificate_not_after(certificate)) if certificate else None
+        
         cursor.execute('''
-            INSERT INTO certificates (user_id, domain, email, cf_email, status, private_key, certificate, ca_certificate, error_message)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, domain, email, cf_email, status, private_key, certificate, ca_certificate, error_message))
+            INSERT INTO certificates (user_id, domain, email, cf_email, status, private_key, certificate, ca_certificate, error_message, timings, not_after, san_domains)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, domain, email, cf_email, status, private_key, certificate, ca_certificate, error_message,
+              json.dumps(timings) if timings is not None else None, not_after,
+              san_domains_key(san_domains or [domain])))
         
         cert_id = cursor.lastrowid
         conn.commit()
@@ -409,64 +969,1216 @@ def save_certificate_record(user_id, domain, email, cf_email, status, private_ke
     finally:
         conn.close()
 
-def get_user_certificates(user_id):
-    """获取用户的证书记录"""
-    conn = sqlite3.connect('ssl_certificates.db')
+def find_reusable_certificates(user_id, san_domains, email, valid_until):
+    """查找同一用户、同一ACME账户、SAN集合完全相同，且在valid_until之后才过期的成功证书（按过期时间倒序）"""
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute('''
-            SELECT id, domain, email, cf_email, status, created_at, error_message
-            FROM certificates 
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        
-        certificates = []
-        for row in cursor.fetchall():
-            certificates.append({
-                'id': row[0],
-                'domain': row[1],
-                'email': row[2],
-                'cf_email': row[3],
-                'status': row[4],
-                'created_at': row[5],
-                'error_message': row[6]
-            })
+            SELECT id, private_key, certificate, ca_certificate, not_after
+            FROM certificates
+            WHERE user_id = ? AND san_domains = ? AND status = 'success' AND email = ?
+              AND certificate IS NOT NULL AND not_after > ?
+            ORDER BY not_after DESC
+        ''', (user_id, san_domains_key(san_domains), email, format_timestamp(valid_until)))
         
-        return certificates
+        return [{
+            'id': row[0],
+            'private_key': row[1],
+            'certificate': row[2],
+            'ca_certificate': row[3],
+            'not_after': row[4]
+        } for row in cursor.fetchall()]
         
     finally:
         conn.close()
 
-def get_certificate_by_id(cert_id, user_id):
-    """根据ID获取证书详情（仅限用户自己的证书）"""
-    conn = sqlite3.connect('ssl_certificates.db')
+def get_acme_account(email, directory_url):
+    """已注册的ACME账户 {'account_key', 'account_uri'}，没有时返回None"""
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute('''
-            SELECT id, domain, email, cf_email, status, private_key, certificate, ca_certificate, created_at, error_message
-            FROM certificates 
-            WHERE id = ? AND user_id = ?
-        ''', (cert_id, user_id))
+            SELECT account_key, account_uri FROM acme_accounts
+            WHERE email = ? AND directory_url = ?
+        ''', (email.strip().lower(), directory_url))
         
         row = cursor.fetchone()
         if row:
-            return {
-                'id': row[0],
-                'domain': row[1],
-                'email': row[2],
-                'cf_email': row[3],
-                'status': row[4],
-                'private_key': row[5],
-                'certificate': row[6],
-                'ca_certificate': row[7],
-                'created_at': row[8],
-                'error_message': row[9]
-            }
-        
+            return {'account_key': credential_cipher.decrypt(row[0]), 'account_uri': row[1]}
         return None
         
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+def save_acme_account(email, directory_url, account_key, account_uri):
+    """保存新注册的ACME账户并记录一次注册；同一邮箱并发注册时保留先保存的账户"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO acme_accounts (email, directory_url, account_key, account_uri)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (email, directory_url) DO NOTHING
+        ''', (email.strip().lower(), directory_url, credential_cipher.encrypt(account_key), account_uri))
+        cursor.execute("INSERT INTO acme_events (kind, email) VALUES ('registration', ?)", (email,))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def record_acme_order(email, san_domains, status):
+    """记录一个向CA提交的订单的结果（success/failed）"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO acme_events (kind, email, san_domains, status)
+            VALUES ('order', ?, ?, ?)
+        ''', (email, san_domains_key(san_domains), status))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def get_acme_event_times(since, kind, status=None, email=None, san_domains=None, contains_domain=None, registered_domain=None):
+    """返回since之后符合条件的CA操作时间（倒序），用于限流窗口统计
+
+    kind 为registration（账户注册）或order（订单）；san_domains 匹配SAN集合完全相同的订单，
+    contains_domain 匹配包含该域名的订单，registered_domain 匹配包含该注册域名本身或其任意子域名（含通配符）的订单。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        conditions = ['kind = ?', 'created_at > ?']
+        params = [kind, format_timestamp(since)]
+        
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if email:
+            conditions.append('email = ?')
+            params.append(email)
+        if san_domains:
+            conditions.append('san_domains = ?')
+            params.append(san_domains_key(san_domains))
+        if contains_domain:
+            conditions.append('EXISTS (SELECT 1 FROM json_each(acme_events.san_domains) d WHERE d.value = ?)')
+            params.append(contains_domain.lower())
+        if registered_domain:
+            conditions.append('''EXISTS (
+                SELECT 1 FROM json_each(acme_events.san_domains) d
+                WHERE d.value = ? OR d.value LIKE ?
+            )''')
+            params.extend([registered_domain.lower(), f'%.{registered_domain.lower()}'])
+        
+        cursor.execute(f'''
+            SELECT created_at FROM acme_events
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at DESC
+        ''', params)
+        
+        return [datetime.strptime(row[0], TIMESTAMP_FORMAT) for row in cursor.fetchall()]
+        
+    finally:
+        conn.close()
+
+# 证书列表（历史记录页面、搜索）查询的列
+CERTIFICATE_SUMMARY_COLUMNS = '''c.id, c.domain, c.email, c.cf_email, c.status, c.created_at, c.error_message, c.san_domains,
+                                 c.not_after, o.status, o.next_update'''
+
+def certificate_summary_from_row(row):
+    return {
+        'id': row[0],
+        'domain': row[1],
+        'email': row[2],
+        'cf_email': row[3],
+        'status': row[4],
+        'created_at': row[5],
+        'error_message': row[6],
+        'san_domains': json.loads(row[7]) if row[7] else [row[1]],
+        'not_after': row[8],
+        'ocsp_status': row[9],
+        'ocsp_next_update': row[10]
+    }
+
+def get_user_certificates(user_id):
+    """获取用户的证书记录"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f'''
+            SELECT {CERTIFICATE_SUMMARY_COLUMNS}
+            FROM certificates c
+            LEFT JOIN ocsp_responses o ON o.certificate_id = c.id
+            WHERE c.user_id = ?
+            ORDER BY c.created_at DESC
+        ''', (user_id,))
+        
+        return [certificate_summary_from_row(row) for row in cursor.fetchall()]
+        
+    finally:
+        conn.close()
+
+def domain_search_pattern(query):
+    """把搜索词转换为域名的LIKE模式：* 匹配任意字符（*.shop.example.com 匹配其所有子域名），
+    不含 * 时按子串匹配；包含域名以外的字符时抛出ValueError"""
+    query = query.strip().lower()
+    if not query or any(not (char.isalnum() or char in '.-*') for char in query):
+        raise ValueError('搜索词只能包含字母、数字、"."、"-" 和通配符 "*"')
+    if '*' in query:
+        return query.replace('*', '%')
+    return f'%{query}%'
+
+# 域名搜索：trigram索引匹配的域名少于该数量时按候选域名查找证书，
+# 否则搜索词不够有选择性，改为按ID倒序扫描用户的证书并逐条匹配，找到limit条即停止
+SEARCH_CANDIDATE_LIMIT = 5000
+
+def search_user_certificates(user_id, query=None, status=None, expires_after=None, expires_before=None,
+                             before_id=None, limit=50):
+    """搜索用户的证书记录（按ID倒序），返回最多limit条
+
+    - query 匹配证书包含的任意域名，规则见 domain_search_pattern()
+    - status 为success或failed；expires_after、expires_before 按过期时间筛选（不含没有过期时间的失败记录）
+    - before_id 用于翻页：只返回ID小于该值的记录
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        conditions = ['c.user_id = ?']
+        params = [user_id]
+        
+        if query:
+            pattern = domain_search_pattern(query)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'certificate_domain_search'")
+            selective = False
+            if cursor.fetchone():
+                cursor.execute('''
+                    SELECT COUNT(*) FROM (
+                        SELECT rowid FROM certificate_domain_search WHERE domain LIKE ? LIMIT ?
+                    )
+                ''', (pattern, SEARCH_CANDIDATE_LIMIT))
+                selective = cursor.fetchone()[0] < SEARCH_CANDIDATE_LIMIT
+            if selective:
+                # 先由trigram索引找出候选域名，再按原始域名确认匹配
+                conditions.append('''c.id IN (
+                    SELECT d.certificate_id FROM certificate_domains d
+                    WHERE d.id IN (SELECT rowid FROM certificate_domain_search WHERE domain LIKE ?)
+                      AND d.domain LIKE ?
+                )''')
+                params.extend([pattern, pattern])
+            else:
+                conditions.append('''EXISTS (
+                    SELECT 1 FROM certificate_domains d WHERE d.certificate_id = c.id AND d.domain LIKE ?
+                )''')
+                params.append(pattern)
+        if status:
+            conditions.append('c.status = ?')
+            params.append(status)
+        if expires_after:
+            conditions.append('c.not_after >= ?')
+            params.append(format_timestamp(expires_after))
+        if expires_before:
+            conditions.append('c.not_after < ?')
+            params.append(format_timestamp(expires_before))
+        if before_id:
+            conditions.append('c.id < ?')
+            params.append(before_id)
+        
+        cursor.execute(f'''
+            SELECT {CERTIFICATE_SUMMARY_COLUMNS}
+            FROM certificates c
+            LEFT JOIN ocsp_responses o ON o.certificate_id = c.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY c.id DESC
+            LIMIT ?
+        ''', params + [limit])
+        
+        return [certificate_summary_from_row(row) for row in cursor.fetchall()]
+        
+    finally:
+        conn.close()
+
+def find_certificates_by_domain(user_id, domain):
+    """查找用户包含指定域名的证书记录ID（按申请时间倒序）"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT c.id FROM certificates c
+            JOIN certificate_domains d ON d.certificate_id = c.id
+            WHERE c.user_id = ? AND d.domain = ?
+            ORDER BY c.created_at DESC
+        ''', (user_id, domain.lower()))
+        
+        return [row[0] for row in cursor.fetchall()]
+        
+    finally:
+        conn.close()
+
+def get_certificate_by_id(cert_id, user_id):
+    """根据ID获取证书详情（仅限用户自己的证书）"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT id, domain, email, cf_email, status, private_key, certificate, ca_certificate, created_at, error_message, timings, san_domains
+            FROM certificates 
+            WHERE id = ? AND user_id = ?
+        ''', (cert_id, user_id))
+        
+        row = cursor.fetchone()
+        if row:
+            return {
+                'id': row[0],
+                'domain': row[1],
+                'email': row[2],
+                'cf_email': row[3],
+                'status': row[4],
+                'private_key': row[5],
+                'certificate': row[6],
+                'ca_certificate': row[7],
+                'created_at': row[8],
+                'error_message': row[9],
+                'timings': json.loads(row[10]) if row[10] else [],
+                'san_domains': json.loads(row[11]) if row[11] else [row[1]],
+                'ocsp': query_ocsp_status(cursor, row[0]),
+                'renewal': query_renewal_info(cursor, row[0]),
+                'deployments': query_certificate_deployments(cursor, row[0], user_id)
+            }
+        
+        return None
+        
+    finally:
+        conn.close()
+
+OCSP_COLUMNS = '''certificate_id, responder_url, status, revoked_at, revocation_reason, this_update,
+                  next_update, checked_at, refresh_at, error_message'''
+
+def ocsp_status_from_row(row):
+    return {
+        'certificate_id': row[0],
+        'responder_url': row[1],
+        'status': row[2],
+        'revoked_at': row[3],
+        'revocation_reason': row[4],
+        'this_update': row[5],
+        'next_update': row[6],
+        'checked_at': row[7],
+        'refresh_at': row[8],
+        'error_message': row[9]
+    }
+
+def query_ocsp_status(cursor, certificate_id):
+    """在调用方的连接中查询证书缓存的OCSP状态（不含DER响应），尚未检查过时返回None"""
+    cursor.execute(f'SELECT {OCSP_COLUMNS} FROM ocsp_responses WHERE certificate_id = ?', (certificate_id,))
+    row = cursor.fetchone()
+    return ocsp_status_from_row(row) if row else None
+
+def get_ocsp_status(certificate_id):
+    """证书缓存的OCSP状态（不含DER响应），尚未检查过时返回None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        return query_ocsp_status(cursor, certificate_id)
+        
+    finally:
+        conn.close()
+
+def get_ocsp_response(certificate_id, user_id):
+    """用户证书缓存的OCSP响应，返回 (状态, DER响应)，没有可用响应时返回None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f'''
+            SELECT {', '.join('o.' + column.strip() for column in OCSP_COLUMNS.split(','))}, o.response
+            FROM ocsp_responses o
+            JOIN certificates c ON c.id = o.certificate_id
+            WHERE o.certificate_id = ? AND c.user_id = ? AND o.response IS NOT NULL
+        ''', (certificate_id, user_id))
+        row = cursor.fetchone()
+        return (ocsp_status_from_row(row), row[10]) if row else None
+        
+    finally:
+        conn.close()
+
+def get_certificates_due_for_ocsp(now, limit=500):
+    """需要查询OCSP的证书：未过期的成功证书中从未查询过或已到刷新时间的，按刷新时间排序"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT c.id, c.certificate, c.ca_certificate
+            FROM certificates c
+            LEFT JOIN ocsp_responses o ON o.certificate_id = c.id
+            WHERE c.status = 'success' AND c.certificate IS NOT NULL
+              AND (c.not_after IS NULL OR c.not_after > ?)
+              AND (o.certificate_id IS NULL OR o.refresh_at <= ?)
+            ORDER BY o.refresh_at IS NOT NULL, o.refresh_at, c.id
+            LIMIT ?
+        ''', (format_timestamp(now), format_timestamp(now), limit))
+        return [{'id': row[0], 'certificate': row[1], 'ca_certificate': row[2]} for row in cursor.fetchall()]
+        
+    finally:
+        conn.close()
+
+def save_ocsp_response(certificate_id, responder_url, status, refresh_at, response=None, this_update=None,
+                       next_update=None, revoked_at=None, revocation_reason=None):
+    """保存一次成功的OCSP查询结果（status为good/revoked/unknown，证书没有OCSP地址时为unavailable）"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO ocsp_responses (certificate_id, responder_url, status, revoked_at, revocation_reason,
+                                        this_update, next_update, response, checked_at, refresh_at, error_message)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?, NULL)
+            ON CONFLICT (certificate_id) DO UPDATE SET
+                responder_url = excluded.responder_url,
+                status = excluded.status,
+                revoked_at = excluded.revoked_at,
+                revocation_reason = excluded.revocation_reason,
+                this_update = excluded.this_update,
+                next_update = excluded.next_update,
+                response = excluded.response,
+                checked_at = excluded.checked_at,
+                refresh_at = excluded.refresh_at,
+                error_message = NULL
+        ''', (certificate_id, responder_url, status, format_timestamp(revoked_at), revocation_reason,
+              format_timestamp(this_update), format_timestamp(next_update), response, format_timestamp(refresh_at)))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def save_ocsp_error(certificate_id, responder_url, error_message, refresh_at):
+    """记录一次失败的OCSP查询；已有的响应在next_update之前仍然有效，予以保留"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO ocsp_responses (certificate_id, responder_url, status, checked_at, refresh_at, error_message)
+            VALUES (?, ?, 'error', CURRENT_TIMESTAMP, ?, ?)
+            ON CONFLICT (certificate_id) DO UPDATE SET
+                status = CASE WHEN next_update IS NOT NULL AND next_update > excluded.checked_at
+                              THEN status ELSE 'error' END,
+                checked_at = excluded.checked_at,
+                refresh_at = excluded.refresh_at,
+                error_message = excluded.error_message
+        ''', (certificate_id, responder_url, format_timestamp(refresh_at), error_message))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def query_renewal_info(cursor, certificate_id):
+    """在调用方的连接中查询证书的续期计划（不含Cloudflare密钥），尚未查询过时返回None"""
+    cursor.execute('''
+        SELECT ari_cert_id, source, window_start, window_end, explanation_url, scheduled_at,
+               next_poll_at, checked_at, auto_renew, renewal_attempts, renewed_certificate_id, error_message
+        FROM renewal_info WHERE certificate_id = ?
+    ''', (certificate_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {
+        'ari_cert_id': row[0],
+        'source': row[1],
+        'window_start': row[2],
+        'window_end': row[3],
+        'explanation_url': row[4],
+        'scheduled_at': row[5],
+        'next_poll_at': row[6],
+        'checked_at': row[7],
+        'auto_renew': bool(row[8]),
+        'renewal_attempts': row[9],
+        'renewed_certificate_id': row[10],
+        'error_message': row[11]
+    }
+
+def get_renewal_info(certificate_id):
+    """证书的续期计划（不含Cloudflare密钥），尚未查询过时返回None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        return query_renewal_info(cursor, certificate_id)
+        
+    finally:
+        conn.close()
+
+def get_certificates_due_for_ari(now, limit=500):
+    """需要查询续期窗口的证书：未过期、尚未续期的成功证书中从未查询过或已到下次查询时间的"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT c.id, c.certificate, c.ca_certificate
+            FROM certificates c
+            LEFT JOIN renewal_info r ON r.certificate_id = c.id
+            WHERE c.status = 'success' AND c.certificate IS NOT NULL
+              AND (c.not_after IS NULL OR c.not_after > ?)
+              AND (r.certificate_id IS NULL OR (r.renewed_certificate_id IS NULL AND (r.next_poll_at IS NULL OR r.next_poll_at <= ?)))
+            ORDER BY r.next_poll_at IS NOT NULL, r.next_poll_at, c.id
+            LIMIT ?
+        ''', (format_timestamp(now), format_timestamp(now), limit))
+        return [{'id': row[0], 'certificate': row[1], 'ca_certificate': row[2]} for row in cursor.fetchall()]
+        
+    finally:
+        conn.close()
+
+def save_renewal_window(certificate_id, ari_cert_id, source, window_start, window_end, explanation_url,
+                        scheduled_at, next_poll_at):
+    """保存查询到的续期窗口
+
+    窗口没有变化时保留已选取的续期时间，窗口变化（如CA因批量吊销提前了窗口）时改用新选取的时间。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO renewal_info (certificate_id, ari_cert_id, source, window_start, window_end, explanation_url,
+                                      scheduled_at, next_poll_at, checked_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (certificate_id) DO UPDATE SET
+                ari_cert_id = excluded.ari_cert_id,
+                source = excluded.source,
+                scheduled_at = CASE WHEN window_start IS excluded.window_start AND window_end IS excluded.window_end
+                                    AND scheduled_at IS NOT NULL
+                                    THEN scheduled_at ELSE excluded.scheduled_at END,
+                window_start = excluded.window_start,
+                window_end = excluded.window_end,
+                explanation_url = excluded.explanation_url,
+                next_poll_at = excluded.next_poll_at,
+                checked_at = excluded.checked_at,
+                error_message = NULL
+        ''', (certificate_id, ari_cert_id, source, format_timestamp(window_start), format_timestamp(window_end),
+              explanation_url, format_timestamp(scheduled_at), format_timestamp(next_poll_at)))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def save_renewal_poll_error(certificate_id, error_message, next_poll_at):
+    """记录一次失败的ARI查询，已有的续期窗口保持不变"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO renewal_info (certificate_id, next_poll_at, checked_at, error_message)
+            VALUES (?, ?, CURRENT_TIMESTAMP, ?)
+            ON CONFLICT (certificate_id) DO UPDATE SET
+                next_poll_at = excluded.next_poll_at,
+                checked_at = excluded.checked_at,
+                error_message = excluded.error_message
+        ''', (certificate_id, format_timestamp(next_poll_at), error_message))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def set_auto_renew(certificate_id, user_id, enabled, cf_api_key=None):
+    """开启或关闭用户证书的自动续期，返回是否更新成功
+
+    开启时Cloudflare密钥加密保存，关闭时删除。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT id FROM certificates WHERE id = ? AND user_id = ? AND status = 'success'
+        ''', (certificate_id, user_id))
+        if not cursor.fetchone():
+            return False
+        
+        cursor.execute('''
+            INSERT INTO renewal_info (certificate_id, auto_renew, cf_api_key)
+            VALUES (?, ?, ?)
+            ON CONFLICT (certificate_id) DO UPDATE SET
+                auto_renew = excluded.auto_renew,
+                cf_api_key = excluded.cf_api_key,
+                renewal_attempts = 0
+        ''', (certificate_id, bool(enabled), credential_cipher.encrypt(cf_api_key) if enabled else None))
+        conn.commit()
+        return True
+        
+    finally:
+        conn.close()
+
+def get_due_renewals(now, limit=50):
+    """已开启自动续期、到达续期时间且尚未续期的证书（Cloudflare密钥已解密），密钥无法解密的证书跳过"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT c.id, c.user_id, c.domain, c.san_domains, c.email, c.cf_email, r.cf_api_key, r.renewal_attempts
+            FROM renewal_info r
+            JOIN certificates c ON c.id = r.certificate_id
+            WHERE r.auto_renew AND r.cf_api_key IS NOT NULL AND r.renewed_certificate_id IS NULL
+              AND r.scheduled_at <= ?
+            ORDER BY r.scheduled_at
+            LIMIT ?
+        ''', (format_timestamp(now), limit))
+        
+        renewals = []
+        for row in cursor.fetchall():
+            try:
+                cf_api_key = credential_cipher.decrypt(row[6])
+            except CredentialError as e:
+                print(f"证书 {row[0]} 的自动续期密钥无法解密，跳过续期: {e}")
+                continue
+            renewals.append({
+                'certificate_id': row[0],
+                'user_id': row[1],
+                'domains': json.loads(row[3]) if row[3] else [row[2]],
+                'email': row[4],
+                'cf_email': row[5],
+                'cf_api_key': cf_api_key,
+                'renewal_attempts': row[7]
+            })
+        return renewals
+        
+    finally:
+        conn.close()
+
+def finish_renewal(certificate_id, renewed_certificate_id):
+    """续期成功：记录新证书，并把自动续期设置转移到新证书上"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO renewal_info (certificate_id, auto_renew, cf_api_key)
+            SELECT ?, auto_renew, cf_api_key FROM renewal_info WHERE certificate_id = ?
+            ON CONFLICT (certificate_id) DO UPDATE SET
+                auto_renew = excluded.auto_renew,
+                cf_api_key = excluded.cf_api_key
+        ''', (renewed_certificate_id, certificate_id))
+        cursor.execute('''
+            UPDATE renewal_info
+            SET renewed_certificate_id = ?, cf_api_key = NULL, error_message = NULL
+            WHERE certificate_id = ?
+        ''', (renewed_certificate_id, certificate_id))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def save_renewal_failure(certificate_id, error_message, retry_at):
+    """续期失败：记录错误并推迟到retry_at重试"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE renewal_info
+            SET error_message = ?, scheduled_at = ?, renewal_attempts = renewal_attempts + 1
+            WHERE certificate_id = ?
+        ''', (error_message, format_timestamp(retry_at), certificate_id))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+# 部署目标参数中不在页面上显示的密钥字段
+DEPLOYMENT_SECRET_FIELDS = ('password', 'private_key', 'secret')
+
+def create_deployment_target(certificate_id, user_id, name, kind, config):
+    """为用户证书的SAN集合添加部署目标，证书不存在或不属于该用户时返回None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO deployment_targets (user_id, san_domains, name, kind, config)
+            SELECT user_id, san_domains, ?, ?, ? FROM certificates WHERE id = ? AND user_id = ?
+        ''', (name, kind, json.dumps(config), certificate_id, user_id))
+        conn.commit()
+        return cursor.lastrowid if cursor.rowcount else None
+        
+    finally:
+        conn.close()
+
+def delete_deployment_target(target_id, user_id):
+    """删除用户的部署目标及其部署记录，返回是否删除成功"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('DELETE FROM deployment_targets WHERE id = ? AND user_id = ?', (target_id, user_id))
+        if not cursor.rowcount:
+            return False
+        cursor.execute('DELETE FROM deployments WHERE target_id = ?', (target_id,))
+        conn.commit()
+        return True
+        
+    finally:
+        conn.close()
+
+def query_certificate_deployments(cursor, certificate_id, user_id):
+    """在调用方的连接中查询证书适用的部署目标（不含密钥）及该证书在各目标上的部署状态"""
+    cursor.execute('''
+        SELECT t.id, t.name, t.kind, t.config, t.enabled,
+               d.status, d.result, d.attempts, d.error_message, d.started_at, d.finished_at
+        FROM certificates c
+        JOIN deployment_targets t ON t.user_id = c.user_id AND t.san_domains = c.san_domains
+        LEFT JOIN deployments d ON d.target_id = t.id AND d.certificate_id = c.id
+        WHERE c.id = ? AND c.user_id = ?
+        ORDER BY t.id
+    ''', (certificate_id, user_id))
+    
+    targets = []
+    for row in cursor.fetchall():
+        config = json.loads(row[3])
+        for field in DEPLOYMENT_SECRET_FIELDS:
+            config.pop(field, None)
+        targets.append({
+            'id': row[0],
+            'name': row[1],
+            'kind': row[2],
+            'config': config,
+            'enabled': bool(row[4]),
+            'status': row[5],
+            'result': row[6],
+            'attempts': row[7],
+            'error_message': row[8],
+            'started_at': row[9],
+            'finished_at': row[10]
+        })
+    return targets
+
+def get_certificate_deployments(certificate_id, user_id):
+    """证书适用的部署目标（不含密钥）及该证书在各目标上的部署状态"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        return query_certificate_deployments(cursor, certificate_id, user_id)
+        
+    finally:
+        conn.close()
+
+def get_deployment_job(certificate_id):
+    """部署一张证书所需的证书内容和已启用的部署目标（含密钥），证书不是成功状态时返回None"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT id, user_id, domain, san_domains, private_key, certificate, ca_certificate, not_after
+            FROM certificates
+            WHERE id = ? AND status = 'success' AND certificate IS NOT NULL AND private_key IS NOT NULL
+        ''', (certificate_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        cursor.execute('''
+            SELECT id, name, kind, config FROM deployment_targets
+            WHERE user_id = ? AND san_domains = ? AND enabled
+            ORDER BY id
+        ''', (row[1], row[3]))
+        targets = [{'id': t[0], 'name': t[1], 'kind': t[2], 'config': json.loads(t[3])} for t in cursor.fetchall()]
+        
+        return {
+            'certificate_id': row[0],
+            'user_id': row[1],
+            'domain': row[2],
+            'san_domains': json.loads(row[3]) if row[3] else [row[2]],
+            'private_key': row[4],
+            'certificate': row[5],
+            'ca_certificate': row[6],
+            'not_after': row[7],
+            'targets': targets
+        }
+        
+    finally:
+        conn.close()
+
+def claim_deployment(target_id, certificate_id, fingerprint, stale_before, force=False):
+    """认领一次部署，返回claimed（首次部署）、reclaimed（重新部署之前失败、中断或强制重新部署的记录），认领失败时返回None
+
+    同一目标上该指纹已成功部署（force时除外）、或其他进程正在部署且未超过stale_before时认领失败，
+    多个进程同时部署同一张证书时每个目标只由一个进程执行。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT 1 FROM deployments WHERE target_id = ? AND fingerprint = ?
+        ''', (target_id, fingerprint))
+        existed = cursor.fetchone() is not None
+        
+        cursor.execute('''
+            INSERT INTO deployments (target_id, certificate_id, fingerprint, status, started_at)
+            VALUES (?, ?, ?, 'running', CURRENT_TIMESTAMP)
+            ON CONFLICT (target_id, fingerprint) DO UPDATE SET
+                certificate_id = excluded.certificate_id,
+                status = 'running',
+                result = NULL,
+                attempts = 0,
+                error_message = NULL,
+                started_at = excluded.started_at,
+                finished_at = NULL
+            WHERE status = 'failed'
+               OR (status = 'running' AND started_at < ?)
+               OR (status = 'success' AND ?)
+        ''', (target_id, certificate_id, fingerprint, format_timestamp(stale_before), bool(force)))
+        claimed = cursor.rowcount > 0
+        conn.commit()
+        if not claimed:
+            return None
+        return 'reclaimed' if existed else 'claimed'
+        
+    finally:
+        conn.close()
+
+def finish_deployment(target_id, fingerprint, status, attempts, result=None, error_message=None):
+    """记录部署结果"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE deployments
+            SET status = ?, result = ?, attempts = ?, error_message = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE target_id = ? AND fingerprint = ?
+        ''', (status, result, attempts, error_message, target_id, fingerprint))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+# 订单结束后从检查点中移除的密钥字段（证书私钥已保存在certificates表），订单进行中加密保存
+ORDER_SECRET_FIELDS = ('account_key', 'private_key', 'certificate')
+
+def dump_order_state(state):
+    """序列化订单检查点，密钥字段加密"""
+    return json.dumps({
+        key: credential_cipher.encrypt(value) if key in ORDER_SECRET_FIELDS else value
+        for key, value in state.items()
+    })
+
+def load_order_state(data):
+    """反序列化订单检查点并解密密钥字段"""
+    state = json.loads(data)
+    for key in ORDER_SECRET_FIELDS:
+        if key in state:
+            state[key] = credential_cipher.decrypt(state[key])
+    return state
+
+def create_issuance_order(user_id, domains, email, cf_email, cf_api_key):
+    """创建签发订单检查点，返回订单ID"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO issuance_orders (user_id, domains, email, cf_email, cf_api_key, state)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, json.dumps(domains), email, cf_email, credential_cipher.encrypt(cf_api_key),
+              json.dumps({'phase': 'created'})))
+        
+        order_id = cursor.lastrowid
+        conn.commit()
+        return order_id
+        
+    finally:
+        conn.close()
+
+def save_issuance_order_state(order_id, state):
+    """写入订单检查点"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE issuance_orders
+            SET phase = ?, state = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (state.get('phase', 'created'), dump_order_state(state), order_id))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def touch_issuance_order(order_id):
+    """刷新进行中订单的updated_at（心跳），单个阶段耗时较长时不会被其他进程当作中断订单认领"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE issuance_orders SET updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'pending'
+        ''', (order_id,))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def finish_issuance_order(order_id, status, state, certificate_id=None, error_message=None):
+    """结束订单（completed/failed）并清除密钥
+
+    仍有未清理的DNS记录时保留Cloudflare密钥，供清理任务稍后重试。
+    """
+    state = {key: value for key, value in state.items() if key not in ORDER_SECRET_FIELDS}
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE issuance_orders
+            SET status = ?, phase = ?, state = ?, certificate_id = ?, error_message = ?,
+                cf_api_key = CASE WHEN ? THEN cf_api_key ELSE NULL END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (status, state.get('phase', 'created'), dump_order_state(state), certificate_id, error_message,
+              bool(state.get('dns_records')), order_id))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def issuance_order_from_row(row):
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'domains': json.loads(row[2]),
+        'email': row[3],
+        'cf_email': row[4],
+        'cf_api_key': credential_cipher.decrypt(row[5]),
+        'status': row[6],
+        'phase': row[7],
+        'state': load_order_state(row[8]) if row[8] else {'phase': row[7]},
+        'attempts': row[9],
+        'updated_at': row[10]
+    }
+
+ISSUANCE_ORDER_COLUMNS = 'id, user_id, domains, email, cf_email, cf_api_key, status, phase, state, attempts, updated_at'
+
+def claim_stale_issuance_orders(stale_before):
+    """认领在stale_before之后没有写入过检查点的进行中订单
+
+    认领会刷新updated_at并增加attempts，以updated_at做乐观锁，
+    多个进程同时执行恢复时每个订单只会被其中一个认领。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f'''
+            SELECT {ISSUANCE_ORDER_COLUMNS} FROM issuance_orders
+            WHERE status = 'pending' AND updated_at < ?
+            ORDER BY id
+        ''', (format_timestamp(stale_before),))
+        
+        claimed = []
+        for row in cursor.fetchall():
+            try:
+                order = issuance_order_from_row(row)
+            except CredentialError as e:
+                print(f"签发订单 #{row[0]} 的凭据无法解密，跳过恢复: {e}")
+                continue
+            cursor.execute('''
+                UPDATE issuance_orders
+                SET attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending' AND updated_at = ?
+            ''', (row[0], row[10]))
+            conn.commit()
+            if cursor.rowcount == 1:
+                order['attempts'] += 1
+                claimed.append(order)
+        
+        return claimed
+        
+    finally:
+        conn.close()
+
+def get_orders_with_orphaned_records():
+    """已结束但仍有DNS验证记录未清理的订单"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(f'''
+            SELECT {ISSUANCE_ORDER_COLUMNS} FROM issuance_orders
+            WHERE status != 'pending' AND cf_api_key IS NOT NULL
+              AND json_array_length(state, '$.dns_records') > 0
+            ORDER BY id
+        ''')
+        
+        orders = []
+        for row in cursor.fetchall():
+            try:
+                orders.append(issuance_order_from_row(row))
+            except CredentialError as e:
+                print(f"签发订单 #{row[0]} 的凭据无法解密，跳过DNS记录清理: {e}")
+        return orders
+        
+    finally:
+        conn.close()
+
+def save_orphaned_records_state(order_id, state):
+    """更新已结束订单的DNS记录清理进度，全部清理后清除Cloudflare密钥"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE issuance_orders
+            SET state = ?, cf_api_key = CASE WHEN ? THEN cf_api_key ELSE NULL END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (dump_order_state(state), bool(state.get('dns_records')), order_id))
+        conn.commit()
+        
+    finally:
+        conn.close()
+
+def encrypt_stored_credentials():
+    """加密旧版本以明文保存的凭据（订单和自动续期的Cloudflare密钥、订单检查点中的密钥字段），返回加密的记录数"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    encrypted = 0
+    
+    try:
+        cursor.execute('''
+            SELECT id, cf_api_key, state FROM issuance_orders
+            WHERE (cf_api_key IS NOT NULL AND cf_api_key NOT LIKE 'enc:v1:%')
+               OR (status = 'pending' AND state IS NOT NULL)
+        ''')
+        for order_id, cf_api_key, state in cursor.fetchall():
+            new_state = dump_order_state(json.loads(state)) if state else state
+            new_key = credential_cipher.encrypt(cf_api_key)
+            if new_key == cf_api_key and new_state == state:
+                continue
+            cursor.execute('''
+                UPDATE issuance_orders SET cf_api_key = ?, state = ? WHERE id = ?
+            ''', (new_key, new_state, order_id))
+            encrypted += 1
+        
+        cursor.execute('''
+            SELECT certificate_id, cf_api_key FROM renewal_info
+            WHERE cf_api_key IS NOT NULL AND cf_api_key NOT LIKE 'enc:v1:%'
+        ''')
+        for certificate_id, cf_api_key in cursor.fetchall():
+            cursor.execute('''
+                UPDATE renewal_info SET cf_api_key = ? WHERE certificate_id = ?
+            ''', (credential_cipher.encrypt(cf_api_key), certificate_id))
+            encrypted += 1
+        
+        conn.commit()
+        return encrypted
+        
+    finally:
+        conn.close()
+
+def compress_email_logs(sent_before, batch_size=500):
+    """压缩sent_before之前发送的邮件内容，每批在单独的事务中提交，返回 (压缩条数, 节省字节数)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    compressed = saved = 0
+    
+    try:
+        while True:
+            cursor.execute('''
+                SELECT id, content FROM email_logs
+                WHERE content_compressed = 0 AND sent_at < ?
+                ORDER BY id
+                LIMIT ?
+            ''', (format_timestamp(sent_before), batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            
+            updates = []
+            for log_id, content in rows:
+                data = compress_email_content(content)
+                saved += len(content.encode('utf-8')) - len(data)
+                updates.append((data, log_id))
+            cursor.executemany('''
+                UPDATE email_logs SET content = ?, content_compressed = 1 WHERE id = ?
+            ''', updates)
+            conn.commit()
+            compressed += len(rows)
+        
+        return compressed, saved
+        
+    finally:
+        conn.close()
+
+def delete_email_logs(sent_before, email_type=None, exclude_types=None, batch_size=500):
+    """分批删除sent_before之前发送的邮件记录，每批在单独的事务中提交，返回删除条数
+
+    email_type 只删除该类型，exclude_types 删除除这些类型以外的记录。
+    """
+    conditions = ['sent_at < ?']
+    params = [format_timestamp(sent_before)]
+    if email_type:
+        conditions.append('email_type = ?')
+        params.append(email_type)
+    if exclude_types:
+        conditions.append(f"email_type NOT IN ({', '.join('?' for _ in exclude_types)})")
+        params.extend(exclude_types)
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    deleted = 0
+    
+    try:
+        while True:
+            cursor.execute(f'''
+                DELETE FROM email_logs WHERE id IN (
+                    SELECT id FROM email_logs WHERE {' AND '.join(conditions)} LIMIT ?
+                )
+            ''', params + [batch_size])
+            conn.commit()
+            if cursor.rowcount <= 0:
+                break
+            deleted += cursor.rowcount
+        
+        return deleted
+        
+    finally:
+        conn.close()
+
+def incremental_vacuum(max_pages=None):
+    """执行 PRAGMA incremental_vacuum 归还空闲页，返回回收的字节数
+
+    max_pages 限制单次回收的页数，避免长时间持有写锁。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+        pages_before = cursor.execute('PRAGMA page_count').fetchone()[0]
+        
+        # incremental_vacuum每执行一步回收一页，execute只会执行一步，
+        # executescript会一直执行到结束
+        if max_pages:
+            cursor.executescript(f'PRAGMA incremental_vacuum({int(max_pages)});')
+        else:
+            cursor.executescript('PRAGMA incremental_vacuum;')
+        
+        pages_after = cursor.execute('PRAGMA page_count').fetchone()[0]
+        return (pages_before - pages_after) * page_size
+        
+    finally:
+        conn.close()
+
+def get_data_versions(keys):
+    """查询数据版本，keys为 [(user_id, scope)]，返回 {(user_id, scope): (version, updated_at)}
+
+    从未变化过的数据版本为0，updated_at为None。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        versions = {key: (0, None) for key in keys}
+        conditions = ' OR '.join('(user_id = ? AND scope = ?)' for _ in keys)
+        cursor.execute(f'''
+            SELECT user_id, scope, version, updated_at FROM user_data_versions
+            WHERE {conditions}
+        ''', [value for key in keys for value in key])
+        
+        for user_id, scope, version, updated_at in cursor.fetchall():
+            versions[(user_id, scope)] = (version, datetime.strptime(updated_at, TIMESTAMP_FORMAT))
+        
+        return versions
+        
+    finally:
+        conn.close()
+
+def acquire_lease(name, holder, ttl):
+    """获取或续约租约，成功时返回fencing token，租约由其他持有者持有且未过期时返回None
+
+    租约过期后由任意进程以一条UPSERT语句抢占，同一时刻只有一个进程能写入成功；
+    持有者变化（包括原持有者在过期后重新获取）时token递增。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        now = time.time()
+        cursor.execute('''
+            INSERT INTO leases (name, holder, token, expires_at, heartbeat_at)
+            VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                token = CASE WHEN leases.holder = excluded.holder AND leases.expires_at > excluded.heartbeat_at
+                             THEN leases.token ELSE leases.token + 1 END,
+                holder = excluded.holder,
+                expires_at = excluded.expires_at,
+                heartbeat_at = excluded.heartbeat_at,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE leases.holder = excluded.holder OR leases.expires_at <= excluded.heartbeat_at
+        ''', (name, holder, now + ttl, now))
+        acquired = cursor.rowcount == 1
+        
+        cursor.execute('SELECT token FROM leases WHERE name = ? AND holder = ?', (name, holder))
+        row = cursor.fetchone()
+        conn.commit()
+        
+        return row[0] if acquired and row else None
+        
+    finally:
+        conn.close()
+
+def release_lease(name, holder, token):
+    """主动释放租约（进程正常退出时），其他进程下次心跳即可接管"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE leases SET expires_at = 0, updated_at = CURRENT_TIMESTAMP
+            WHERE name = ? AND holder = ? AND token = ?
+        ''', (name, holder, token))
+        conn.commit()
+        return cursor.rowcount == 1
+        
+    finally:
+        conn.close()
+
+def claim_lease_slot(name, holder, token, slot):
+    """以租约认领一个执行周期，返回是否认领成功
+
+    只有token仍然有效且未过期的持有者才能认领，每个周期编号只能被认领一次；
+    已被接管的旧持有者即使仍在运行，也会因为token不匹配而认领失败。
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            UPDATE leases SET last_slot = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?
+              AND (last_slot IS NULL OR last_slot < ?)
+        ''', (slot, name, holder, token, time.time(), slot))
+        conn.commit()
+        return cursor.rowcount == 1
+        
+    finally:
+        conn.close()
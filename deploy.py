@@ -0,0 +1,507 @@
+# 证书部署
+# 证书签发成功后推送到用户为该域名集合配置的部署目标：本机目录（原子替换文件后执行重新加载命令）、
+# SFTP（paramiko）和HTTP Webhook。一张证书的各目标并发部署，单个目标失败后按指数退避重试，
+# 结果记录在deployments表。部署以证书指纹去重：同一证书在同一目标上成功部署后不再重复执行，
+# 目标上的文件已是该证书时跳过写入和重新加载。
+# SFTP和Webhook目标由普通用户配置、由服务器发起连接，配置和每次部署时都解析主机并拒绝非公网地址，
+# 部署时连接校验过的地址，不能被用来访问服务器所在内网或云厂商元数据服务。
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import json
+import os
+import posixpath
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit
+import paramiko
+import requests
+from requests.adapters import HTTPAdapter
+from cryptography.hazmat.primitives import serialization
+from cert_utils import load_certificate_chain
+from database import get_deployment_job, claim_deployment, finish_deployment
+from metrics import DEPLOYMENT_TOTAL, DEPLOYMENT_SECONDS
+
+# 写入目标的文件名（与certbot一致）
+FULLCHAIN_FILE = 'fullchain.pem'
+PRIVATE_KEY_FILE = 'privkey.pem'
+
+# 部署进行中的记录超过该时间视为所在进程已中断，可以重新认领
+STALE_DEPLOYMENT = timedelta(minutes=10)
+
+class DeployError(Exception):
+    """部署失败，retryable为False时不再重试（配置错误、认证失败、目标拒绝等）"""
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+def certificate_fingerprint(fullchain_pem):
+    """服务器证书DER编码的SHA-256指纹"""
+    chain = load_certificate_chain(fullchain_pem)
+    if not chain:
+        raise DeployError('证书内容为空', retryable=False)
+    return hashlib.sha256(chain[0].public_bytes(serialization.Encoding.DER)).hexdigest()
+
+def bundle_files(job):
+    """写入目标的文件 {文件名: 内容}，证书链不完整时补上CA证书"""
+    fullchain = job['certificate']
+    if fullchain.count('-----BEGIN CERTIFICATE-----') < 2 and job.get('ca_certificate'):
+        fullchain = fullchain.rstrip('\n') + '\n' + job['ca_certificate']
+    return {
+        FULLCHAIN_FILE: fullchain.encode('utf-8'),
+        PRIVATE_KEY_FILE: job['private_key'].encode('utf-8')
+    }
+
+def resolve_public_address(host, port):
+    """解析部署目标的主机，返回用于连接的地址
+
+    任一解析结果为内网、回环、链路本地、保留、组播或未指定地址时抛出DeployError（不重试）。
+    """
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise DeployError(f'无法解析主机 {host}: {e}')
+    addresses = []
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise DeployError(f'主机 {host} 解析到非公网地址 {address}，不能作为部署目标', retryable=False)
+        addresses.append(str(address))
+    if not addresses:
+        raise DeployError(f'无法解析主机 {host}')
+    return addresses[0]
+
+def webhook_address(url):
+    """Webhook地址的主机和端口"""
+    parts = urlsplit(url)
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError:
+        raise DeployError('Webhook地址的端口无效', retryable=False)
+    if not parts.hostname:
+        raise DeployError('Webhook地址缺少主机名', retryable=False)
+    return parts.hostname, port
+
+class PinnedAddressAdapter(HTTPAdapter):
+    """连接事先校验过的IP地址，Host请求头、TLS的SNI和证书主机名校验仍使用URL中的主机名
+
+    requests按URL中的主机名连接时会再次解析，主机名可能在校验之后解析到内网地址（DNS重绑定）。
+    """
+
+    def __init__(self, scheme, hostname, address, **kwargs):
+        self.scheme = scheme
+        self.hostname = hostname
+        self.address = address
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.scheme == 'https':
+            pool_kwargs.update(server_hostname=self.hostname, assert_hostname=self.hostname)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.scheme != self.scheme or parts.hostname != self.hostname:
+            raise requests.ConnectionError(f'请求的地址 {request.url} 不是已校验的主机 {self.hostname}')
+        host = f'[{self.address}]' if ':' in self.address else self.address
+        request.headers['Host'] = parts.netloc.rpartition('@')[2]
+        request.url = urlunsplit(parts._replace(netloc=f'{host}:{parts.port}' if parts.port else host))
+        return super().send(request, **kwargs)
+
+def file_mode(name):
+    return 0o600 if name == PRIVATE_KEY_FILE else 0o644
+
+class LocalTarget:
+    """本机目录：写入同目录下的临时文件后原子替换，文件有变化时执行重新加载命令"""
+
+    def __init__(self, config, timeout=30):
+        self.directory = config['directory']
+        self.reload_command = config.get('reload_command')
+        self.timeout = timeout
+        # 本次部署已替换文件但重新加载尚未成功，重试时即使文件已是新证书也要重新加载
+        self.reload_pending = False
+
+    @staticmethod
+    def parse_config(form):
+        directory = (form.get('directory') or '').strip()
+        if not directory or not os.path.isabs(directory):
+            raise DeployError('本机目录必须是绝对路径', retryable=False)
+        return {'directory': directory, 'reload_command': (form.get('reload_command') or '').strip() or None}
+
+    def deploy(self, files, job, fingerprint):
+        try:
+            os.makedirs(self.directory, mode=0o755, exist_ok=True)
+            changed = {name: content for name, content in files.items()
+                       if self.read(name) != content}
+            for name, content in changed.items():
+                self.write(name, content)
+        except OSError as e:
+            raise DeployError(f'写入 {self.directory} 失败: {e}')
+
+        if changed:
+            self.reload_pending = True
+        if not self.reload_pending:
+            return 'unchanged'
+        self.reload()
+        self.reload_pending = False
+        return 'deployed'
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, content):
+        fd, temp_path = tempfile.mkstemp(prefix=f'.{name}.', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temp_path, file_mode(name))
+            os.replace(temp_path, os.path.join(self.directory, name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def reload(self):
+        if not self.reload_command:
+            return
+        try:
+            completed = subprocess.run(shlex.split(self.reload_command), capture_output=True, timeout=self.timeout)
+        except (OSError, ValueError) as e:
+            raise DeployError(f'执行重新加载命令失败: {e}', retryable=False)
+        except subprocess.TimeoutExpired:
+            raise DeployError(f'重新加载命令超过 {self.timeout} 秒未结束')
+        if completed.returncode != 0:
+            output = (completed.stderr or completed.stdout).decode('utf-8', 'replace').strip()[-500:]
+            raise DeployError(f'重新加载命令退出码 {completed.returncode}: {output}')
+
+class SFTPTarget:
+    """SFTP：只连接主机密钥与配置一致的服务器，上传到临时文件后重命名，文件有变化时通过SSH执行重新加载命令"""
+
+    def __init__(self, config, timeout=30):
+        self.config = config
+        self.port = int(config.get('port') or 22)
+        self.timeout = timeout
+        self.reload_pending = False
+
+    @staticmethod
+    def parse_config(form):
+        config = {
+            'host': (form.get('host') or '').strip(),
+            'port': int(form.get('port') or 22),
+            'username': (form.get('username') or '').strip(),
+            'password': form.get('password') or None,
+            'private_key': (form.get('private_key') or '').strip() or None,
+            'host_key': (form.get('host_key') or '').strip(),
+            'directory': (form.get('directory') or '').strip(),
+            'reload_command': (form.get('reload_command') or '').strip() or None
+        }
+        if not all([config['host'], config['username'], config['directory']]):
+            raise DeployError('请填写SFTP主机、用户名和目录', retryable=False)
+        if not (config['password'] or config['private_key']):
+            raise DeployError('请填写SFTP密码或私钥', retryable=False)
+        resolve_public_address(config['host'], config['port'])
+        # 主机密钥必须事先确认（ssh-keyscan输出中的"类型 Base64"部分），防止中间人获取证书私钥
+        parse_host_key(config['host_key'])
+        if config['private_key']:
+            load_private_key(config['private_key'])
+        return config
+
+    def connect(self):
+        # 连接本次解析并校验过的地址，主机名在校验之后重新解析到内网地址时也不会连接过去
+        address = resolve_public_address(self.config['host'], self.port)
+        client = paramiko.SSHClient()
+        hostname = address if self.port == 22 else f"[{address}]:{self.port}"
+        key_type, key = parse_host_key(self.config['host_key'])
+        client.get_host_keys().add(hostname, key_type, key)
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        try:
+            client.connect(
+                address, port=self.port, username=self.config['username'],
+                password=self.config.get('password'),
+                pkey=load_private_key(self.config['private_key']) if self.config.get('private_key') else None,
+                timeout=self.timeout, banner_timeout=self.timeout, auth_timeout=self.timeout,
+                allow_agent=False, look_for_keys=False
+            )
+        except paramiko.AuthenticationException as e:
+            raise DeployError(f'SFTP认证失败: {e}', retryable=False)
+        except paramiko.BadHostKeyException:
+            raise DeployError('服务器的主机密钥与配置不一致', retryable=False)
+        except (paramiko.SSHException, OSError) as e:
+            raise DeployError(f'连接 {self.config["host"]} 失败: {e}')
+        return client
+
+    def deploy(self, files, job, fingerprint):
+        client = self.connect()
+        try:
+            sftp = client.open_sftp()
+            changed = {name: content for name, content in files.items()
+                       if self.read(sftp, name) != content}
+            for name, content in changed.items():
+                self.write(sftp, name, content)
+            if changed:
+                self.reload_pending = True
+            if not self.reload_pending:
+                return 'unchanged'
+            self.reload(client)
+            self.reload_pending = False
+            return 'deployed'
+        except (paramiko.SSHException, OSError) as e:
+            raise DeployError(f'SFTP部署失败: {e}')
+        finally:
+            client.close()
+
+    def read(self, sftp, name):
+        try:
+            with sftp.open(posixpath.join(self.config['directory'], name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, sftp, name, content):
+        path = posixpath.join(self.config['directory'], name)
+        temp_path = posixpath.join(self.config['directory'], f'.{name}.{os.urandom(4).hex()}')
+        try:
+            with sftp.open(temp_path, 'wb') as f:
+                # 写入内容之前设置权限，私钥不会以默认权限出现在服务器上
+                sftp.chmod(temp_path, file_mode(name))
+                f.write(content)
+            sftp.posix_rename(temp_path, path)
+        except (paramiko.SSHException, OSError):
+            try:
+                sftp.remove(temp_path)
+            except (paramiko.SSHException, OSError):
+                pass
+            raise
+
+    def reload(self, client):
+        command = self.config.get('reload_command')
+        if not command:
+            return
+        _, stdout, stderr = client.exec_command(command, timeout=self.timeout)
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            output = stderr.read().decode('utf-8', 'replace').strip()[-500:]
+            raise DeployError(f'重新加载命令退出码 {exit_status}: {output}')
+
+def parse_host_key(host_key):
+    """解析 "ssh-ed25519 AAAA..." 形式的主机公钥，返回 (类型, PKey)"""
+    parts = (host_key or '').split()
+    if len(parts) < 2:
+        raise DeployError('请填写服务器主机公钥（如 ssh-keyscan 输出中的 "ssh-ed25519 AAAA..."）', retryable=False)
+    try:
+        entry = paramiko.hostkeys.HostKeyEntry.from_line(f'host {parts[0]} {parts[1]}')
+    except (paramiko.SSHException, paramiko.hostkeys.InvalidHostKey, ValueError):
+        entry = None
+    if entry is None:
+        raise DeployError('无法解析服务器主机公钥', retryable=False)
+    return parts[0], entry.key
+
+def load_private_key(private_key_pem):
+    """加载SFTP登录私钥（Ed25519、ECDSA或RSA，OpenSSH或PEM格式）"""
+    for key_class in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+        try:
+            return key_class.from_private_key(io.StringIO(private_key_pem))
+        except (paramiko.SSHException, ValueError):
+            continue
+    raise DeployError('无法解析SFTP私钥（不支持带密码的私钥）', retryable=False)
+
+class WebhookTarget:
+    """HTTP Webhook：POST证书和私钥的JSON，配置了密钥时附带HMAC-SHA256签名；
+    Idempotency-Key为证书指纹，接收方可以据此忽略重复推送。不跟随重定向，重定向视为部署失败"""
+
+    # 这些状态码表示暂时失败，其余4xx不再重试
+    RETRYABLE_STATUS = (408, 425, 429)
+
+    def __init__(self, config, timeout=30):
+        self.url = config['url']
+        self.secret = config.get('secret')
+        self.timeout = timeout
+
+    @staticmethod
+    def parse_config(form):
+        url = (form.get('url') or '').strip()
+        if not url.startswith(('https://', 'http://')):
+            raise DeployError('Webhook地址必须以 http:// 或 https:// 开头', retryable=False)
+        resolve_public_address(*webhook_address(url))
+        return {'url': url, 'secret': form.get('secret') or None}
+
+    def deploy(self, files, job, fingerprint):
+        body = json.dumps({
+            'certificate_id': job['certificate_id'],
+            'domain': job['domain'],
+            'domains': job['san_domains'],
+            'fingerprint': fingerprint,
+            'not_after': job['not_after'],
+            'fullchain': files[FULLCHAIN_FILE].decode('utf-8'),
+            'private_key': files[PRIVATE_KEY_FILE].decode('utf-8')
+        }).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': fingerprint,
+            'X-Certificate-Fingerprint': fingerprint
+        }
+        if self.secret:
+            digest = hmac.new(self.secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+            headers['X-Signature-256'] = f'sha256={digest}'
+
+        # 连接本次解析并校验过的地址，不让requests按主机名重新解析；不使用环境变量中的代理
+        hostname, port = webhook_address(self.url)
+        address = resolve_public_address(hostname, port)
+        session = requests.Session()
+        session.trust_env = False
+        scheme = urlsplit(self.url).scheme
+        session.mount(f'{scheme}://', PinnedAddressAdapter(scheme, hostname, address))
+        try:
+            response = session.post(self.url, data=body, headers=headers, timeout=self.timeout,
+                                    allow_redirects=False)
+        except requests.RequestException as e:
+            raise DeployError(f'请求Webhook失败: {e}')
+        finally:
+            session.close()
+        if 200 <= response.status_code < 300:
+            return 'deployed'
+        if 300 <= response.status_code < 400:
+            raise DeployError(f'Webhook返回重定向 HTTP {response.status_code}，不会跟随', retryable=False)
+        retryable = response.status_code >= 500 or response.status_code in self.RETRYABLE_STATUS
+        raise DeployError(f'Webhook返回HTTP {response.status_code}', retryable=retryable)
+
+TARGET_TYPES = {
+    'local': LocalTarget,
+    'sftp': SFTPTarget,
+    'webhook': WebhookTarget
+}
+
+def parse_target_config(kind, form):
+    """校验页面提交的部署目标参数，返回保存的配置；参数无效时抛出DeployError"""
+    if kind not in TARGET_TYPES:
+        raise DeployError(f'未知的部署方式: {kind}', retryable=False)
+    return TARGET_TYPES[kind].parse_config(form)
+
+class Deployer:
+    """把一张证书并发部署到全部目标"""
+
+    def __init__(self, max_workers=16, max_attempts=3, retry_delay=2, timeout=30):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._background = None
+
+    def configure(self, max_workers=None, max_attempts=None, retry_delay=None, timeout=None):
+        """应用启动时按配置调整"""
+        if max_workers:
+            self.max_workers = max_workers
+        if max_attempts:
+            self.max_attempts = max_attempts
+        if retry_delay is not None:
+            self.retry_delay = retry_delay
+        if timeout:
+            self.timeout = timeout
+
+    def deploy(self, certificate_id, force=False):
+        """部署证书到全部已启用的目标，返回各结果的数量（deployed/unchanged/failed/skipped）
+
+        已在目标上成功部署的证书记为skipped，force为True时重新部署；证书不存在或没有部署目标时返回空字典。
+        """
+        job = get_deployment_job(certificate_id)
+        if not job or not job['targets']:
+            return {}
+
+        try:
+            fingerprint = certificate_fingerprint(job['certificate'])
+        except (DeployError, ValueError) as e:
+            print(f"证书 {certificate_id} 无法部署: {e}")
+            return {}
+        files = bundle_files(job)
+
+        stale_before = datetime.utcnow() - STALE_DEPLOYMENT
+        claimed = []
+        for target in job['targets']:
+            claim = claim_deployment(target['id'], certificate_id, fingerprint, stale_before, force=force)
+            if claim:
+                claimed.append((target, claim == 'reclaimed'))
+        report = {}
+        if len(claimed) < len(job['targets']):
+            report['skipped'] = len(job['targets']) - len(claimed)
+
+        if claimed:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(claimed)), thread_name_prefix='deploy-target') as executor:
+                for result in executor.map(lambda item: self.deliver(item[0], files, job, fingerprint, redeploy=item[1]), claimed):
+                    report[result] = report.get(result, 0) + 1
+            print(f"证书 {certificate_id} 部署完成: {report}")
+        return report
+
+    def deliver(self, target, files, job, fingerprint, redeploy=False):
+        """部署到单个目标，失败时按指数退避重试，返回deployed/unchanged/failed
+
+        redeploy表示之前的部署失败、中断或被强制重新部署：文件可能已经写入而重新加载没有成功，
+        即使目标上已是该证书也要执行重新加载。
+        """
+        started = time.perf_counter()
+        attempts = 0
+        result, error = None, None
+        try:
+            delivery = TARGET_TYPES[target['kind']](target['config'], timeout=self.timeout)
+        except (DeployError, KeyError) as e:
+            delivery, error = None, str(e) if isinstance(e, DeployError) else f"未知的部署方式: {target['kind']}"
+        if redeploy and hasattr(delivery, 'reload_pending'):
+            delivery.reload_pending = True
+
+        while delivery is not None:
+            attempts += 1
+            try:
+                result = delivery.deploy(files, job, fingerprint)
+                error = None
+                break
+            except DeployError as e:
+                error, retryable = str(e), e.retryable
+            except Exception as e:
+                error, retryable = f'部署出错: {e}', False
+                traceback.print_exc()
+            if not retryable or attempts >= self.max_attempts:
+                break
+            time.sleep(self.retry_delay * 2 ** (attempts - 1))
+
+        status = 'success' if result else 'failed'
+        finish_deployment(target['id'], fingerprint, status, attempts, result=result, error_message=error)
+        DEPLOYMENT_TOTAL.labels(kind=target['kind'], status=result or 'failed').inc()
+        DEPLOYMENT_SECONDS.labels(kind=target['kind']).observe(time.perf_counter() - started)
+        if error:
+            print(f"证书 {job['certificate_id']} 部署到 {target['name']} 失败（{attempts} 次）: {error}")
+        return result or 'failed'
+
+    def deploy_async(self, certificate_id, force=False):
+        """在后台线程中部署，不阻塞签发流程，返回Future"""
+        with self._lock:
+            if self._background is None:
+                self._background = ThreadPoolExecutor(max_workers=2, thread_name_prefix='deploy')
+        return self._background.submit(self._deploy_logged, certificate_id, force)
+
+    def _deploy_logged(self, certificate_id, force):
+        try:
+            return self.deploy(certificate_id, force=force)
+        except Exception as e:
+            print(f"证书 {certificate_id} 部署出错: {e}")
+            traceback.print_exc()
+            return {}
+
+# 进程内共用的部署执行器，应用启动时由 app.py 按配置调整
+deployer = Deployer()
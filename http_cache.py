@@ -0,0 +1,120 @@
+# 页面条件缓存
+# 以用户数据版本（证书记录、邮件记录变化时由触发器递增）生成强ETag和Last-Modified，
+# 数据未变化的请求在执行页面查询之前直接返回304；渲染好的页面片段按数据版本缓存在服务端
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import timezone
+from functools import wraps
+from flask import g, request, session, make_response, Response
+from markupsafe import Markup
+from assets import asset_manifest
+from database import get_data_versions
+
+def templates_digest():
+    """模板内容摘要，模板更新后旧的ETag和缓存片段随之失效"""
+    digest = hashlib.sha256()
+    templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    for root, _, files in sorted(os.walk(templates_dir)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+TEMPLATES_DIGEST = templates_digest()
+
+def render_digest():
+    """渲染结果依赖的模板和静态资源清单的摘要
+
+    页面通过 static_url() 引用带哈希的资源地址，重新构建资源后即使模板和数据都没有变化，
+    旧的ETag和缓存片段中的地址也已失效。资源清单在应用启动后加载，所以每次请求时计算。
+    """
+    return f'{TEMPLATES_DIGEST}.{asset_manifest.digest}'
+
+class LRUCache:
+    """线程安全的LRU缓存"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+# 渲染后的页面片段，key包含数据版本，数据变化后旧片段不再被命中并逐渐淘汰
+fragment_cache = LRUCache()
+
+def conditional(version_keys):
+    """视图装饰器：根据数据版本做HTTP条件请求处理
+
+    version_keys() 返回页面依赖的 [(user_id, scope)]。ETag由页面地址、数据版本、模板和资源清单摘要计算，
+    客户端缓存仍然有效时直接返回304，不执行视图中的查询和渲染。
+    有待显示的flash消息时页面内容与数据版本无关，不返回304。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            keys = version_keys()
+            versions = get_data_versions(keys)
+            g.data_versions = tuple(versions[key][0] for key in keys)
+
+            etag = hashlib.sha256(
+                f'{request.full_path}|{keys}|{g.data_versions}|{render_digest()}'.encode('utf-8')
+            ).hexdigest()[:32]
+            modified_times = [updated_at for _, updated_at in versions.values() if updated_at]
+            last_modified = max(modified_times).replace(tzinfo=timezone.utc) if modified_times else None
+
+            if not session.get('_flashes'):
+                if request.if_none_match:
+                    not_modified = request.if_none_match.contains(etag)
+                else:
+                    not_modified = bool(last_modified and request.if_modified_since
+                                        and last_modified <= request.if_modified_since)
+                if not_modified:
+                    response = Response(status=304)
+                    set_cache_headers(response, etag, last_modified)
+                    return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_cache_headers(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
+
+def set_cache_headers(response, etag, last_modified):
+    """页面只允许浏览器私有缓存，每次使用前都需要重新验证"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+def cached_fragment(name, render, *key_parts):
+    """返回缓存的页面片段，未命中时调用 render() 渲染并缓存
+
+    需要在 @conditional 视图中调用，key由片段名、key_parts、当前数据版本以及模板和资源清单摘要组成。
+    render() 返回字符串时结果标记为安全的HTML，也可以返回可JSON序列化的数据。
+    """
+    key = (name, key_parts, g.data_versions, render_digest())
+    value = fragment_cache.get(key)
+    if value is None:
+        value = render()
+        if isinstance(value, str):
+            value = Markup(value)
+        fragment_cache.set(key, value)
+    return value
@@ -0,0 +1,347 @@
+# 证书签发服务
+# 在SSLCertificateGenerator之上处理相同请求的合并、有效证书的复用、结果保存和部署，
+# 以及订单检查点的持久化和进程重启后的恢复
+
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from database import (
+    save_certificate_record, find_reusable_certificates,
+    create_issuance_order, save_issuance_order_state, touch_issuance_order, finish_issuance_order,
+    claim_stale_issuance_orders, get_orders_with_orphaned_records, save_orphaned_records_state,
+    get_acme_account, save_acme_account, record_acme_order
+)
+from ssl_generator import SSLCertificateGenerator, normalize_domains, ACME_DIRECTORY_URL
+from rate_limit import admission_scheduler, AdmissionDenied, AdmissionQueued
+from scheduler import issuance_scheduler, Requeue
+from deploy import deployer
+
+class SingleFlight:
+    """相同key的并发调用只执行一次，其余调用等待并共享结果"""
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.listeners = []
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, listener=None):
+        """执行 fn(notify) 并返回 (result, shared)
+
+        notify(phase, message) 会转发给所有加入该次调用的 listener，
+        shared 为True表示结果来自其他请求发起的调用。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.Call()
+                self._calls[key] = call
+            if listener:
+                call.listeners.append(listener)
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result, True
+
+        def notify(phase, message):
+            with self._lock:
+                listeners = list(call.listeners)
+            for fn_listener in listeners:
+                fn_listener(phase, message)
+
+        try:
+            call.result = fn(notify)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result, False
+
+# 进程内的签发合并，key为(域名集合, ACME邮箱, Cloudflare账户)
+issuance_flight = SingleFlight()
+
+def flight_key(identifiers, email, cf_email, cf_api_key):
+    """合并签发请求的key
+
+    包含Cloudflare密钥摘要：只有持有相同DNS权限的请求才会共享同一张证书。
+    """
+    key_digest = hashlib.sha256(cf_api_key.encode('utf-8')).hexdigest()
+    return (identifiers, email.strip().lower(), cf_email.strip().lower(), key_digest)
+
+def find_reusable_certificate(user_id, domains, email, min_valid_days):
+    """查找可以直接复用的证书：同一用户和ACME账户、SAN集合一致、剩余有效期不少于min_valid_days天"""
+    valid_until = datetime.utcnow() + timedelta(days=min_valid_days)
+    candidates = find_reusable_certificates(user_id, domains, email, valid_until)
+    return candidates[0] if candidates else None
+
+def issue_certificate(user_id, domains, email, cf_email, cf_api_key, on_progress=None, reuse_min_days=None, admission_max_wait=0):
+    """为用户签发证书并保存记录
+
+    - domains 为单个域名或域名列表，全部域名签发在同一张证书中
+    - reuse_min_days 不为None时，优先复用剩余有效期足够的现有证书
+    - 相同域名集合和账户的并发请求合并为一次ACME订单
+    - 预计触发CA限流时最多排队 admission_max_wait 秒，否则推迟并返回 retry_after；
+      排队以抛出 scheduler.Requeue 的方式在调度器中延后重新执行，不在工作线程中等待
+
+    返回与 /generate 接口一致的结果字典；域名不合法时抛出ValueError。需要在公平调度器中执行。
+    """
+    names = normalize_domains(domains)
+    domain = names[0]
+    
+    if reuse_min_days is not None:
+        existing = find_reusable_certificate(user_id, names, email, reuse_min_days)
+        if existing:
+            print(f"复用现有证书 #{existing['id']}: {domain}")
+            return {
+                'success': True,
+                'message': '已复用有效期内的现有证书',
+                'reused': True,
+                'certificate_id': existing['id'],
+                'private_key': existing['private_key'],
+                'certificate': existing['certificate'],
+                'ca_certificate': existing['ca_certificate'] or ''
+            }
+
+    def run(notify):
+        try:
+            registering = get_acme_account(email, ACME_DIRECTORY_URL) is None
+            ticket = admission_scheduler.admit(names, email, max_wait=admission_max_wait, registering=registering)
+        except AdmissionQueued as e:
+            # 没有创建订单，合并到该次调用的请求各自在等待后重新排队
+            notify('queued', str(e))
+            return {
+                'success': False,
+                'message': str(e),
+                'queued': e.wait,
+                'certificate_id': None,
+                'user_id': user_id
+            }
+        except AdmissionDenied as e:
+            # 被推迟的请求没有创建订单，不写入申请记录
+            print(f"证书申请被推迟: {domain}, {e}")
+            return {
+                'success': False,
+                'message': str(e),
+                'retry_after': e.retry_after,
+                'deferred': True,
+                'certificate_id': None,
+                'user_id': user_id
+            }
+        
+        try:
+            order_id = create_issuance_order(user_id, names, email, cf_email, cf_api_key)
+            generator = SSLCertificateGenerator(cf_email, cf_api_key, on_progress=notify)
+            result, state = run_order(generator, order_id, names, email)
+            if result.get('retry_after'):
+                admission_scheduler.block(names, email, result['retry_after'])
+            result['certificate_id'] = save_result(user_id, names, email, cf_email, result)
+            result['user_id'] = user_id
+            finish_order(order_id, state, result)
+            return result
+        finally:
+            admission_scheduler.release(ticket)
+
+    key = flight_key(tuple(sorted(names)), email, cf_email, cf_api_key)
+    result, shared = issuance_flight.do(key, run, listener=on_progress)
+    if result.get('queued'):
+        # 等待期间释放工作线程，到时间后重新申请准入，排队时间计入 admission_max_wait
+        raise Requeue(result['queued'], lambda: issue_certificate(
+            user_id, names, email, cf_email, cf_api_key, on_progress=on_progress,
+            reuse_min_days=reuse_min_days, admission_max_wait=max(admission_max_wait - result['queued'], 0)))
+
+    certificate_id = result['certificate_id']
+    if shared:
+        print(f"合并到正在进行的签发: {domain}")
+        # 其他用户发起的签发，为当前用户单独保存一条记录
+        if result['user_id'] != user_id and not result.get('deferred'):
+            certificate_id = save_result(user_id, names, email, cf_email, result)
+
+    if result['success']:
+        return {
+            'success': True,
+            'message': '证书生成成功！',
+            'domains': names,
+            'coalesced': shared,
+            'certificate_id': certificate_id,
+            'private_key': result['private_key'],
+            'certificate': result['certificate'],
+            'ca_certificate': result.get('ca_certificate', '')
+        }
+
+    failure = {
+        'success': False,
+        'message': result['message']
+    }
+    if result.get('retry_after'):
+        failure['retry_after'] = result['retry_after']
+    return failure
+
+def schedule_certificate(user_id, domains, email, cf_email, cf_api_key, kind='interactive', **options):
+    """提交到公平调度器签发证书，返回结果为 issue_certificate() 返回值的Future
+
+    kind为interactive（页面上的单证书申请）或bulk（批量任务），options原样传给 issue_certificate()。
+    域名不合法时抛出ValueError，用户当天配额用尽时抛出 QuotaExceeded。
+    """
+    names = normalize_domains(domains)
+    return issuance_scheduler.submit(
+        user_id, cf_email,
+        lambda: issue_certificate(user_id, names, email, cf_email, cf_api_key, **options),
+        kind=kind,
+        cost=len(names)
+    )
+
+def save_result(user_id, names, email, cf_email, result):
+    """保存签发结果，返回证书记录ID；签发成功时在后台部署到该域名集合配置的部署目标"""
+    if result['success']:
+        certificate_id = save_certificate_record(
+            user_id=user_id,
+            domain=names[0],
+            san_domains=names,
+            email=email,
+            cf_email=cf_email,
+            status='success',
+            private_key=result['private_key'],
+            certificate=result['certificate'],
+            ca_certificate=result.get('ca_certificate', ''),
+            timings=result.get('timings')
+        )
+        deployer.deploy_async(certificate_id)
+        return certificate_id
+
+    return save_certificate_record(
+        user_id=user_id,
+        domain=names[0],
+        san_domains=names,
+        email=email,
+        cf_email=cf_email,
+        status='failed',
+        error_message=result['message'],
+        timings=result.get('timings')
+    )
+
+# 签发进行中每隔ORDER_HEARTBEAT_INTERVAL秒刷新订单的updated_at：DNS传播等待和最终确认
+# （90秒期限加上每次最长120秒的ACME请求）期间没有新的检查点，没有心跳时可能超过ORDER_STALE_SECONDS，
+# 被其他进程当作中断订单并发恢复。ORDER_STALE_SECONDS应为心跳间隔的数倍。
+ORDER_HEARTBEAT_INTERVAL = 30
+
+@contextmanager
+def order_heartbeat(order_id, interval=ORDER_HEARTBEAT_INTERVAL):
+    """在with块执行期间定期刷新订单的updated_at"""
+    stopped = threading.Event()
+    
+    def beat():
+        while not stopped.wait(interval):
+            try:
+                touch_issuance_order(order_id)
+            except Exception as e:
+                print(f"刷新签发订单 #{order_id} 心跳失败: {e}")
+    
+    thread = threading.Thread(target=beat, name=f'order-heartbeat-{order_id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+def run_order(generator, order_id, names, email, state=None):
+    """执行（或继续）签发订单，每个阶段完成后写入检查点，返回 (result, state)
+
+    优先复用该ACME邮箱已注册的账户，新注册的账户保存后供之后的签发复用；
+    订单提交到CA后记录订单结果，用于限流统计。执行期间定期写入心跳。
+    """
+    state = state if state is not None else {}
+    if not state.get('account_uri'):
+        account = get_acme_account(email, generator.acme_directory_url)
+        if account:
+            state.update(account)
+    known_account = state.get('account_uri')
+    
+    def on_checkpoint(current):
+        nonlocal known_account
+        if current.get('account_uri') and current['account_uri'] != known_account:
+            known_account = current['account_uri']
+            save_acme_account(email, generator.acme_directory_url, current['account_key'], current['account_uri'])
+        save_issuance_order_state(order_id, current)
+    
+    with order_heartbeat(order_id):
+        result = generator.generate_certificate(names, email, state=state, on_checkpoint=on_checkpoint)
+    if state.get('order_uri'):
+        record_acme_order(email, names, 'success' if result['success'] else 'failed')
+    return result, state
+
+def finish_order(order_id, state, result):
+    """结果已保存为证书记录后结束订单"""
+    if result['success']:
+        finish_issuance_order(order_id, 'completed', state, certificate_id=result['certificate_id'])
+    else:
+        finish_issuance_order(order_id, 'failed', state, certificate_id=result['certificate_id'],
+                              error_message=result['message'])
+
+def resume_order(order, max_attempts):
+    """继续一个中断的签发订单：从最后完成的阶段继续，已签发的证书直接保存"""
+    names = order['domains']
+    state = order['state']
+    
+    if order['attempts'] > max_attempts:
+        print(f"签发订单 #{order['id']} 已恢复 {order['attempts'] - 1} 次仍未完成，放弃: {names[0]}")
+        generator = SSLCertificateGenerator(order['cf_email'], order['cf_api_key'])
+        generator.cleanup_dns_records(state)
+        result = {'success': False, 'message': '证书生成失败: 签发多次中断，已放弃'}
+        result['certificate_id'] = save_result(order['user_id'], names, order['email'], order['cf_email'], result)
+        finish_order(order['id'], state, result)
+        return result
+    
+    print(f"恢复签发订单 #{order['id']}（阶段 {order['phase']}）: {names[0]}")
+    generator = SSLCertificateGenerator(order['cf_email'], order['cf_api_key'])
+    result, state = run_order(generator, order['id'], names, order['email'], state=state)
+    if result.get('retry_after'):
+        admission_scheduler.block(names, order['email'], result['retry_after'])
+    result['certificate_id'] = save_result(order['user_id'], names, order['email'], order['cf_email'], result)
+    finish_order(order['id'], state, result)
+    return result
+
+def sweep_orphaned_records():
+    """清理已结束订单中残留的DNS验证记录，返回清理完成的订单数"""
+    swept = 0
+    for order in get_orders_with_orphaned_records():
+        generator = SSLCertificateGenerator(order['cf_email'], order['cf_api_key'])
+        state = order['state']
+        if generator.cleanup_dns_records(state):
+            swept += 1
+        save_orphaned_records_state(order['id'], state)
+    return swept
+
+def recover_issuance_orders(stale_seconds=300, max_attempts=3):
+    """恢复中断的签发订单
+
+    超过 stale_seconds 秒没有写入检查点的进行中订单视为所在进程已退出：
+    从最后完成的阶段继续签发（已签发的直接保存结果），同时清理残留的DNS验证记录。
+    多个进程同时执行时每个订单只会被其中一个认领。
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=stale_seconds)
+    orders = claim_stale_issuance_orders(stale_before)
+    
+    for order in orders:
+        try:
+            resume_order(order, max_attempts)
+        except Exception as e:
+            # 恢复出错时订单保持pending状态，下次恢复时再试
+            print(f"恢复签发订单 #{order['id']} 失败: {e}")
+    
+    swept = sweep_orphaned_records()
+    if orders or swept:
+        print(f"签发订单恢复完成: 恢复 {len(orders)} 个订单，清理 {swept} 个订单的残留DNS记录")
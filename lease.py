@@ -0,0 +1,89 @@
+# 数据库租约（leader选举）
+# 多个副本共用同一个数据库时，同名租约在同一时刻只由一个进程持有。持有者由心跳线程定期续约，
+# 进程崩溃后租约在ttl秒内过期并由其他进程接管，正常退出时主动释放以便立即交接。
+# 每次更换持有者时fencing token递增，以token认领执行周期，已被接管的旧持有者无法再执行。
+
+import atexit
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from database import acquire_lease, release_lease, claim_lease_slot
+
+def default_holder():
+    """租约持有者标识：主机名、进程号和随机后缀"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class Lease:
+    """一个命名租约在当前进程中的句柄"""
+
+    def __init__(self, name, ttl=30, holder=None):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or default_holder()
+        self.token = None
+        self._deadline = 0.0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def held(self):
+        """当前是否持有租约（按本地单调时钟判断，续约失败时最迟在ttl后视为失去租约）"""
+        with self._lock:
+            return self.token is not None and time.monotonic() < self._deadline
+
+    def renew(self):
+        """获取或续约租约，返回是否持有"""
+        # 以发起请求前的时间计算本地期限，早于数据库中的过期时间
+        started = time.monotonic()
+        try:
+            token = acquire_lease(self.name, self.holder, self.ttl)
+        except sqlite3.Error as e:
+            # 数据库暂时不可用时保留已有的租约，直到本地期限到达
+            print(f"租约 {self.name} 续约失败: {e}")
+            return self.held
+
+        with self._lock:
+            if token is None:
+                if self.token is not None:
+                    print(f"租约 {self.name} 已被其他进程接管")
+                self.token = None
+            else:
+                if token != self.token:
+                    print(f"获得租约 {self.name}（持有者 {self.holder}，fencing token {token}）")
+                self.token = token
+                self._deadline = started + self.ttl
+        return self.held
+
+    def claim_slot(self, slot):
+        """以当前token认领执行周期，未持有租约或该周期已执行过时返回False"""
+        with self._lock:
+            token = self.token
+        if token is None or not self.held:
+            return False
+        return claim_lease_slot(self.name, self.holder, token, slot)
+
+    def start_heartbeat(self):
+        """启动心跳线程，每ttl/3秒获取或续约一次；进程退出时自动释放租约"""
+        def loop():
+            while not self._stopped.wait(self.ttl / 3):
+                self.renew()
+
+        self.renew()
+        self._thread = threading.Thread(target=loop, name=f'lease-{self.name}', daemon=True)
+        self._thread.start()
+        atexit.register(self.release)
+
+    def release(self):
+        """停止心跳并释放租约"""
+        self._stopped.set()
+        with self._lock:
+            token, self.token = self.token, None
+        if token is not None:
+            try:
+                release_lease(self.name, self.holder, token)
+            except sqlite3.Error as e:
+                print(f"租约 {self.name} 释放失败: {e}")
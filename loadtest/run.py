@@ -0,0 +1,217 @@
+# HTTP压测
+# 多个虚拟用户并发执行压测场景：以随机的压测用户登录，然后按权重随机访问历史记录、邮件记录分页、
+# 证书详情和邮件统计接口；结束后按接口输出请求数、错误数、每秒请求数和p50/p95/p99延迟。
+#
+# --login-flood N 另外启动N个只反复登录的客户端，模拟登录请求突增，观察登录吞吐量（login行）以及
+# 密码哈希对其他页面延迟的影响（可调整应用的PASSWORD_HASH_WORKERS对比）。
+#
+# 先用 loadtest/seed.py 生成数据，在数据库所在目录启动应用（BACKGROUND_TASKS_ENABLED=false），然后：
+# python loadtest/run.py --base-url http://127.0.0.1:5000 --users 10000 --concurrency 20 --duration 60
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+import requests
+
+DEFAULT_PASSWORD = 'loadtest-password'
+EMAIL_DOMAIN = 'loadtest.example'
+
+# 登录后每个会话访问的页面及权重
+SCENARIOS = ('history', 'email_logs', 'certificate_detail', 'email_stats')
+DEFAULT_MIX = 'history=3,email_logs=4,certificate_detail=2,email_stats=3'
+
+CERTIFICATE_LINK = re.compile(r'/certificate/(\d+)')
+
+def parse_mix(value):
+    """解析形如 "history=3,email_logs=4" 的场景权重"""
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f'未知的压测场景: {name}，可选: {", ".join(SCENARIOS)}')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def percentile(sorted_values, p):
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class Stats:
+    """按接口汇总的请求耗时（秒）和错误数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, latency, ok):
+        with self._lock:
+            self.latencies[name].append(latency)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, elapsed):
+        rows = []
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            rows.append({
+                'endpoint': name,
+                'requests': len(values),
+                'errors': self.errors[name],
+                'rps': round(len(values) / elapsed, 2),
+                'p50_ms': round(percentile(values, 50) * 1000, 1),
+                'p95_ms': round(percentile(values, 95) * 1000, 1),
+                'p99_ms': round(percentile(values, 99) * 1000, 1),
+                'max_ms': round(values[-1] * 1000, 1)
+            })
+        return rows
+
+class VirtualUser:
+    """一个虚拟用户的会话"""
+
+    def __init__(self, options, stats, rng):
+        self.options = options
+        self.stats = stats
+        self.rng = rng
+        self.session = requests.Session()
+        self.certificate_ids = []
+        self.email_pages = 1
+        # 条件请求模式下保存每个地址的ETag，模拟浏览器缓存
+        self.etags = {}
+
+    def request(self, name, method, path, ok_statuses=(200, 304), **kwargs):
+        url = self.options.base_url.rstrip('/') + path
+        headers = kwargs.pop('headers', {})
+        if self.options.conditional and method == 'GET' and path in self.etags:
+            headers['If-None-Match'] = self.etags[path]
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, headers=headers, timeout=self.options.timeout,
+                                            allow_redirects=False, **kwargs)
+        except requests.RequestException:
+            self.stats.record(name, time.perf_counter() - started, False)
+            return None
+        latency = time.perf_counter() - started
+
+        ok = response.status_code in ok_statuses
+        self.stats.record(name, latency, ok)
+        if ok and response.headers.get('ETag'):
+            self.etags[path] = response.headers['ETag']
+        return response
+
+    def login(self):
+        self.session.cookies.clear()
+        self.etags.clear()
+        index = self.rng.randrange(self.options.first_user, self.options.first_user + self.options.users)
+        # 登录成功时重定向到首页，失败时返回登录页
+        response = self.request('login', 'POST', '/auth/login', ok_statuses=(302,), data={
+            'email': f'user{index}@{EMAIL_DOMAIN}',
+            'password': self.options.password
+        })
+        self.certificate_ids = []
+        self.email_pages = 1
+        return response is not None and response.status_code == 302
+
+    def history(self):
+        response = self.request('history', 'GET', '/history')
+        if response is not None and response.status_code == 200:
+            self.certificate_ids = sorted(set(CERTIFICATE_LINK.findall(response.text)))
+
+    def email_logs(self):
+        page = self.rng.randint(1, self.email_pages)
+        response = self.request('email_logs', 'GET', f'/email-logs?page={page}')
+        # 按"下一页"链接逐步扩大可访问的页码范围，模拟用户向后翻页
+        if response is not None and response.status_code == 200 and f'page={page + 1}' in response.text:
+            self.email_pages = max(self.email_pages, page + 1)
+
+    def certificate_detail(self):
+        if not self.certificate_ids:
+            self.history()
+            return
+        self.request('certificate_detail', 'GET', f'/certificate/{self.rng.choice(self.certificate_ids)}')
+
+    def email_stats(self):
+        self.request('email_stats', 'GET', '/api/email-stats')
+
+    def flood_logins(self, deadline):
+        """只反复登录，不访问其他页面"""
+        while time.monotonic() < deadline:
+            self.login()
+
+    def run(self, deadline, mix):
+        names, weights = zip(*mix.items())
+        while time.monotonic() < deadline:
+            if not self.login():
+                time.sleep(0.5)
+                continue
+            for _ in range(self.options.requests_per_session):
+                if time.monotonic() >= deadline:
+                    break
+                getattr(self, self.rng.choices(names, weights=weights)[0])()
+                if self.options.think_time:
+                    time.sleep(self.rng.uniform(0, self.options.think_time * 2))
+
+def print_report(rows, elapsed):
+    print(f"\n压测时长 {elapsed:.1f} 秒")
+    print(f"{'接口':<20}{'请求数':>10}{'错误':>8}{'req/s':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for row in rows:
+        print(f"{row['endpoint']:<20}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description='SSL证书管理系统HTTP压测')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000', help='应用地址')
+    parser.add_argument('--users', type=int, default=10000, help='seed.py生成的用户数')
+    parser.add_argument('--first-user', type=int, default=1, help='第一个压测用户的序号（seed.py输出）')
+    parser.add_argument('--password', default=DEFAULT_PASSWORD, help='压测用户的密码')
+    parser.add_argument('--concurrency', type=int, default=20, help='并发的虚拟用户数')
+    parser.add_argument('--duration', type=float, default=60, help='压测时长（秒）')
+    parser.add_argument('--requests-per-session', type=int, default=20, help='每次登录后访问的页面数')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'场景权重，默认 {DEFAULT_MIX}')
+    parser.add_argument('--login-flood', type=int, default=0, help='另外只反复登录的并发客户端数')
+    parser.add_argument('--think-time', type=float, default=0, help='两次请求之间的平均间隔（秒）')
+    parser.add_argument('--conditional', action='store_true', help='携带上次响应的ETag发送条件请求（模拟浏览器缓存）')
+    parser.add_argument('--timeout', type=float, default=30, help='单个请求的超时时间（秒）')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子')
+    parser.add_argument('--json', help='同时把结果写入JSON文件，便于比较不同版本')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    stats = Stats()
+    rng = random.Random(args.seed)
+    deadline = time.monotonic() + args.duration
+
+    threads = []
+    started = time.perf_counter()
+    for index in range(args.concurrency):
+        user = VirtualUser(args, stats, random.Random(rng.random()))
+        thread = threading.Thread(target=user.run, args=(deadline, mix), name=f'vu-{index}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    for index in range(args.login_flood):
+        user = VirtualUser(args, stats, random.Random(rng.random()))
+        thread = threading.Thread(target=user.flood_logins, args=(deadline,), name=f'login-{index}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    rows = stats.report(elapsed)
+    print_report(rows, elapsed)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'duration': round(elapsed, 2), 'options': vars(args), 'endpoints': rows},
+                      f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
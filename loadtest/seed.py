@@ -0,0 +1,188 @@
+# 压测数据生成
+# 在指定目录的 ssl_certificates.db（或在同一进程中 storage 当前的存储后端）中批量写入用户、证书记录和邮件记录，
+# 用于压测大数据量下的页面和查询性能。
+# 数据由 --seed 决定，相同参数生成相同的数据。
+#
+# 用法：python loadtest/seed.py --dir /tmp/loadtest --users 10000 --certificates 50000 --email-logs 1000000
+# 所有用户已验证邮箱，邮箱为 user<序号>@loadtest.example，密码为 --password 指定的值
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from werkzeug.security import generate_password_hash
+
+DEFAULT_PASSWORD = 'loadtest-password'
+EMAIL_DOMAIN = 'loadtest.example'
+
+EMAIL_TYPES = [('general', 70), ('certificate', 20), ('verification', 10)]
+EMAIL_STATUSES = [('sent', 90), ('failed', 7), ('pending', 3)]
+CERTIFICATE_STATUSES = [('success', 85), ('failed', 15)]
+PHASES = ['account', 'order', 'dns_record', 'propagation', 'validation', 'finalize']
+
+def user_email(index):
+    return f"user{index}@{EMAIL_DOMAIN}"
+
+def weighted_choice(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights=weights)[0]
+
+def sample_certificate():
+    """所有证书记录共用的自签名证书和私钥（只用于页面展示）"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, f'loadtest.{EMAIL_DOMAIN}')])
+    now = datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=90))
+        .sign(key, hashes.SHA256())
+    )
+    private_key_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode('utf-8')
+    return private_key_pem, certificate.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+def timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+def insert_batches(conn, sql, rows, total, label, batch_size=10000):
+    """分批写入，每批提交一次并打印进度"""
+    cursor = conn.cursor()
+    batch = []
+    written = 0
+    started = time.perf_counter()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            conn.commit()
+            written += len(batch)
+            batch = []
+            print(f"  {label}: {written}/{total}", end='\r', flush=True)
+    if batch:
+        cursor.executemany(sql, batch)
+        conn.commit()
+        written += len(batch)
+    print(f"  {label}: {written}/{total}，耗时 {time.perf_counter() - started:.1f} 秒")
+
+def seed(users, certificates, email_logs, days=365, shared_email_ratio=0.001, content_size=1000,
+         password=DEFAULT_PASSWORD, seed_value=42):
+    """在当前的存储后端（默认为当前目录的数据库）中写入压测数据"""
+    from database import init_db
+    from storage import storage
+    init_db()
+
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    conn = storage.connect()
+    # 生成数据时不需要每次提交都落盘
+    conn.execute('PRAGMA synchronous = OFF')
+
+    cursor = conn.cursor()
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM users')
+    first_user_id = cursor.fetchone()[0] + 1
+
+    # 所有用户使用同一个密码哈希，避免逐个计算哈希
+    password_hash = generate_password_hash(password)
+    print(f"写入用户（从 {user_email(first_user_id)} 开始）")
+    insert_batches(conn, '''
+        INSERT INTO users (id, email, password_hash, is_verified, created_at)
+        VALUES (?, ?, ?, TRUE, ?)
+    ''', (
+        (user_id, user_email(user_id), password_hash, timestamp(now - timedelta(days=days)))
+        for user_id in range(first_user_id, first_user_id + users)
+    ), users, 'users')
+    user_ids = range(first_user_id, first_user_id + users)
+
+    private_key, certificate = sample_certificate()
+
+    def certificate_rows():
+        for index in range(certificates):
+            user_id = rng.choice(user_ids)
+            domain = f"site{index}.{EMAIL_DOMAIN}"
+            names = sorted([domain, f"*.{domain}"]) if rng.random() < 0.3 else [domain]
+            created_at = now - timedelta(seconds=rng.randrange(days * 86400))
+            status = weighted_choice(rng, CERTIFICATE_STATUSES)
+            timings = json.dumps([
+                {'phase': phase, 'domain': None, 'duration': round(rng.uniform(0.1, 20), 2), 'status': 'ok'}
+                for phase in PHASES
+            ])
+            if status == 'success':
+                yield (user_id, names[0], f'acme@{EMAIL_DOMAIN}', f'cf@{EMAIL_DOMAIN}', status,
+                       private_key, certificate, certificate, None, timings,
+                       timestamp(created_at + timedelta(days=90)), json.dumps(names), timestamp(created_at))
+            else:
+                yield (user_id, names[0], f'acme@{EMAIL_DOMAIN}', f'cf@{EMAIL_DOMAIN}', status,
+                       None, None, None, 'DNS validation failed', timings,
+                       None, json.dumps(names), timestamp(created_at))
+
+    print("写入证书记录")
+    insert_batches(conn, '''
+        INSERT INTO certificates (user_id, domain, email, cf_email, status, private_key, certificate,
+                                  ca_certificate, error_message, timings, not_after, san_domains, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', certificate_rows(), certificates, 'certificates')
+
+    filler = ('<p>' + 'loadtest ' * (content_size // 9) + '</p>')[:content_size]
+
+    def email_log_rows():
+        for index in range(email_logs):
+            # 少量不属于任何用户的邮件记录，出现在每个用户的邮件记录页面中
+            user_id = None if rng.random() < shared_email_ratio else rng.choice(user_ids)
+            status = weighted_choice(rng, EMAIL_STATUSES)
+            sent_at = now - timedelta(seconds=rng.randrange(days * 86400))
+            yield (user_id, user_email(user_id) if user_id else f'admin@{EMAIL_DOMAIN}',
+                   f'压测邮件 #{index}', f'<html><body><h1>#{index}</h1>{filler}</body></html>',
+                   weighted_choice(rng, EMAIL_TYPES), status,
+                   'SMTP timeout' if status == 'failed' else None, timestamp(sent_at))
+
+    print("写入邮件记录")
+    insert_batches(conn, '''
+        INSERT INTO email_logs (user_id, recipient_email, subject, content, email_type, status, error_message, sent_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', email_log_rows(), email_logs, 'email_logs')
+
+    conn.execute('ANALYZE')
+    size = conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+    conn.close()
+    print(f"完成：用户 {users}，证书记录 {certificates}，邮件记录 {email_logs}，"
+          f"数据库大小 {size / 1024 / 1024:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='生成压测数据')
+    parser.add_argument('--dir', default='.', help='数据库所在目录（压测时应用也从该目录启动），默认为当前目录')
+    parser.add_argument('--users', type=int, default=10000, help='用户数')
+    parser.add_argument('--certificates', type=int, default=50000, help='证书记录数')
+    parser.add_argument('--email-logs', type=int, default=1000000, help='邮件记录数')
+    parser.add_argument('--days', type=int, default=365, help='记录时间分布在最近多少天内')
+    parser.add_argument('--shared-email-ratio', type=float, default=0.001, help='不属于任何用户的邮件记录比例')
+    parser.add_argument('--content-size', type=int, default=1000, help='邮件HTML内容的大约字节数')
+    parser.add_argument('--password', default=DEFAULT_PASSWORD, help='所有压测用户的密码')
+    parser.add_argument('--seed', type=int, default=42, help='随机数种子')
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    os.chdir(args.dir)
+    seed(args.users, args.certificates, args.email_logs, days=args.days,
+         shared_email_ratio=args.shared_email_ratio, content_size=args.content_size,
+         password=args.password, seed_value=args.seed)
+
+if __name__ == '__main__':
+    main()
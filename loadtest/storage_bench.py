@@ -0,0 +1,110 @@
+# 存储后端压测
+# 对每个 --url 指定的存储后端（DATABASE_URL格式）分别用 seed.py 写入相同的数据，
+# 再以相同的随机序列在进程内直接调用 database.py 的函数（历史记录、域名搜索、证书详情、邮件记录、写入邮件记录），
+# 按操作输出次数、每秒操作数和p50/p95/p99延迟，用于比较不同后端。SQLite文件后端应指向一个不存在的新文件。
+#
+# python loadtest/storage_bench.py --url memory:// --url sqlite:////tmp/storage-bench/ssl_certificates.db \
+#     --users 200 --certificates 20000 --email-logs 100000 --concurrency 4 --operations 500
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import seed
+from run import Stats
+
+OPERATIONS = ('history', 'search', 'certificate_detail', 'email_logs', 'log_email')
+
+def run_workload(user_ids, operations, concurrency, rng):
+    """concurrency个线程各执行operations次随机操作，返回按操作汇总的延迟"""
+    from database import (
+        get_user_certificates, search_user_certificates, get_certificate_by_id,
+        get_user_email_logs, log_email
+    )
+
+    stats = Stats()
+
+    def worker(worker_rng):
+        certificate_ids = {}
+        for _ in range(operations):
+            user_id = worker_rng.choice(user_ids)
+            name = worker_rng.choice(OPERATIONS)
+            started = time.perf_counter()
+            if name == 'history':
+                certificate_ids[user_id] = [c['id'] for c in get_user_certificates(user_id)]
+            elif name == 'search':
+                search_user_certificates(user_id, query=f'site{worker_rng.randrange(1000)}')
+            elif name == 'certificate_detail':
+                if user_id not in certificate_ids:
+                    certificate_ids[user_id] = [c['id'] for c in get_user_certificates(user_id)]
+                    name = 'history'
+                elif certificate_ids[user_id]:
+                    get_certificate_by_id(worker_rng.choice(certificate_ids[user_id]), user_id)
+            elif name == 'email_logs':
+                get_user_email_logs(user_id)
+            else:
+                log_email(user_id, f'user{user_id}@loadtest.example', '压测邮件', '<p>storage bench</p>',
+                          'general', 'sent')
+            stats.record(name, time.perf_counter() - started, True)
+
+    threads = [
+        threading.Thread(target=worker, args=(random.Random(rng.random()),), daemon=True)
+        for _ in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return elapsed, stats.report(elapsed)
+
+def bench(url, args):
+    from storage import storage
+    print(f"\n== {url}")
+    storage.configure(url)
+    seed(args.users, args.certificates, args.email_logs, seed_value=args.seed)
+
+    conn = storage.connect()
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    conn.close()
+
+    elapsed, rows = run_workload(user_ids, args.operations, args.concurrency, random.Random(args.seed))
+    print(f"{'操作':<20}{'次数':>10}{'ops/s':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for row in rows:
+        print(f"{row['endpoint']:<20}{row['requests']:>10}{row['rps']:>10}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    total = sum(row['requests'] for row in rows)
+    print(f"共 {total} 次操作，耗时 {elapsed:.1f} 秒，{total / elapsed:.1f} ops/s")
+    return {'url': url, 'duration': round(elapsed, 2), 'operations': rows}
+
+def main():
+    parser = argparse.ArgumentParser(description='存储后端压测')
+    parser.add_argument('--url', action='append', required=True, help='存储后端地址（DATABASE_URL格式），可指定多次')
+    parser.add_argument('--users', type=int, default=200, help='用户数')
+    parser.add_argument('--certificates', type=int, default=20000, help='证书记录数')
+    parser.add_argument('--email-logs', type=int, default=100000, help='邮件记录数')
+    parser.add_argument('--concurrency', type=int, default=4, help='并发线程数')
+    parser.add_argument('--operations', type=int, default=500, help='每个线程执行的操作数')
+    parser.add_argument('--seed', type=int, default=42, help='随机数种子')
+    parser.add_argument('--json', help='同时把结果写入JSON文件')
+    args = parser.parse_args()
+
+    for url in args.url:
+        if url.startswith('sqlite:///'):
+            directory = os.path.dirname(url[len('sqlite:///'):])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+    results = [bench(url, args) for url in args.url]
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'options': vars(args), 'backends': results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
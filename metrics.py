@@ -0,0 +1,210 @@
+# 监控指标模块
+# 记录证书签发各阶段耗时、Cloudflare/ACME接口调用情况、证书部署、密码哈希、邮件发送延迟和请求的数据库访问，
+# 并以Prometheus文本格式通过 /metrics 导出
+
+import time
+import json
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# 证书签发耗时分布（秒），覆盖DNS传播等待等长耗时阶段
+ISSUANCE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+
+ISSUANCE_PHASE_SECONDS = Histogram(
+    'ssl_issuance_phase_duration_seconds',
+    '证书签发各阶段耗时',
+    ['phase'],
+    buckets=ISSUANCE_BUCKETS
+)
+
+ISSUANCE_SECONDS = Histogram(
+    'ssl_issuance_duration_seconds',
+    '证书签发总耗时',
+    ['status'],
+    buckets=ISSUANCE_BUCKETS
+)
+
+ISSUANCE_TOTAL = Counter(
+    'ssl_issuance_total',
+    '证书签发次数',
+    ['status']
+)
+
+CLOUDFLARE_REQUESTS = Counter(
+    'cloudflare_api_requests_total',
+    'Cloudflare API调用次数',
+    ['operation']
+)
+
+CLOUDFLARE_ERRORS = Counter(
+    'cloudflare_api_errors_total',
+    'Cloudflare API调用失败次数',
+    ['operation']
+)
+
+ACME_REQUESTS = Counter(
+    'acme_requests_total',
+    'ACME接口调用次数',
+    ['operation']
+)
+
+ACME_ERRORS = Counter(
+    'acme_errors_total',
+    'ACME接口调用失败次数',
+    ['operation']
+)
+
+ADMISSION_DEFERRED = Counter(
+    'acme_admission_deferred_total',
+    '因预计触发CA限流而被推迟的申请次数',
+    ['limit']
+)
+
+ISSUANCE_QUEUE_DEPTH = Gauge(
+    'issuance_queue_depth',
+    '按任务类型统计的排队中的签发任务数',
+    ['kind']
+)
+
+ISSUANCE_RUNNING = Gauge(
+    'issuance_running',
+    '按任务类型统计的执行中的签发任务数',
+    ['kind']
+)
+
+ISSUANCE_QUEUE_WAIT_SECONDS = Histogram(
+    'issuance_queue_wait_seconds',
+    '签发任务排队等待时间',
+    ['kind'],
+    buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+
+DEPLOYMENT_TOTAL = Counter(
+    'certificate_deployments_total',
+    '证书部署次数（每个目标一次，含重试后的最终结果）',
+    ['kind', 'status']
+)
+
+DEPLOYMENT_SECONDS = Histogram(
+    'certificate_deployment_duration_seconds',
+    '证书部署到单个目标的耗时（含重试）',
+    ['kind'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+PASSWORD_HASH_SECONDS = Histogram(
+    'password_hash_duration_seconds',
+    '密码哈希计算和校验耗时',
+    ['operation'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+
+PASSWORD_HASH_WAIT_SECONDS = Histogram(
+    'password_hash_queue_wait_seconds',
+    '密码哈希排队等待时间',
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+)
+
+PASSWORD_HASH_REJECTED = Counter(
+    'password_hash_rejected_total',
+    '排队超时被拒绝的密码哈希请求数',
+    ['operation']
+)
+
+EMAIL_SEND_SECONDS = Histogram(
+    'email_send_duration_seconds',
+    '邮件发送耗时（含重试）',
+    ['email_type', 'status'],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+)
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    '请求处理耗时',
+    ['endpoint'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries',
+    '每个请求执行的数据库查询数',
+    ['endpoint'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200)
+)
+
+REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_duration_seconds',
+    '每个请求的数据库查询总耗时',
+    ['endpoint'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+@contextmanager
+def track_call(requests_counter, errors_counter, operation):
+    """统计一次外部接口调用，调用抛出异常时同时计入错误次数"""
+    requests_counter.labels(operation=operation).inc()
+    try:
+        yield
+    except Exception:
+        errors_counter.labels(operation=operation).inc()
+        raise
+
+def track_cloudflare(operation):
+    """统计一次Cloudflare API调用"""
+    return track_call(CLOUDFLARE_REQUESTS, CLOUDFLARE_ERRORS, operation)
+
+def track_acme(operation):
+    """统计一次ACME接口调用"""
+    return track_call(ACME_REQUESTS, ACME_ERRORS, operation)
+
+class PhaseTimer:
+    """记录一次证书签发中各阶段的耗时
+
+    同一阶段可以出现多次（例如每个域名各做一次Zone查询），
+    spans 中逐次记录，结束时按阶段汇总后写入直方图。
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name, **labels):
+        """计时一个阶段，异常会被标记在记录中并继续向上抛出"""
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            span = {
+                'phase': name,
+                'offset': round(start - self._started, 3),
+                'duration': round(time.perf_counter() - start, 3),
+                'status': status
+            }
+            span.update(labels)
+            self.spans.append(span)
+
+    def totals(self):
+        """按阶段汇总耗时"""
+        totals = {}
+        for span in self.spans:
+            totals[span['phase']] = totals.get(span['phase'], 0) + span['duration']
+        return totals
+
+    def finish(self, status):
+        """签发结束时调用，导出各阶段及总耗时"""
+        for phase, duration in self.totals().items():
+            ISSUANCE_PHASE_SECONDS.labels(phase=phase).observe(duration)
+        ISSUANCE_SECONDS.labels(status=status).observe(time.perf_counter() - self._started)
+        ISSUANCE_TOTAL.labels(status=status).inc()
+
+    def to_json(self):
+        return json.dumps(self.spans)
+
+def render_metrics():
+    """生成Prometheus文本格式的指标数据"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,226 @@
+# 证书OCSP状态检查
+# 从证书的AIA扩展中读取OCSP响应者地址，向响应者查询吊销状态并校验签名，
+# 响应缓存到nextUpdate，由后台任务在有效期过半时刷新；同一响应者的请求复用HTTP连接并限制并发数。
+# 缓存的DER响应可直接用于边缘服务器的OCSP Stapling（/certificate/<id>/ocsp.der）。
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import AuthorityInformationAccessOID, ExtendedKeyUsageOID
+from cert_utils import load_certificate_chain
+from database import get_certificates_due_for_ocsp, save_ocsp_response, save_ocsp_error
+
+# 响应没有nextUpdate时的缓存时间
+DEFAULT_TTL = timedelta(hours=1)
+# 查询失败后的重试间隔
+ERROR_RETRY = timedelta(minutes=15)
+# 两次刷新之间的最短间隔，避免有效期很短的响应被频繁查询
+MIN_REFRESH = timedelta(minutes=5)
+# 允许的时钟偏差
+CLOCK_SKEW = timedelta(minutes=5)
+
+REVOCATION_STATUS = {
+    ocsp.OCSPCertStatus.GOOD: 'good',
+    ocsp.OCSPCertStatus.REVOKED: 'revoked',
+    ocsp.OCSPCertStatus.UNKNOWN: 'unknown'
+}
+
+class OCSPError(Exception):
+    """OCSP查询失败或响应无效"""
+
+def ocsp_responder_url(certificate):
+    """证书AIA扩展中的OCSP响应者地址，没有时返回None"""
+    try:
+        aia = certificate.extensions.get_extension_for_class(x509.AuthorityInformationAccess)
+    except x509.ExtensionNotFound:
+        return None
+    for description in aia.value:
+        if description.access_method == AuthorityInformationAccessOID.OCSP:
+            return description.access_location.value
+    return None
+
+def certificate_and_issuer(fullchain_pem, ca_certificate_pem=None):
+    """从证书链中取出服务器证书和签发者证书，找不到签发者时签发者为None"""
+    chain = load_certificate_chain(fullchain_pem)
+    if not chain:
+        raise OCSPError('证书内容为空')
+    if len(chain) < 2 and ca_certificate_pem:
+        chain += load_certificate_chain(ca_certificate_pem)
+    certificate = chain[0]
+    issuer = next((cert for cert in chain[1:] if cert.subject == certificate.issuer), None)
+    return certificate, issuer
+
+def build_request(certificate, issuer):
+    """构造DER编码的OCSP请求（SHA1证书标识，各CA的响应者均支持）"""
+    builder = ocsp.OCSPRequestBuilder().add_certificate(certificate, issuer, hashes.SHA1())
+    return builder.build().public_bytes(serialization.Encoding.DER)
+
+def verify_signature(public_key, signature, data, hash_algorithm):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, data, padding.PKCS1v15(), hash_algorithm)
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        public_key.verify(signature, data, ec.ECDSA(hash_algorithm))
+    else:
+        public_key.verify(signature, data)
+
+def verify_response(response, request_der, certificate, issuer, now):
+    """校验OCSP响应：对应请求的证书、由签发者或其授权的响应者签名、在有效期内"""
+    if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+        raise OCSPError(f'响应者返回 {response.response_status.name}')
+
+    request = ocsp.load_der_ocsp_request(request_der)
+    if (response.serial_number != certificate.serial_number
+            or response.issuer_key_hash != request.issuer_key_hash
+            or response.issuer_name_hash != request.issuer_name_hash):
+        raise OCSPError('响应与查询的证书不匹配')
+
+    # 响应者可以是签发者本身，也可以是签发者授权的OCSP签名证书：
+    # 由签发者签发（名称和签名都匹配）、带OCSP签名用途、且在有效期内
+    signer = issuer
+    if response.certificates:
+        delegate = response.certificates[0]
+        if delegate.issuer != issuer.subject:
+            raise OCSPError('响应者证书不是由证书的签发者签发')
+        if not delegate.not_valid_before - CLOCK_SKEW <= now <= delegate.not_valid_after + CLOCK_SKEW:
+            raise OCSPError('响应者证书不在有效期内')
+        try:
+            verify_signature(issuer.public_key(), delegate.signature, delegate.tbs_certificate_bytes,
+                             delegate.signature_hash_algorithm)
+            usages = delegate.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value
+        except (InvalidSignature, x509.ExtensionNotFound):
+            raise OCSPError('响应者证书未经签发者授权')
+        if ExtendedKeyUsageOID.OCSP_SIGNING not in usages:
+            raise OCSPError('响应者证书未经签发者授权')
+        signer = delegate
+
+    try:
+        verify_signature(signer.public_key(), response.signature, response.tbs_response_bytes,
+                         response.signature_hash_algorithm)
+    except InvalidSignature:
+        raise OCSPError('响应签名无效')
+
+    if response.this_update > now + CLOCK_SKEW:
+        raise OCSPError('响应的thisUpdate晚于当前时间')
+    if response.next_update and response.next_update < now:
+        raise OCSPError('响应已过期')
+
+def refresh_time(this_update, next_update, now):
+    """在响应有效期过半时刷新，保证缓存的响应始终可以用于Stapling"""
+    if not next_update:
+        return now + DEFAULT_TTL
+    return max(this_update + (next_update - this_update) / 2, now + MIN_REFRESH)
+
+class OCSPClient:
+    """OCSP查询客户端：每个响应者一个HTTP会话复用连接，并限制对同一响应者的并发请求数"""
+
+    def __init__(self, max_workers=8, per_responder=4, timeout=10):
+        self.max_workers = max_workers
+        self.per_responder = per_responder
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._semaphores = {}
+
+    def _responder(self, url):
+        with self._lock:
+            if url not in self._sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.per_responder)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[url] = session
+                self._semaphores[url] = threading.BoundedSemaphore(self.per_responder)
+            return self._sessions[url], self._semaphores[url]
+
+    def fetch(self, url, request_der):
+        """向响应者发送OCSP请求，返回DER编码的响应"""
+        session, semaphore = self._responder(url)
+        with semaphore:
+            try:
+                response = session.post(url, data=request_der, timeout=self.timeout,
+                                        headers={'Content-Type': 'application/ocsp-request'})
+            except requests.RequestException as e:
+                raise OCSPError(f'请求响应者失败: {e}')
+        if response.status_code != 200:
+            raise OCSPError(f'响应者返回HTTP {response.status_code}')
+        return response.content
+
+    def check(self, record, now=None):
+        """查询一张证书的OCSP状态并保存，返回状态（good/revoked/unknown/unavailable/error）"""
+        now = now or datetime.utcnow()
+        responder_url = None
+        try:
+            certificate, issuer = certificate_and_issuer(record['certificate'], record.get('ca_certificate'))
+            responder_url = ocsp_responder_url(certificate)
+            if not responder_url:
+                # 证书不提供OCSP（如CA已停止OCSP服务），证书内容不会变化，无需再次检查
+                save_ocsp_response(record['id'], None, 'unavailable', None)
+                return 'unavailable'
+            if issuer is None:
+                raise OCSPError('证书链中缺少签发者证书')
+
+            request_der = build_request(certificate, issuer)
+            response_der = self.fetch(responder_url, request_der)
+            try:
+                response = ocsp.load_der_ocsp_response(response_der)
+            except ValueError:
+                raise OCSPError('无法解析OCSP响应')
+            verify_response(response, request_der, certificate, issuer, now)
+        except (OCSPError, ValueError, InvalidSignature, UnsupportedAlgorithm, requests.RequestException) as e:
+            # 单张证书的异常（包括签名算法不受支持等）记录为查询失败，不影响同一批的其他证书
+            message = str(e) or type(e).__name__
+            print(f"证书 {record['id']} OCSP查询失败: {message}")
+            save_ocsp_error(record['id'], responder_url, message, now + ERROR_RETRY)
+            return 'error'
+
+        status = REVOCATION_STATUS[response.certificate_status]
+        save_ocsp_response(
+            record['id'], responder_url, status,
+            refresh_time(response.this_update, response.next_update, now),
+            response=response_der,
+            this_update=response.this_update,
+            next_update=response.next_update,
+            revoked_at=response.revocation_time,
+            revocation_reason=response.revocation_reason.name if response.revocation_reason else None
+        )
+        if status == 'revoked':
+            print(f"证书 {record['id']} 已被吊销（{response.revocation_time}）")
+        return status
+
+    def refresh(self, records):
+        """并发查询一批证书，返回各状态的数量"""
+        report = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ocsp') as executor:
+            for status in executor.map(self.check, records):
+                report[status] = report.get(status, 0) + 1
+        return report
+
+def refresh_ocsp_responses(client, batch_size=500):
+    """刷新所有到期的OCSP缓存，返回各状态的数量"""
+    report = {}
+    while True:
+        records = get_certificates_due_for_ocsp(datetime.utcnow(), limit=batch_size)
+        if not records:
+            break
+        for status, count in client.refresh(records).items():
+            report[status] = report.get(status, 0) + count
+        if len(records) < batch_size:
+            break
+    if report:
+        print(f"OCSP状态刷新完成: {report}")
+    return report
+
+def refresh_from_config(config):
+    """按应用配置刷新OCSP缓存"""
+    client = OCSPClient(
+        max_workers=config.get('OCSP_MAX_WORKERS', 8),
+        per_responder=config.get('OCSP_PER_RESPONDER', 4),
+        timeout=config.get('OCSP_TIMEOUT', 10)
+    )
+    return refresh_ocsp_responses(client, batch_size=config.get('OCSP_BATCH_SIZE', 500))
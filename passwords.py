@@ -0,0 +1,86 @@
+# 密码哈希
+# 计算和校验密码哈希是CPU密集的操作（pbkdf2/scrypt），集中在这里执行并限制同时计算的数量：
+# 大量登录请求同时到达时超出上限的请求排队，排队超过queue_timeout秒直接拒绝，
+# 不会占满全部CPU而拖慢其他页面。哈希算法和参数可配置，
+# 登录成功时如果保存的哈希使用了旧的算法或参数，由调用方用新参数重新计算并保存。
+
+import threading
+import time
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from metrics import PASSWORD_HASH_SECONDS, PASSWORD_HASH_WAIT_SECONDS, PASSWORD_HASH_REJECTED
+
+DEFAULT_METHOD = f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}'
+
+class PasswordHashingBusy(Exception):
+    """同时计算的密码哈希已达上限，排队超时"""
+
+def normalize_method(method):
+    """把哈希算法配置补全为werkzeug保存在哈希中的形式，如 scrypt -> scrypt:32768:8:1"""
+    name, *args = method.strip().split(':')
+    if name == 'scrypt':
+        if not args:
+            args = ['32768', '8', '1']
+        if len(args) != 3 or not all(arg.isdigit() for arg in args):
+            raise ValueError(f'scrypt 参数应为 scrypt:n:r:p，当前为 {method}')
+        return f"scrypt:{':'.join(str(int(arg)) for arg in args)}"
+    if name == 'pbkdf2':
+        if len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+            raise ValueError(f'pbkdf2 参数应为 pbkdf2:hash_name:iterations，当前为 {method}')
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f'不支持的密码哈希算法: {method}，可选 pbkdf2 或 scrypt')
+
+def hash_method(password_hash):
+    """哈希中保存的算法和参数（$ 之前的部分），格式无法识别时返回None"""
+    if isinstance(password_hash, bytes):
+        password_hash = password_hash.decode('utf-8')
+    method, separator, _ = password_hash.partition('$')
+    return method if separator else None
+
+class PasswordHasher:
+    """限制并发的密码哈希执行器
+
+    - method: 新哈希使用的算法和参数（werkzeug格式，如 pbkdf2:sha256:600000、scrypt:32768:8:1）
+    - workers: 同时计算的哈希数上限，其余请求排队
+    - queue_timeout: 排队等待的最长秒数，超时抛出PasswordHashingBusy
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, queue_timeout=5):
+        self.configure(method, workers, queue_timeout)
+
+    def configure(self, method=DEFAULT_METHOD, workers=2, queue_timeout=5):
+        self.method = normalize_method(method)
+        self.workers = max(1, workers)
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(self.workers)
+
+    def _run(self, operation, func, *args):
+        slots = self._slots
+        queued = time.perf_counter()
+        if not slots.acquire(timeout=self.queue_timeout):
+            PASSWORD_HASH_REJECTED.labels(operation=operation).inc()
+            raise PasswordHashingBusy('当前请求较多，请稍后再试。')
+        started = time.perf_counter()
+        PASSWORD_HASH_WAIT_SECONDS.observe(started - queued)
+        try:
+            return func(*args)
+        finally:
+            slots.release()
+            PASSWORD_HASH_SECONDS.labels(operation=operation).observe(time.perf_counter() - started)
+
+    def hash(self, password):
+        """按当前配置计算密码哈希"""
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """校验密码，兼容以bytes保存的旧哈希"""
+        if isinstance(password_hash, bytes):
+            password_hash = password_hash.decode('utf-8')
+        return self._run('verify', check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """保存的哈希不是当前配置的算法和参数（或以bytes保存）时返回True"""
+        return isinstance(password_hash, bytes) or hash_method(password_hash) != self.method
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,157 @@
+# 请求级性能分析
+# 统计每个请求的耗时、打开的数据库连接数、执行的查询数和查询耗时（database.get_connection() 返回的连接上报），
+# 通过 Server-Timing 响应头和Prometheus指标导出；超过阈值的查询记录到慢查询日志。
+# 管理员请求带 X-Profile 头时对处理该请求的线程做采样分析，调用栈以flamegraph的折叠格式保存。
+
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import request
+from flask_login import current_user
+from metrics import REQUEST_SECONDS, REQUEST_DB_QUERIES, REQUEST_DB_SECONDS
+
+# 开启采样分析的请求头
+PROFILE_HEADER = 'X-Profile'
+
+class ProfilingSettings:
+    """性能分析参数，应用启动时由 init_profiling() 按配置设置"""
+
+    def __init__(self):
+        self.slow_query_seconds = 0.1
+        self.admin_emails = set()
+        self.profile_dir = 'profiles'
+        self.sample_interval = 0.005
+
+settings = ProfilingSettings()
+
+class RequestProfile:
+    """一个请求的耗时和数据库访问统计"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint or 'unknown'
+        self.started = time.perf_counter()
+        self.connections = 0
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.sampler = None
+
+# 当前请求的统计，请求之外（后台任务、签发工作线程）为None
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+def record_connection():
+    """打开数据库连接时调用"""
+    profile = _current_profile.get()
+    if profile:
+        profile.connections += 1
+
+def record_query_time(duration, statement=False):
+    """累计查询耗时，statement为True时表示执行了一条新的语句（读取结果的耗时也计入查询耗时）"""
+    profile = _current_profile.get()
+    if profile:
+        profile.query_seconds += duration
+        if statement:
+            profile.queries += 1
+
+def log_slow_query(sql, duration):
+    """查询（含读取结果）耗时超过阈值时记录慢查询日志，返回是否记录"""
+    if duration < settings.slow_query_seconds:
+        return False
+    profile = _current_profile.get()
+    source = profile.endpoint if profile else threading.current_thread().name
+    print(f"慢查询 {duration * 1000:.1f}ms [{source}]: {' '.join(sql.split())[:500]}")
+    return True
+
+def folded_stack(frame):
+    """调用栈的折叠格式（从外到内以分号分隔）"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class StackSampler:
+    """按固定间隔采样指定线程的调用栈"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[folded_stack(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.samples
+
+def write_folded_stacks(samples, endpoint):
+    """以 "调用栈 采样次数" 的格式写入文件（flamegraph.pl、speedscope可直接读取），返回文件名"""
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    name = f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}-{endpoint.replace('.', '-')}.folded"
+    with open(os.path.join(settings.profile_dir, name), 'w', encoding='utf-8') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    return name
+
+def is_admin():
+    return (current_user.is_authenticated
+            and current_user.email.lower() in settings.admin_emails)
+
+def init_profiling(app):
+    """按配置注册请求统计和采样分析的钩子"""
+    settings.slow_query_seconds = app.config.get('SLOW_QUERY_MS', 100) / 1000
+    settings.admin_emails = {email.strip().lower() for email in app.config.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+    settings.profile_dir = app.config.get('PROFILE_DIR', 'profiles')
+    settings.sample_interval = app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000
+
+    @app.before_request
+    def start_request_profile():
+        profile = RequestProfile(request.endpoint)
+        _current_profile.set(profile)
+        if request.headers.get(PROFILE_HEADER) and is_admin():
+            profile.sampler = StackSampler(threading.get_ident(), settings.sample_interval).start()
+
+    @app.after_request
+    def finish_request_profile(response):
+        profile = _current_profile.get()
+        if profile is None:
+            return response
+
+        elapsed = time.perf_counter() - profile.started
+        REQUEST_SECONDS.labels(endpoint=profile.endpoint).observe(elapsed)
+        REQUEST_DB_QUERIES.labels(endpoint=profile.endpoint).observe(profile.queries)
+        REQUEST_DB_SECONDS.labels(endpoint=profile.endpoint).observe(profile.query_seconds)
+
+        # 流式响应只统计到返回响应头为止
+        response.headers.add('Server-Timing', f'db;dur={profile.query_seconds * 1000:.1f};'
+                             f'desc="{profile.queries} queries, {profile.connections} connections"')
+        response.headers.add('Server-Timing', f'app;dur={elapsed * 1000:.1f}')
+
+        if profile.sampler:
+            samples = profile.sampler.stop()
+            profile.sampler = None
+            response.headers['X-Profile-File'] = write_folded_stacks(samples, profile.endpoint)
+        return response
+
+    @app.teardown_request
+    def clear_request_profile(exc):
+        profile = _current_profile.get()
+        # 请求异常结束时after_request不会执行，需要停止采样线程
+        if profile and profile.sampler:
+            profile.sampler.stop()
+        _current_profile.set(None)
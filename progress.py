@@ -0,0 +1,85 @@
+# 证书签发进度推送模块
+# 进程内的轻量发布/订阅，签发流程发布阶段事件，SSE接口按事件ID订阅
+
+import threading
+import time
+import uuid
+
+class ProgressChannel:
+    """一次签发对应的事件通道"""
+
+    def __init__(self, owner_id, lock):
+        self.owner_id = owner_id
+        self.events = []  # [(event_id, event, data)]
+        self.closed = False
+        self.updated_at = time.monotonic()
+        self.condition = threading.Condition(lock)
+
+class ProgressBroker:
+    """签发进度事件代理
+
+    事件保存在内存中，订阅方断线后可以携带最后收到的事件ID重新订阅，
+    只补发之后的事件。通道在最后一次更新 ttl 秒后被清理。
+    """
+
+    def __init__(self, ttl=600, history_limit=200):
+        self.ttl = ttl
+        self.history_limit = history_limit
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def create(self, owner_id):
+        """创建新的事件通道，返回通道ID"""
+        channel_id = uuid.uuid4().hex
+        with self._lock:
+            self._expire()
+            self._channels[channel_id] = ProgressChannel(owner_id, self._lock)
+        return channel_id
+
+    def owner(self, channel_id):
+        """返回通道所属用户ID，通道不存在时返回None"""
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            return channel.owner_id if channel else None
+
+    def publish(self, channel_id, event, data, close=False):
+        """发布事件，close为True时通道不再接收新事件"""
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if not channel or channel.closed:
+                return None
+
+            event_id = channel.events[-1][0] + 1 if channel.events else 1
+            channel.events.append((event_id, event, data))
+            del channel.events[:-self.history_limit]
+            channel.closed = close
+            channel.updated_at = time.monotonic()
+            channel.condition.notify_all()
+            return event_id
+
+    def wait(self, channel_id, last_event_id=0, timeout=15):
+        """等待 last_event_id 之后的事件
+
+        返回 (events, closed)；通道不存在时返回 (None, True)。
+        超时未收到新事件时 events 为空列表。
+        """
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            if not channel:
+                return None, True
+
+            def pending():
+                return [item for item in channel.events if item[0] > last_event_id]
+
+            channel.condition.wait_for(lambda: pending() or channel.closed, timeout=timeout)
+            return pending(), channel.closed
+
+    def _expire(self):
+        """清理过期通道，调用方需持有锁"""
+        now = time.monotonic()
+        expired = [channel_id for channel_id, channel in self._channels.items()
+                   if now - channel.updated_at > self.ttl]
+        for channel_id in expired:
+            del self._channels[channel_id]
+
+progress_broker = ProgressBroker()
@@ -0,0 +1,185 @@
+# ACME限流感知的准入调度
+# 参照Let's Encrypt的限流规则，提交订单前按滑动窗口统计acme_events表中实际发生的CA操作
+# （账户注册和订单结果，合并签发只计一次），预计会被CA拒绝的请求在调度器中延后重新排队或直接推迟；
+# CA返回的Retry-After同样会被遵守
+
+import itertools
+import math
+import threading
+from datetime import datetime, timedelta
+from database import get_acme_event_times
+from metrics import ADMISSION_DEFERRED
+
+class RateLimit:
+    """一条滑动窗口限流规则
+
+    kind 为统计的CA操作：order（订单）或registration（账户注册）。
+    scope 决定按什么分桶统计：
+    - global: 整个服务（CA按出口IP统计，单个部署视为一个IP）
+    - account: ACME账户邮箱
+    - registered_domain: 证书涉及的每个注册域名（example.com）
+    - identifiers: 完全相同的SAN集合
+    - account_domain: 账户 + 证书中的每个域名
+    """
+
+    def __init__(self, name, limit, window, scope, status=None, kind='order'):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.scope = scope
+        self.status = status
+        self.kind = kind
+
+# Let's Encrypt 生产环境限流规则
+DEFAULT_RATE_LIMITS = [
+    # 每个ACME邮箱只注册一次账户（之后复用），只有需要注册时才受每个IP的注册数限制
+    RateLimit('new_registrations', 10, timedelta(hours=3), 'global', kind='registration'),
+    RateLimit('new_orders', 300, timedelta(hours=3), 'account'),
+    RateLimit('certificates_per_domain', 50, timedelta(days=7), 'registered_domain', status='success'),
+    RateLimit('duplicate_certificates', 5, timedelta(days=7), 'identifiers', status='success'),
+    RateLimit('failed_validations', 5, timedelta(hours=1), 'account_domain', status='failed'),
+]
+
+def registered_domain(domain):
+    """提取注册域名（与Zone查询一致，取最后两级）"""
+    parts = domain.lstrip('*.').split('.')
+    return '.'.join(parts[-2:])
+
+class AdmissionDenied(Exception):
+    """请求在允许的等待时间内无法通过限流检查"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionQueued(Exception):
+    """请求需要等待 wait 秒后才能通过限流检查，等待时间在允许范围内
+
+    调用方不应在当前线程中等待，而是在 wait 秒后重新申请准入（签发任务以 scheduler.Requeue 重新排队）。
+    """
+    def __init__(self, message, wait, reason):
+        super().__init__(message)
+        self.wait = wait
+        self.reason = reason
+
+class AdmissionScheduler:
+    """证书申请准入调度
+
+    已发生的CA操作由数据库统计；已放行但尚未记录结果的申请
+    在内存中预留名额，避免并发请求同时越过限额。
+    数据库查询在锁外执行，持锁期间有申请释放名额（结果已写入数据库）时重新查询。
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or DEFAULT_RATE_LIMITS
+        self._lock = threading.Lock()
+        self._tickets = itertools.count(1)
+        self._reservations = {}  # ticket -> [(bucket, time)]
+        self._blocked = {}       # bucket -> 解除时间（CA的Retry-After）
+        self._released = 0       # 释放名额的次数，用于判断锁外的查询结果是否过期
+
+    def applicable_limits(self, registering):
+        """本次申请需要检查的规则：复用已有账户时不检查账户注册数"""
+        return [rate_limit for rate_limit in self.limits if registering or rate_limit.kind != 'registration']
+
+    def buckets(self, rate_limit, domains, email):
+        """规则对应的统计桶，返回 [(bucket, 数据库查询条件)]"""
+        if rate_limit.scope == 'global':
+            return [((rate_limit.name,), {})]
+        if rate_limit.scope == 'account':
+            return [((rate_limit.name, email), {'email': email})]
+        if rate_limit.scope == 'registered_domain':
+            return [((rate_limit.name, name), {'registered_domain': name})
+                    for name in sorted(set(registered_domain(domain) for domain in domains))]
+        if rate_limit.scope == 'identifiers':
+            return [((rate_limit.name, tuple(sorted(domains))), {'san_domains': domains})]
+        return [((rate_limit.name, email, domain), {'email': email, 'contains_domain': domain})
+                for domain in domains]
+
+    def blocked_buckets(self, domains, email):
+        """CA限流时需要暂停的桶：同一账户和涉及的每个注册域名"""
+        return [('ca', email)] + [('ca', name) for name in sorted(set(registered_domain(domain) for domain in domains))]
+
+    def recorded_times(self, limits, domains, email, now):
+        """从数据库读取各统计桶窗口内的CA操作时间（不持有锁），返回 {bucket: [time]}"""
+        recorded = {}
+        for rate_limit in limits:
+            for bucket, filters in self.buckets(rate_limit, domains, email):
+                recorded[bucket] = get_acme_event_times(now - rate_limit.window, rate_limit.kind,
+                                                        status=rate_limit.status, **filters)
+        return recorded
+
+    def wait_time(self, limits, domains, email, recorded, now):
+        """返回 (需要等待的秒数, 触发的规则名)，调用方需持有锁"""
+        wait, reason = 0, None
+
+        for bucket in self.blocked_buckets(domains, email):
+            until = self._blocked.get(bucket)
+            if until and until > now and (until - now).total_seconds() > wait:
+                wait, reason = (until - now).total_seconds(), 'ca_retry_after'
+
+        reserved = {}
+        for entries in self._reservations.values():
+            for bucket, reserved_at in entries:
+                reserved.setdefault(bucket, []).append(reserved_at)
+
+        for rate_limit in limits:
+            for bucket, _ in self.buckets(rate_limit, domains, email):
+                times = recorded[bucket] + reserved.get(bucket, [])
+                if len(times) < rate_limit.limit:
+                    continue
+                # 最近第limit次申请移出窗口后才有空位
+                times.sort(reverse=True)
+                free_at = times[rate_limit.limit - 1] + rate_limit.window
+                if (free_at - now).total_seconds() > wait:
+                    wait, reason = (free_at - now).total_seconds(), rate_limit.name
+
+        return wait, reason
+
+    def admit(self, domains, email, max_wait=0, registering=False):
+        """申请准入，domains为证书包含的全部域名，返回需要在结果写入数据库后 release 的票据
+
+        registering 为True表示该邮箱还没有ACME账户，本次申请会注册新账户。
+        需要等待的时间不超过 max_wait 秒时抛出 AdmissionQueued，由调用方在等待后重新申请，
+        否则抛出 AdmissionDenied。准入本身不等待，不占用调用方的线程。
+        """
+        limits = self.applicable_limits(registering)
+        while True:
+            released = self._released
+            now = datetime.utcnow()
+            recorded = self.recorded_times(limits, domains, email, now)
+            with self._lock:
+                if released != self._released:
+                    # 查询期间有申请的结果写入了数据库并释放了预留，重新查询避免漏算
+                    continue
+                wait, reason = self.wait_time(limits, domains, email, recorded, now)
+                if wait <= 0:
+                    ticket = next(self._tickets)
+                    self._reservations[ticket] = [
+                        (bucket, now)
+                        for rate_limit in limits
+                        for bucket, _ in self.buckets(rate_limit, domains, email)
+                    ]
+                    return ticket
+            break
+
+        if wait > max_wait:
+            ADMISSION_DEFERRED.labels(limit=reason).inc()
+            retry_after = math.ceil(wait)
+            raise AdmissionDenied(f"触发Let's Encrypt限流规则 {reason}，请在 {retry_after} 秒后重试", retry_after)
+        raise AdmissionQueued(f"触发限流规则 {reason}，排队等待 {math.ceil(wait)} 秒", wait, reason)
+
+    def release(self, ticket):
+        """申请的CA操作已写入数据库（或未产生订单），释放预留名额"""
+        with self._lock:
+            if self._reservations.pop(ticket, None) is not None:
+                self._released += 1
+
+    def block(self, domains, email, retry_after):
+        """记录CA返回的Retry-After，期间同一账户和注册域名的申请都会被推迟"""
+        until = datetime.utcnow() + timedelta(seconds=retry_after)
+        with self._lock:
+            for bucket in self.blocked_buckets(domains, email):
+                if self._blocked.get(bucket, until) <= until:
+                    self._blocked[bucket] = until
+
+admission_scheduler = AdmissionScheduler()
@@ -0,0 +1,72 @@
+# 邮件日志保留策略
+# 按邮件类型删除过期的邮件记录，压缩较早邮件的HTML内容，
+# 并通过 PRAGMA incremental_vacuum 把释放的空间归还给文件系统
+
+import os
+import time
+from datetime import datetime, timedelta
+from database import compress_email_logs, delete_email_logs, incremental_vacuum
+
+# 各类型邮件的默认保留天数，未列出的类型使用 default_days
+DEFAULT_EMAIL_RETENTION_DAYS = {
+    'verification': 30,
+}
+
+def parse_retention_days(value):
+    """解析形如 "verification=30,general=180" 的按类型保留天数配置"""
+    retention = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        email_type, _, days = item.partition('=')
+        retention[email_type.strip()] = int(days)
+    return retention
+
+def run_email_retention(retention_days=None, default_days=180, compress_after_days=7, batch_size=500, vacuum_pages=None):
+    """执行一次邮件日志保留策略，返回执行报告
+
+    - retention_days: {邮件类型: 保留天数}，天数为0表示永久保留
+    - default_days: 其他类型的保留天数，为0表示永久保留
+    - compress_after_days: 发送超过该天数的邮件内容压缩保存
+    """
+    retention_days = DEFAULT_EMAIL_RETENTION_DAYS if retention_days is None else retention_days
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    report = {'deleted': {}}
+
+    # 先删除再压缩，避免压缩马上要删除的记录
+    for email_type, days in retention_days.items():
+        if days > 0:
+            report['deleted'][email_type] = delete_email_logs(
+                now - timedelta(days=days), email_type=email_type, batch_size=batch_size)
+    if default_days > 0:
+        report['deleted']['*'] = delete_email_logs(
+            now - timedelta(days=default_days), exclude_types=list(retention_days), batch_size=batch_size)
+
+    report['compressed'], report['compressed_bytes_saved'] = compress_email_logs(
+        now - timedelta(days=compress_after_days), batch_size=batch_size)
+    report['bytes_reclaimed'] = incremental_vacuum(vacuum_pages)
+    report['duration'] = round(time.perf_counter() - started, 3)
+
+    print(f"邮件日志保留策略执行完成: 删除 {sum(report['deleted'].values())} 条，"
+          f"压缩 {report['compressed']} 条（节省 {report['compressed_bytes_saved']} 字节），"
+          f"数据库文件回收 {report['bytes_reclaimed']} 字节，耗时 {report['duration']} 秒")
+    return report
+
+def run_from_config(config):
+    """按应用配置执行保留策略"""
+    retention_days = dict(DEFAULT_EMAIL_RETENTION_DAYS)
+    retention_days.update(parse_retention_days(config.get('EMAIL_RETENTION_DAYS')))
+    return run_email_retention(
+        retention_days=retention_days,
+        default_days=config.get('EMAIL_RETENTION_DEFAULT_DAYS', 180),
+        compress_after_days=config.get('EMAIL_COMPRESS_AFTER_DAYS', 7),
+        batch_size=config.get('EMAIL_RETENTION_BATCH_SIZE', 500),
+        vacuum_pages=config.get('VACUUM_MAX_PAGES')
+    )
+
+if __name__ == '__main__':
+    # 手动执行一次：python retention.py
+    os.environ.setdefault('BACKGROUND_TASKS_ENABLED', 'false')
+    from app import app
+    print(run_from_config(app.config))
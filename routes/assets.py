@@ -0,0 +1,31 @@
+import mimetypes
+import os
+from flask import Blueprint, request, send_file, abort
+from assets import asset_manifest, DIST_DIR, ENCODINGS
+
+assets_bp = Blueprint('assets', __name__)
+
+# 文件名包含内容哈希，内容变化后地址随之变化，可以永久缓存
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@assets_bp.route('/assets/<path:filename>')
+def asset(filename):
+    """返回构建后的静态资源，客户端支持时返回预压缩版本"""
+    if filename not in asset_manifest.built:
+        abort(404)
+    
+    path = os.path.join(DIST_DIR, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    
+    encoding = None
+    for name, suffix in ENCODINGS:
+        if request.accept_encodings[name] and os.path.exists(path + suffix):
+            encoding, path = name, path + suffix
+            break
+    
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
@@ -3,6 +3,7 @@ from flask_login import login_user, logout_user, login_required
 from werkzeug.security import check_password_hash
 import re
 from database import create_user, verify_user, verify_email_token
+from passwords import PasswordHashingBusy
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -12,7 +13,11 @@ def login():
         email = request.form['email']
         password = request.form['password']
         
-        user = verify_user(email, password)
+        try:
+            user = verify_user(email, password)
+        except PasswordHashingBusy as e:
+            flash(str(e), 'error')
+            return render_template('login.html'), 503
         if user:
             if user.is_verified:
                 login_user(user)
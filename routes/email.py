@@ -1,32 +1,42 @@
 from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
 from flask_login import login_required, current_user
 from database import get_user_email_logs, get_email_log_detail
+from http_cache import conditional, cached_fragment
 
 email_bp = Blueprint('email', __name__)
 
+def email_version_keys():
+    """邮件记录页面包含用户自己的和不属于任何用户的邮件记录"""
+    return [(current_user.id, 'emails'), (0, 'emails')]
+
 @email_bp.route('/email-logs')
 @login_required
+@conditional(email_version_keys)
 def email_logs():
     """邮件发送记录页面"""
     page = request.args.get('page', 1, type=int)
     per_page = 20
     
-    # 获取用户的邮件记录
-    logs = get_user_email_logs(current_user.id, limit=per_page * page)
-    
-    # 简单分页处理
-    start_index = (page - 1) * per_page
-    end_index = start_index + per_page
-    page_logs = logs[start_index:end_index]
+    def render_table():
+        # 获取用户的邮件记录
+        logs = get_user_email_logs(current_user.id, limit=per_page * page)
+        
+        # 简单分页处理
+        start_index = (page - 1) * per_page
+        end_index = start_index + per_page
+        page_logs = logs[start_index:end_index]
+        
+        has_next = len(logs) > end_index
+        has_prev = page > 1
+        
+        return render_template('partials/email_logs_table.html',
+                             logs=page_logs,
+                             page=page,
+                             has_next=has_next,
+                             has_prev=has_prev)
     
-    has_next = len(logs) > end_index
-    has_prev = page > 1
-    
-    return render_template('email_logs.html', 
-                         logs=page_logs,
-                         page=page,
-                         has_next=has_next,
-                         has_prev=has_prev)
+    table = cached_fragment('email_logs_table', render_table, current_user.id, page)
+    return render_template('email_logs.html', table=table)
 
 @email_bp.route('/email-logs/<int:log_id>')
 @login_required
@@ -42,19 +52,23 @@ def email_log_detail(log_id):
 
 @email_bp.route('/api/email-stats')
 @login_required
+@conditional(email_version_keys)
 def email_stats():
     """获取邮件统计信息"""
-    logs = get_user_email_logs(current_user.id, limit=1000)
-    
-    total = len(logs)
-    sent = len([log for log in logs if log['status'] == 'sent'])
-    failed = len([log for log in logs if log['status'] == 'failed'])
-    pending = len([log for log in logs if log['status'] == 'pending'])
+    def compute_stats():
+        logs = get_user_email_logs(current_user.id, limit=1000)
+        
+        total = len(logs)
+        sent = len([log for log in logs if log['status'] == 'sent'])
+        failed = len([log for log in logs if log['status'] == 'failed'])
+        pending = len([log for log in logs if log['status'] == 'pending'])
+        
+        return {
+            'total': total,
+            'sent': sent,
+            'failed': failed,
+            'pending': pending,
+            'success_rate': round((sent / total * 100) if total > 0 else 0, 2)
+        }
     
-    return jsonify({
-        'total': total,
-        'sent': sent,
-        'failed': failed,
-        'pending': pending,
-        'success_rate': round((sent / total * 100) if total > 0 else 0, 2)
-    })
\ No newline at end of file
+    return jsonify(cached_fragment('email_stats', compute_stats, current_user.id))
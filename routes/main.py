@@ -1,8 +1,21 @@
-from flask import Blueprint, render_template, request, jsonify
+from flask import Blueprint, render_template, request, jsonify, Response, current_app, abort, redirect, url_for, flash
 from flask_login import login_required, current_user
-from database import get_user_certificates, get_certificate_by_id, save_certificate_record
-from ssl_generator import SSLCertificateGenerator
+from database import (
+    get_user_certificates, get_certificate_by_id, save_certificate_record, get_ocsp_response, set_auto_renew,
+    create_deployment_target, delete_deployment_target, search_user_certificates, domain_search_pattern, TIMESTAMP_FORMAT
+)
+from issuance import schedule_certificate
+from scheduler import QuotaExceeded
+from bulk import run_batch, parse_json_items, parse_csv_items
+from ssl_generator import normalize_domains
+from progress import progress_broker
+from http_cache import conditional, cached_fragment
+from deploy import deployer, parse_target_config, DeployError
+from profiling import is_admin
 import traceback
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
 
 main_bp = Blueprint('main', __name__)
 
@@ -11,11 +24,80 @@ main_bp = Blueprint('main', __name__)
 def index():
     return render_template('index.html')
 
+# 历史记录页面搜索时最多显示的记录数
+HISTORY_SEARCH_LIMIT = 200
+
+def search_filters(args):
+    """从请求参数读取证书搜索条件（q、status、expires_after、expires_before），参数无效时抛出ValueError"""
+    filters = {}
+    query = args.get('q', '').strip()
+    if query:
+        domain_search_pattern(query)
+        filters['query'] = query
+    status = args.get('status', '')
+    if status:
+        if status not in ('success', 'failed'):
+            raise ValueError('状态只能是 success 或 failed')
+        filters['status'] = status
+    for name in ('expires_after', 'expires_before'):
+        value = args.get(name, '').strip()
+        if value:
+            try:
+                filters[name] = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('过期时间的格式应为 YYYY-MM-DD')
+    if 'expires_before' in filters:
+        # 结束日期包含当天
+        filters['expires_before'] += timedelta(days=1)
+    return filters
+
 @main_bp.route('/history')
 @login_required
+@conditional(lambda: [(current_user.id, 'certificates')])
 def history():
-    certificates = get_user_certificates(current_user.id)
-    return render_template('history.html', certificates=certificates)
+    try:
+        filters = search_filters(request.args)
+        search_error = None
+    except ValueError as e:
+        filters, search_error = {}, str(e)
+    
+    if filters:
+        table = cached_fragment('history_search', lambda: render_template(
+            'partials/history_table.html', searching=True, limit=HISTORY_SEARCH_LIMIT,
+            certificates=search_user_certificates(current_user.id, limit=HISTORY_SEARCH_LIMIT, **filters)
+        ), current_user.id, tuple(sorted(filters.items())))
+    else:
+        table = cached_fragment('history_table', lambda: render_template(
+            'partials/history_table.html', certificates=get_user_certificates(current_user.id)
+        ), current_user.id)
+    return render_template('history.html', table=table, search=request.args, search_error=search_error)
+
+@main_bp.route('/api/certificates/search')
+@login_required
+@conditional(lambda: [(current_user.id, 'certificates')])
+def search_certificates():
+    """按域名（支持 * 通配符和后缀匹配）、状态和过期时间搜索证书记录
+
+    参数：q、status、expires_after、expires_before（YYYY-MM-DD）、limit（最多200）、
+    before（上一页返回的next_before，用于翻页）
+    """
+    try:
+        filters = search_filters(request.args)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    certificates = search_user_certificates(
+        current_user.id, before_id=request.args.get('before', type=int), limit=limit, **filters
+    )
+    return jsonify({
+        'success': True,
+        'certificates': certificates,
+        'next_before': certificates[-1]['id'] if len(certificates) == limit else None
+    })
 
 @main_bp.route('/certificate/<int:cert_id>')
 @login_required
@@ -25,62 +107,196 @@ def certificate_detail(cert_id):
         return "证书不存在或您没有权限查看", 404
     return render_template('certificate_detail.html', certificate=certificate)
 
+@main_bp.route('/certificate/<int:cert_id>/ocsp.der')
+@login_required
+def certificate_ocsp(cert_id):
+    """缓存的OCSP响应（DER），可直接作为边缘服务器的OCSP Stapling文件"""
+    cached = get_ocsp_response(cert_id, current_user.id)
+    if not cached:
+        abort(404)
+    status, response_der = cached
+    
+    now = datetime.utcnow()
+    next_update = datetime.strptime(status['next_update'], TIMESTAMP_FORMAT) if status['next_update'] else None
+    if next_update and next_update <= now:
+        # 响应已过期，Stapling过期的响应会导致客户端握手失败
+        abort(404)
+    
+    response = Response(response_der, mimetype='application/ocsp-response')
+    response.headers['Content-Disposition'] = f'attachment; filename={cert_id}.ocsp'
+    response.set_etag(hashlib.sha256(response_der).hexdigest())
+    response.last_modified = datetime.strptime(status['this_update'], TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    if next_update:
+        response.cache_control.max_age = int((next_update - now).total_seconds())
+    response.cache_control.private = True
+    return response.make_conditional(request)
+
+@main_bp.route('/certificate/<int:cert_id>/auto-renew', methods=['POST'])
+@login_required
+def certificate_auto_renew(cert_id):
+    """开启或关闭证书的自动续期，开启时需要提供续期使用的Cloudflare密钥"""
+    enabled = request.form.get('enabled') == '1'
+    cf_api_key = request.form.get('cf_api_key', '').strip()
+    if enabled and not cf_api_key:
+        flash('开启自动续期需要填写Cloudflare Global API Key。', 'error')
+    elif not set_auto_renew(cert_id, current_user.id, enabled, cf_api_key):
+        abort(404)
+    else:
+        flash('已开启自动续期，将在CA建议的续期时间窗口内自动签发新证书。' if enabled else '已关闭自动续期。', 'success')
+    return redirect(url_for('main.certificate_detail', cert_id=cert_id))
+
+@main_bp.route('/certificate/<int:cert_id>/deployment-targets', methods=['POST'])
+@login_required
+def add_deployment_target(cert_id):
+    """为证书的域名集合添加部署目标，之后签发（含续期）的证书都会部署到该目标"""
+    kind = request.form.get('kind', '')
+    name = request.form.get('name', '').strip() or kind
+    if kind == 'local' and not is_admin():
+        # 本机目录部署会在服务器上写入文件并执行命令
+        flash('本机目录部署只允许管理员配置。', 'error')
+        return redirect(url_for('main.certificate_detail', cert_id=cert_id))
+    
+    try:
+        config = parse_target_config(kind, request.form)
+    except (DeployError, ValueError) as e:
+        flash(f'部署目标无效：{e}', 'error')
+        return redirect(url_for('main.certificate_detail', cert_id=cert_id))
+    
+    if not create_deployment_target(cert_id, current_user.id, name, kind, config):
+        abort(404)
+    flash(f'已添加部署目标 {name}，点击"部署"将当前证书推送到该目标。', 'success')
+    return redirect(url_for('main.certificate_detail', cert_id=cert_id))
+
+@main_bp.route('/certificate/<int:cert_id>/deployment-targets/<int:target_id>/delete', methods=['POST'])
+@login_required
+def remove_deployment_target(cert_id, target_id):
+    if not delete_deployment_target(target_id, current_user.id):
+        abort(404)
+    flash('已删除部署目标。', 'success')
+    return redirect(url_for('main.certificate_detail', cert_id=cert_id))
+
+@main_bp.route('/certificate/<int:cert_id>/deploy', methods=['POST'])
+@login_required
+def deploy_certificate(cert_id):
+    """在后台把证书部署到全部目标，已成功部署过的目标跳过（force=1时重新部署）"""
+    certificate = get_certificate_by_id(cert_id, current_user.id)
+    if not certificate or certificate['status'] != 'success':
+        abort(404)
+    deployer.deploy_async(cert_id, force=request.form.get('force') == '1')
+    flash('已开始部署，刷新页面查看各目标的部署结果。', 'success')
+    return redirect(url_for('main.certificate_detail', cert_id=cert_id))
+
+@main_bp.route('/generate/progress', methods=['POST'])
+@login_required
+def create_progress():
+    """创建签发进度通道，客户端随后订阅事件流并在/generate请求中携带progress_id"""
+    return jsonify({'progress_id': progress_broker.create(current_user.id)})
+
+@main_bp.route('/generate/progress/<progress_id>/events')
+@login_required
+def progress_events(progress_id):
+    """签发进度事件流（Server-Sent Events）
+
+    每次请求只返回 Last-Event-ID 之后已有的事件并立即结束，不等待新事件，
+    浏览器在 PROGRESS_RETRY_MS 毫秒后携带 Last-Event-ID 自动重连，观察者不占用工作线程。
+    事件流本身只读取内存中的事件，不占用数据库连接。
+    """
+    if progress_broker.owner(progress_id) != current_user.id:
+        abort(404)
+    
+    last_event_id = request.headers.get('Last-Event-ID', 0, type=int)
+    events, closed = progress_broker.wait(progress_id, last_event_id, timeout=0)
+    if events is None or (closed and not events):
+        # 204告知浏览器不再重连
+        return Response(status=204)
+    
+    retry = current_app.config.get('PROGRESS_RETRY_MS', 1000)
+    body = [f'retry: {retry}\n\n']
+    for event_id, event, data in events:
+        body.append(f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n')
+    
+    return Response(''.join(body), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def issue_options():
+    """签发选项：按配置复用有效期内的现有证书，预计触发CA限流时排队等待"""
+    reuse_min_days = None
+    if current_app.config.get('CERT_REUSE_ENABLED'):
+        reuse_min_days = current_app.config.get('CERT_REUSE_MIN_DAYS', 30)
+    
+    return {
+        'reuse_min_days': reuse_min_days,
+        'admission_max_wait': current_app.config.get('RATE_LIMIT_MAX_WAIT', 60)
+    }
+
 @main_bp.route('/generate', methods=['POST'])
 @login_required
 def generate_certificate():
+    data = {}
+    domains = None
     try:
-        data = request.get_json()
-        domain = data.get('domain')
+        data = request.get_json() or {}
+        # domains可以是域名列表，也兼容以逗号或换行分隔多个域名的domain字段
+        domains = data.get('domains') or data.get('domain')
         email = data.get('email')
         cf_email = data.get('cf_email')
         cf_api_key = data.get('cf_api_key')
+        progress_id = data.get('progress_id')
         
-        if not all([domain, email, cf_email, cf_api_key]):
+        if not all([domains, email, cf_email, cf_api_key]):
             return jsonify({
                 'success': False,
                 'message': '请填写所有必需字段'
             })
         
-        # 生成证书
-        generator = SSLCertificateGenerator(cf_email, cf_api_key)
-        result = generator.generate_certificate(domain, email)
-        
-        if result['success']:
-            # 保存到数据库
-            cert_id = save_certificate_record(
-                user_id=current_user.id,
-                domain=domain,
-                email=email,
-                cf_email=cf_email,
-                status='success',
-                private_key=result['private_key'],
-                certificate=result['certificate'],
-                ca_certificate=result.get('ca_certificate', '')
-            )
-            
+        try:
+            domains = normalize_domains(domains)
+        except ValueError as e:
             return jsonify({
-                'success': True,
-                'message': '证书生成成功！',
-                'certificate_id': cert_id,
-                'private_key': result['private_key'],
-                'certificate': result['certificate'],
-                'ca_certificate': result.get('ca_certificate', '')
+                'success': False,
+                'message': str(e)
             })
-        else:
-            # 保存失败记录
-            save_certificate_record(
+        
+        # 只向属于当前用户的进度通道推送事件
+        if progress_id and progress_broker.owner(progress_id) != current_user.id:
+            progress_id = None
+        
+        def on_progress(phase, message):
+            if progress_id:
+                progress_broker.publish(progress_id, 'progress', {'phase': phase, 'message': message})
+        
+        # 生成证书（在公平调度器中排队执行；相同请求自动合并，按配置复用有效期内的现有证书）
+        try:
+            result = schedule_certificate(
                 user_id=current_user.id,
-                domain=domain,
+                domains=domains,
                 email=email,
                 cf_email=cf_email,
-                status='failed',
-                error_message=result['message']
-            )
-            
-            return jsonify({
+                cf_api_key=cf_api_key,
+                kind='interactive',
+                on_progress=on_progress,
+                **issue_options()
+            ).result()
+        except QuotaExceeded as e:
+            result = {
                 'success': False,
-                'message': result['message']
-            })
+                'message': str(e),
+                'retry_after': e.retry_after
+            }
+        finally:
+            if progress_id:
+                progress_broker.publish(progress_id, 'done', {'phase': 'done', 'message': '签发流程结束'}, close=True)
+        
+        if result.get('retry_after'):
+            # 触发限流，提示客户端稍后重试
+            response = jsonify(result)
+            response.status_code = 429
+            response.headers['Retry-After'] = str(result['retry_after'])
+            return response
+        
+        return jsonify(result)
             
     except Exception as e:
         error_msg = f"生成证书时发生错误: {str(e)}"
@@ -91,7 +307,8 @@ def generate_certificate():
         try:
             save_certificate_record(
                 user_id=current_user.id,
-                domain=data.get('domain', ''),
+                # 规范化之后domains是域名列表，规范化之前出错时是请求中的原始值（字符串或列表）
+                domain=domains if isinstance(domains, str) else ','.join(map(str, domains or [])),
                 email=data.get('email', ''),
                 cf_email=data.get('cf_email', ''),
                 status='failed',
@@ -103,4 +320,75 @@ def generate_certificate():
         return jsonify({
             'success': False,
             'message': error_msg
-        })
\ No newline at end of file
+        })
+
+@main_bp.route('/generate/batch', methods=['POST'])
+@login_required
+def generate_batch():
+    """批量签发，每张证书完成后以NDJSON逐行返回结果
+
+    请求体为JSON：{"items": [...], "email", "cf_email", "cf_api_key"}，items每项为一张证书的域名；
+    或multipart表单：CSV文件字段file（每行一张证书），以及email、cf_email、cf_api_key字段。
+    """
+    if request.is_json:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({
+                'success': False,
+                'message': '请求体应为JSON对象'
+            }), 400
+        try:
+            items = list(parse_json_items(data.get('items') or data.get('domains') or []))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 400
+    else:
+        # CSV文件最多读取BATCH_MAX_UPLOAD_BYTES字节，超出时直接拒绝，不把整个文件读入内存
+        max_bytes = current_app.config.get('BATCH_MAX_UPLOAD_BYTES', 1024 * 1024)
+        too_large = {
+            'success': False,
+            'message': f'上传的文件不能超过 {max(max_bytes // 1024, 1)} KB'
+        }
+        # 表单其他字段和multipart分隔符另外预留64KB
+        if request.content_length and request.content_length > max_bytes + 64 * 1024:
+            return jsonify(too_large), 413
+        data = request.form
+        upload = request.files.get('file')
+        content = upload.stream.read(max_bytes + 1) if upload else b''
+        if len(content) > max_bytes:
+            return jsonify(too_large), 413
+        items = list(parse_csv_items(content.decode('utf-8-sig', errors='replace')))
+    
+    email = data.get('email')
+    cf_email = data.get('cf_email')
+    cf_api_key = data.get('cf_api_key')
+    
+    if not all([items, email, cf_email, cf_api_key]):
+        return jsonify({
+            'success': False,
+            'message': '请填写所有必需字段'
+        }), 400
+    
+    max_items = current_app.config.get('BATCH_MAX_ITEMS', 200)
+    if len(items) > max_items:
+        return jsonify({
+            'success': False,
+            'message': f'单次批量申请最多 {max_items} 张证书，当前为 {len(items)} 张'
+        }), 400
+    
+    events = run_batch(
+        current_user.id, items, email, cf_email, cf_api_key,
+        max_workers=current_app.config.get('BATCH_MAX_WORKERS', 4),
+        **issue_options()
+    )
+    
+    def stream():
+        for event in events:
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+    
+    return Response(stream(), mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
@@ -0,0 +1,36 @@
+from flask import Blueprint, Response, request, current_app, abort, jsonify
+from flask_login import login_required
+from metrics import render_metrics
+from profiling import is_admin
+from scheduler import issuance_scheduler
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """Prometheus指标导出接口"""
+    # 配置了METRICS_TOKEN时要求抓取方携带Bearer令牌
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+@metrics_bp.route('/metrics/issuance-queue')
+@login_required
+def issuance_queue():
+    """排队最多的租户（只允许ADMIN_EMAILS中的用户查看）
+
+    issuance_queue_depth 指标不按用户打标签，各租户的排队情况在这里查看，
+    最多返回 limit（默认20，不超过100）个租户。
+    """
+    if not is_admin():
+        abort(404)
+    
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    depths = issuance_scheduler.queue_depth(limit=limit)
+    return jsonify({'tenants': [
+        {'user_id': user_id, 'cf_email': cf_email, 'kind': kind, 'queued': queued}
+        for (user_id, cf_email, kind), queued in depths.items()
+    ]})
@@ -0,0 +1,248 @@
+# 签发任务的多租户公平调度
+# 签发任务在固定数量的工作线程中执行，按租户（用户 + Cloudflare账户 + 任务类型）分队列，
+# 以加权的起始时间公平排队（Start-time Fair Queuing）选择下一个任务：
+# 一个用户提交大批量任务时，其他用户的任务不需要排在整批之后。
+# 交互式的单证书申请获得更高的权重，批量任务运行期间仍然保持较低的等待时间。
+# 暂时不能执行的任务（如等待CA限流名额）抛出 Requeue，在指定时间后重新排队，不在工作线程中等待。
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from collections import deque
+from datetime import datetime, timedelta
+from database import get_user_schedule_policy, count_user_certificates_since
+from metrics import ISSUANCE_QUEUE_DEPTH, ISSUANCE_RUNNING, ISSUANCE_QUEUE_WAIT_SECONDS
+
+class QuotaExceeded(Exception):
+    """用户当天的签发次数已达到配额"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Requeue(Exception):
+    """任务暂时不能执行：delay 秒后重新排队执行 fn（为None时重新执行原来的函数）
+
+    任务保留原来的虚拟起始时间和Future，等待期间不占用工作线程和用户的并发名额。
+    """
+    def __init__(self, delay, fn=None):
+        super().__init__(f'{delay:.1f} 秒后重新执行')
+        self.delay = delay
+        self.fn = fn
+
+class SchedulePolicy:
+    """用户的调度参数（保存在users表）
+
+    - weight: 调度权重，权重越大分到的执行机会越多
+    - max_concurrent: 该用户同时执行的签发任务上限
+    - daily_quota: 每天（UTC）最多提交的签发次数，0表示不限制
+    """
+
+    def __init__(self, weight=1.0, max_concurrent=2, daily_quota=0):
+        self.weight = weight
+        self.max_concurrent = max_concurrent
+        self.daily_quota = daily_quota
+
+class FairScheduler:
+    """加权公平调度的签发任务执行器"""
+
+    class Tenant:
+        def __init__(self, key, user_id, kind):
+            self.key = key
+            self.user_id = user_id
+            self.kind = kind
+            self.jobs = deque()
+            self.delayed = []       # 重新排队的任务 [(可执行时间, 序号, 任务)]，按可执行时间排列的堆
+            self.last_finish = 0.0  # 该租户最后一个任务的虚拟结束时间
+
+    def __init__(self, workers=8, interactive_boost=4.0, policy_loader=None, usage_loader=None):
+        self.workers = workers
+        self.interactive_boost = interactive_boost
+        # policy_loader(user_id) -> SchedulePolicy；usage_loader(user_id, since) -> since之后的签发次数
+        self.policy_loader = policy_loader or (lambda user_id: SchedulePolicy())
+        self.usage_loader = usage_loader
+        self._cond = threading.Condition()
+        self._tenants = {}
+        self._running = {}       # user_id -> 执行中的任务数
+        self._submitted = {}     # user_id -> 排队和执行中的任务数（尚未计入数据库）
+        self._finished = {}      # user_id -> 已执行完的任务数，用于发现读取用量期间完成的任务
+        self._policies = {}      # user_id -> 最近一次提交时读取的调度参数
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._threads = []
+
+    def configure(self, workers=None, interactive_boost=None):
+        """应用启动时按配置调整，需要在第一次提交任务之前调用"""
+        if workers:
+            self.workers = workers
+        if interactive_boost:
+            self.interactive_boost = interactive_boost
+
+    def submit(self, user_id, cf_email, fn, kind='interactive', cost=1):
+        """提交签发任务，返回Future
+
+        kind为interactive（单证书申请）或bulk（批量任务），cost为任务的相对开销（如证书包含的域名数）。
+        用户当天的签发次数已达配额时抛出 QuotaExceeded。
+        """
+        policy = self.policy_loader(user_id)
+        weight = policy.weight * (self.interactive_boost if kind == 'interactive' else 1)
+        future = Future()
+        key = (user_id, (cf_email or '').strip().lower(), kind)
+
+        with self._cond:
+            finished = self._finished.get(user_id, 0)
+        # 数据库查询在加锁之前完成，不阻塞其他提交和工作线程选择任务
+        usage = self.load_usage(user_id, policy)
+
+        with self._cond:
+            # 配额检查和计入已提交任务在同一次加锁中完成，同一用户并发提交时不会一起通过检查
+            self.check_quota(user_id, policy, usage, finished)
+            self._ensure_workers()
+            self._policies[user_id] = policy
+            tenant = self._tenants.get(key)
+            if tenant is None:
+                tenant = self._tenants[key] = self.Tenant(key, user_id, kind)
+
+            # 空闲后重新提交的租户从当前虚拟时间开始，不能用之前积累的份额插队
+            start = max(self._virtual_time, tenant.last_finish)
+            tenant.last_finish = start + cost / max(weight, 0.001)
+            tenant.jobs.append((start, next(self._sequence), future, fn, time.monotonic()))
+            self._submitted[user_id] = self._submitted.get(user_id, 0) + 1
+            ISSUANCE_QUEUE_DEPTH.labels(kind=kind).inc()
+            self._cond.notify()
+
+        return future
+
+    def load_usage(self, user_id, policy):
+        """查询当天（UTC）数据库中的签发次数，返回 (次数, 当天开始时间)，不限配额时返回None"""
+        if not policy.daily_quota or not self.usage_loader:
+            return None
+        day_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        return self.usage_loader(user_id, day_start), day_start
+
+    def check_quota(self, user_id, policy, usage, finished):
+        """检查当天的签发配额，调用方需持有锁
+
+        usage为加锁前 load_usage() 读取的数据库用量，finished为读取之前已执行完的任务数。
+        读取期间执行完的任务可能还没有计入usage，也不再计入_submitted，按已使用计算，
+        同一任务最多被重复计算一次，不会放行超过配额的提交。
+        """
+        if usage is None:
+            return
+
+        used, day_start = usage
+        used += self._submitted.get(user_id, 0) + self._finished.get(user_id, 0) - finished
+        if used >= policy.daily_quota:
+            retry_after = int((day_start + timedelta(days=1) - datetime.utcnow()).total_seconds()) + 1
+            raise QuotaExceeded(f"今日签发次数已达上限（{policy.daily_quota} 次），请明天再试", retry_after)
+
+    def queue_depth(self, limit=None):
+        """各租户排队中的任务数 {(user_id, cf_email, kind): 数量}，limit只返回排队最多的前若干个租户"""
+        with self._cond:
+            depths = [(key, len(tenant.jobs) + len(tenant.delayed)) for key, tenant in self._tenants.items()
+                      if tenant.jobs or tenant.delayed]
+        depths.sort(key=lambda item: item[1], reverse=True)
+        return dict(depths[:limit] if limit else depths)
+
+    def _ensure_workers(self):
+        """第一次提交任务时启动工作线程，调用方需持有锁"""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'issuance-worker-{len(self._threads) + 1}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        """选择虚拟起始时间最早、且用户未达并发上限的任务，调用方需持有锁"""
+        best = None
+        idle = []
+        now = time.monotonic()
+        for tenant in self._tenants.values():
+            self._promote_delayed(tenant, now)
+            if not tenant.jobs:
+                # 虚拟时间已经追上的空闲租户不再有份额差异，可以清理
+                if not tenant.delayed and tenant.last_finish <= self._virtual_time:
+                    idle.append(tenant.key)
+                continue
+            policy = self._policies.get(tenant.user_id) or SchedulePolicy()
+            if self._running.get(tenant.user_id, 0) >= policy.max_concurrent:
+                continue
+            if best is None or tenant.jobs[0][:2] < best.jobs[0][:2]:
+                best = tenant
+
+        for key in idle:
+            del self._tenants[key]
+
+        if best is None:
+            return None
+
+        job = best.jobs.popleft()
+        self._virtual_time = max(self._virtual_time, job[0])
+        return best, job
+
+    def _promote_delayed(self, tenant, now):
+        """把已到可执行时间的重新排队任务按虚拟起始时间放回队列，调用方需持有锁"""
+        while tenant.delayed and tenant.delayed[0][0] <= now:
+            _, _, job = heapq.heappop(tenant.delayed)
+            index = next((i for i, queued in enumerate(tenant.jobs) if queued[:2] > job[:2]), len(tenant.jobs))
+            tenant.jobs.insert(index, job)
+
+    def _next_wakeup(self):
+        """距离最早的重新排队任务可以执行的秒数，没有时返回None，调用方需持有锁"""
+        ready_times = [tenant.delayed[0][0] for tenant in self._tenants.values() if tenant.delayed]
+        if not ready_times:
+            return None
+        return max(min(ready_times) - time.monotonic(), 0)
+
+    def _requeue(self, tenant, job, requeue):
+        """任务在 requeue.delay 秒后重新排队，调用方需持有锁"""
+        start, sequence, future, fn, _ = job
+        ready_at = time.monotonic() + max(requeue.delay, 0)
+        # 任务执行期间空闲的租户可能已被清理
+        tenant = self._tenants.setdefault(tenant.key, tenant)
+        heapq.heappush(tenant.delayed, (ready_at, sequence, (start, sequence, future, requeue.fn or fn, ready_at)))
+        ISSUANCE_QUEUE_DEPTH.labels(kind=tenant.kind).inc()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait(self._next_wakeup())
+                    job = self._next_job()
+                tenant, job = job
+                _, _, future, fn, enqueued_at = job
+                self._running[tenant.user_id] = self._running.get(tenant.user_id, 0) + 1
+
+            ISSUANCE_QUEUE_DEPTH.labels(kind=tenant.kind).dec()
+            ISSUANCE_RUNNING.labels(kind=tenant.kind).inc()
+            ISSUANCE_QUEUE_WAIT_SECONDS.labels(kind=tenant.kind).observe(time.monotonic() - enqueued_at)
+
+            requeue = None
+            try:
+                # 重新排队的任务Future已处于执行中状态
+                if future.running() or future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn())
+                    except Requeue as e:
+                        requeue = e
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                ISSUANCE_RUNNING.labels(kind=tenant.kind).dec()
+                with self._cond:
+                    self._running[tenant.user_id] -= 1
+                    if requeue:
+                        self._requeue(tenant, job, requeue)
+                    else:
+                        self._submitted[tenant.user_id] -= 1
+                        self._finished[tenant.user_id] = self._finished.get(tenant.user_id, 0) + 1
+                    # 并发名额释放后其他工作线程可能有可执行的任务
+                    self._cond.notify_all()
+
+def load_schedule_policy(user_id):
+    """从users表读取用户的调度参数"""
+    policy = get_user_schedule_policy(user_id)
+    return SchedulePolicy(**policy) if policy else SchedulePolicy()
+
+issuance_scheduler = FairScheduler(policy_loader=load_schedule_policy, usage_loader=count_user_certificates_since)
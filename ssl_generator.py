@@ -1,6 +1,10 @@
+import os
 import requests
 import time
 import json
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from acme import client, messages
 from acme.challenges import DNS01
 from cryptography.hazmat.primitives import hashes, serialization
@@ -11,12 +15,109 @@ from josepy import JWKRSA
 import OpenSSL
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from metrics import PhaseTimer, CLOUDFLARE_ERRORS, track_cloudflare, track_acme
+
+# Let's Encrypt单张证书最多包含100个域名
+MAX_SAN_NAMES = 100
+
+DOMAIN_PATTERN = re.compile(r'^(\*\.)?([a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z0-9-]{2,63}$')
+
+def normalize_domains(domains):
+    """整理证书域名列表：小写、去重、校验格式，通配符域名同时包含根域名
+
+    domains 可以是列表，也可以是以逗号、空白或换行分隔的字符串。
+    返回保持输入顺序的域名列表，第一个域名作为证书的主域名；格式不合法时抛出ValueError。
+    """
+    if isinstance(domains, str):
+        domains = re.split(r'[\s,]+', domains)
+    
+    names = []
+    for domain in domains:
+        domain = (domain or '').strip().lower().rstrip('.')
+        if not domain:
+            continue
+        
+        # 国际化域名转换为Punycode
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            raise ValueError(f"域名格式不正确: {domain}")
+        
+        if len(domain) > 253 or not DOMAIN_PATTERN.match(domain):
+            raise ValueError(f"域名格式不正确: {domain}")
+        
+        candidates = [domain]
+        if domain.startswith('*.'):
+            candidates.append(domain[2:])
+        for name in candidates:
+            if name not in names:
+                names.append(name)
+    
+    if not names:
+        raise ValueError("请至少填写一个域名")
+    if len(names) > MAX_SAN_NAMES:
+        raise ValueError(f"单张证书最多包含 {MAX_SAN_NAMES} 个域名（含通配符对应的根域名），当前为 {len(names)} 个")
+    
+    return names
+
+class RateLimitedError(Exception):
+    """CA返回rateLimited错误，retry_after为CA要求等待的秒数"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def retry_after_seconds(value, default):
+    """解析Retry-After头（秒数或HTTP日期）为需要等待的秒数，无法解析时返回default
+
+    HTTP日期按UTC与当前时间比较，结果与服务器所在时区无关。
+    """
+    if not value:
+        return default
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(int((retry_at - datetime.now(timezone.utc)).total_seconds()), 0)
+
+class ACMENetwork(client.ClientNetwork):
+    """在ACME错误中保留CA返回的Retry-After"""
+    
+    def _check_response(self, response, content_type=None):
+        try:
+            return super()._check_response(response, content_type=content_type)
+        except messages.Error as error:
+            if error.code == 'rateLimited':
+                retry_after = retry_after_seconds(response.headers.get('Retry-After'), default=3600)
+                raise RateLimitedError(str(error), retry_after) from error
+            raise
+
+# ACME目录地址，可通过环境变量切换到测试环境（如Let's Encrypt staging）
+ACME_DIRECTORY_URL = os.environ.get('ACME_DIRECTORY_URL') or 'https://acme-v02.api.letsencrypt.org/directory'
 
 class SSLCertificateGenerator:
-    def __init__(self, cf_email, cf_api_key):
+    def __init__(self, cf_email, cf_api_key, on_progress=None):
         self.cf_email = cf_email
         self.cf_api_key = cf_api_key
-        self.acme_directory_url = 'https://acme-v02.api.letsencrypt.org/directory'
+        self.acme_directory_url = ACME_DIRECTORY_URL
+        # 进度回调 on_progress(phase, message)，用于向前端推送签发阶段
+        self.on_progress = on_progress
+        # 同一次签发中多个域名共用Zone时只查询一次
+        self.zone_cache = {}
+    
+    def notify(self, phase, message):
+        """报告签发进度，回调异常不影响签发流程"""
+        if not self.on_progress:
+            return
+        try:
+            self.on_progress(phase, message)
+        except Exception as e:
+            print(f"进度回调失败: {e}")
         
     def get_zone_id(self, domain):
         """获取域名的Zone ID"""
@@ -26,6 +127,9 @@ class SSLCertificateGenerator:
             root_domain = '.'.join(domain_parts[-2:])
         else:
             root_domain = domain
+        
+        if root_domain in self.zone_cache:
+            return self.zone_cache[root_domain]
             
         headers = {
             'X-Auth-Email': self.cf_email,
@@ -33,18 +137,20 @@ class SSLCertificateGenerator:
             'Content-Type': 'application/json'
         }
         
-        response = requests.get(
-            f'https://api.cloudflare.com/client/v4/zones?name={root_domain}',
-            headers=headers,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data['success'] and data['result']:
-                return data['result'][0]['id']
-        
-        raise Exception(f"无法获取域名 {root_domain} 的Zone ID")
+        with track_cloudflare('get_zone'):
+            response = requests.get(
+                f'https://api.cloudflare.com/client/v4/zones?name={root_domain}',
+                headers=headers,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                if data['success'] and data['result']:
+                    self.zone_cache[root_domain] = data['result'][0]['id']
+                    return self.zone_cache[root_domain]
+            
+            raise Exception(f"无法获取域名 {root_domain} 的Zone ID")
     
     def add_dns_record(self, zone_id, name, content):
         """添加DNS记录"""
@@ -61,19 +167,20 @@ class SSLCertificateGenerator:
             'ttl': 120
         }
         
-        response = requests.post(
-            f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records',
-            headers=headers,
-            json=data,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            if result['success']:
-                return result['result']['id']
-        
-        raise Exception(f"添加DNS记录失败: {response.text}")
+        with track_cloudflare('add_dns_record'):
+            response = requests.post(
+                f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records',
+                headers=headers,
+                json=data,
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                if result['success']:
+                    return result['result']['id']
+            
+            raise Exception(f"添加DNS记录失败: {response.text}")
     
     def delete_dns_record(self, zone_id, record_id):
         """删除DNS记录"""
@@ -82,13 +189,22 @@ class SSLCertificateGenerator:
             'X-Auth-Key': self.cf_api_key
         }
         
-        response = requests.delete(
-            f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}',
-            headers=headers,
-            timeout=30
-        )
+        with track_cloudflare('delete_dns_record'):
+            response = requests.delete(
+                f'https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}',
+                headers=headers,
+                timeout=30
+            )
         
-        return response.status_code == 200
+        # 记录已不存在（之前已清理过）同样视为清理成功
+        if response.status_code == 404:
+            return True
+        
+        if response.status_code != 200:
+            CLOUDFLARE_ERRORS.labels(operation='delete_dns_record').inc()
+            return False
+        
+        return True
     
     def generate_private_key(self):
         """生成私钥"""
@@ -98,20 +214,18 @@ class SSLCertificateGenerator:
         )
         return private_key
     
-    def generate_csr(self, private_key, domain):
-        """生成证书签名请求"""
-        # 方案1：CN直接使用原域名，避免域名不匹配问题
-        subject = x509.Name([
-            x509.NameAttribute(NameOID.COMMON_NAME, domain)
-        ])
+    def generate_csr(self, private_key, domains):
+        """生成证书签名请求，domains为单个域名或域名列表"""
+        names = normalize_domains(domains)
         
-        # 构建SAN列表
-        san_list = [x509.DNSName(domain)]
+        # CN使用第一个域名，避免域名不匹配问题；CN最长64个字符，超长时只使用SAN
+        attributes = []
+        if len(names[0]) <= 64:
+            attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, names[0]))
+        subject = x509.Name(attributes)
         
-        # 如果是通配符域名，同时添加根域名
-        if domain.startswith("*."):
-            base_domain = domain.lstrip("*.")
-            san_list.append(x509.DNSName(base_domain))
+        # 构建SAN列表（通配符域名的根域名已包含在内）
+        san_list = [x509.DNSName(name) for name in names]
         
         csr = x509.CertificateSigningRequestBuilder().subject_name(
             subject
@@ -122,121 +236,281 @@ class SSLCertificateGenerator:
         
         return csr
     
-    def generate_certificate(self, domain, email):
-        """生成SSL证书的主要方法"""
-        try:
-            print(f"开始为域名 {domain} 生成证书...")
-            
-            # 生成账户私钥
+    def find_dns_challenge(self, authorization):
+        """从授权中找到DNS-01挑战"""
+        for challenge in authorization.body.challenges:
+            if isinstance(challenge.chall, DNS01):
+                return challenge
+        return None
+    
+    def private_key_to_pem(self, private_key):
+        """私钥转换为PEM格式"""
+        return private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ).decode('utf-8')
+    
+    def create_acme_client(self, email, state):
+        """创建ACME客户端
+
+        state中已有注册过的账户时直接复用，否则注册新账户并将账户私钥和URL写入state。
+        """
+        # 生成或加载账户私钥
+        if state.get('account_key'):
+            account_key = serialization.load_pem_private_key(state['account_key'].encode('utf-8'), password=None)
+        else:
             account_key = self.generate_private_key()
-            jwk = JWKRSA(key=account_key)
-            
-            # 创建带有超时配置的ACME客户端
-            # 配置网络客户端，确保能获取完整证书链
-            net = client.ClientNetwork(
-                jwk, 
-                user_agent='ssl-cert-generator/1.0', 
-                timeout=120,
-                verify_ssl=True  # 确保SSL验证
-            )
-            
-            # 获取ACME目录并创建客户端
+        jwk = JWKRSA(key=account_key)
+        
+        # 创建带有超时配置的ACME客户端
+        # 配置网络客户端，确保能获取完整证书链
+        net = ACMENetwork(
+            jwk, 
+            user_agent='ssl-cert-generator/1.0', 
+            timeout=120,
+            verify_ssl=True  # 确保SSL验证
+        )
+        
+        # 获取ACME目录并创建客户端
+        with track_acme('directory'):
             directory = client.ClientV2.get_directory(self.acme_directory_url, net)
-            acme_client = client.ClientV2(directory, net=net)
-            
-            print(f"ACME客户端初始化成功，目录URL: {self.acme_directory_url}")
-            
-            # 注册账户
-            new_account = messages.NewRegistration.from_data(
-                email=email,
-                terms_of_service_agreed=True
-            )
+        acme_client = client.ClientV2(directory, net=net)
+        
+        print(f"ACME客户端初始化成功，目录URL: {self.acme_directory_url}")
+        
+        if state.get('account_uri'):
+            # 已注册的账户只需要账户URL（作为请求签名的kid）
+            net.account = messages.RegistrationResource(uri=state['account_uri'], body=messages.Registration())
+            print("复用已注册的ACME账户")
+            return jwk, acme_client
+        
+        # 注册账户
+        new_account = messages.NewRegistration.from_data(
+            email=email,
+            terms_of_service_agreed=True
+        )
+        with track_acme('new_account'):
             account = acme_client.new_account(new_account)
-            print("ACME账户注册成功")
-            
-            # 生成证书私钥和CSR
-            cert_private_key = self.generate_private_key()
-            csr = self.generate_csr(cert_private_key, domain)
+        state['account_key'] = self.private_key_to_pem(account_key)
+        state['account_uri'] = account.uri
+        print("ACME账户注册成功")
+        return jwk, acme_client
+    
+    def load_order(self, acme_client, state):
+        """根据state中的订单URL重新获取订单及各授权的当前状态"""
+        response = acme_client._post_as_get(state['order_uri'])
+        body = messages.Order.from_json(response.json())
+        authorizations = [
+            acme_client._authzr_from_response(acme_client._post_as_get(url), uri=url)
+            for url in body.authorizations
+        ]
+        return messages.OrderResource(
+            body=body,
+            uri=state['order_uri'],
+            authorizations=authorizations,
+            csr_pem=state['csr'].encode('utf-8')
+        )
+    
+    def finalize_order(self, acme_client, order):
+        """完成订单并获取证书链，恢复的订单可能已处于ready、processing或valid状态"""
+        deadline = datetime.now() + timedelta(seconds=90)
+        status = order.body.status
+        if status in (messages.STATUS_PROCESSING, messages.STATUS_VALID):
+            return acme_client.poll_finalization(order, deadline)
+        if status == messages.STATUS_READY:
+            return acme_client.finalize_order(order, deadline)
+        return acme_client.poll_and_finalize(order, deadline)
+    
+    def wait_since(self, started_at, seconds):
+        """等待到started_at（时间戳）之后seconds秒，恢复的订单只等待剩余时间"""
+        remaining = started_at + seconds - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+    
+    def cleanup_dns_records(self, state):
+        """删除state中记录的DNS验证记录，清理成功的记录从state中移除，全部清理完成时返回True"""
+        remaining = []
+        for record_info in state.get('dns_records', []):
+            try:
+                if self.delete_dns_record(record_info['zone_id'], record_info['record_id']):
+                    print(f"DNS记录清理完成: _acme-challenge.{record_info['domain_name']}")
+                    continue
+                print(f"清理DNS记录失败: _acme-challenge.{record_info['domain_name']}")
+            except Exception as cleanup_error:
+                print(f"清理DNS记录失败: {cleanup_error}")
+            remaining.append(record_info)
+        
+        state['dns_records'] = remaining
+        return not remaining
+    
+    # 签发流程的阶段，state['phase']为最后完成的阶段
+    PHASES = ('created', 'account_registered', 'order_created', 'records_added',
+              'propagated', 'challenges_answered', 'validated', 'finalized')
+    
+    def generate_certificate(self, domains, email, state=None, on_checkpoint=None):
+        """生成SSL证书的主要方法，domains为单个域名或域名列表，所有域名签发在同一张证书中
+
+        state保存签发进度（账户、订单URL、证书私钥、已添加的DNS记录），每完成一个阶段
+        调用 on_checkpoint(state) 持久化。传入已保存的state时从最后完成的阶段继续，
+        复用已注册的账户、已创建的订单和已添加的DNS记录。
+        """
+        timer = PhaseTimer()
+        state = state if state is not None else {}
+        state.setdefault('phase', 'created')
+        state.setdefault('dns_records', [])
+        
+        def reached(phase):
+            return self.PHASES.index(state['phase']) >= self.PHASES.index(phase)
+        
+        def checkpoint(phase=None):
+            if phase:
+                state['phase'] = phase
+            if on_checkpoint:
+                on_checkpoint(state)
+        
+        try:
+            names = normalize_domains(domains)
             
-            # 将CSR转换为PEM格式
-            csr_pem = csr.public_bytes(serialization.Encoding.PEM)
+            # 证书已签发但结果还没有保存
+            if reached('finalized') and state.get('certificate'):
+                print(f"订单已完成签发: {', '.join(names)}")
+                timer.finish('success')
+                return {
+                    'success': True,
+                    'private_key': state['private_key'],
+                    'certificate': state['certificate'],
+                    'timings': timer.spans
+                }
             
-            # 创建订单
-            order = acme_client.new_order(csr_pem)
-            print("创建证书订单成功")
+            if state['phase'] == 'created':
+                print(f"开始为域名 {', '.join(names)} 生成证书...")
+                self.notify('started', f"开始为域名 {', '.join(names)} 生成证书")
+            else:
+                print(f"从阶段 {state['phase']} 继续为域名 {', '.join(names)} 生成证书...")
+                self.notify('resumed', f"从阶段 {state['phase']} 继续签发")
             
-            # 处理挑战
-            dns_records_to_cleanup = []  # 存储需要清理的DNS记录
+            with timer.phase('account'):
+                jwk, acme_client = self.create_acme_client(email, state)
+                if not reached('account_registered'):
+                    checkpoint('account_registered')
+                    self.notify('account_registered', "ACME账户注册成功")
             
-            try:
-                for authorization in order.authorizations:
-                    domain_name = authorization.body.identifier.value
-                    print(f"处理域名 {domain_name} 的验证...")
-                    
-                    # 找到DNS挑战
-                    dns_challenge = None
-                    for challenge in authorization.body.challenges:
-                        if isinstance(challenge.chall, DNS01):
-                            dns_challenge = challenge
-                            break
-                    
-                    if not dns_challenge:
-                        raise Exception("未找到DNS挑战")
-                    
-                    # 获取挑战响应
-                    response, validation = dns_challenge.response_and_validation(jwk)
+            with timer.phase('order'):
+                if state.get('order_uri'):
+                    with track_acme('get_order'):
+                        order = self.load_order(acme_client, state)
+                    print(f"恢复证书订单，当前状态: {order.body.status}")
+                else:
+                    # 生成证书私钥和CSR
+                    cert_private_key = self.generate_private_key()
+                    csr = self.generate_csr(cert_private_key, names)
                     
-                    # 添加DNS记录
-                    zone_id = self.get_zone_id(domain_name)
-                    record_name = f"_acme-challenge.{domain_name}"
-                    record_id = self.add_dns_record(zone_id, record_name, validation)
-                    print(f"DNS记录添加成功: {record_name}")
+                    # 将CSR转换为PEM格式
+                    csr_pem = csr.public_bytes(serialization.Encoding.PEM)
                     
-                    # 保存记录信息用于后续清理
-                    dns_records_to_cleanup.append({
-                        'zone_id': zone_id,
-                        'record_id': record_id,
-                        'domain_name': domain_name
-                    })
+                    # 创建订单
+                    with track_acme('new_order'):
+                        order = acme_client.new_order(csr_pem)
+                    state['private_key'] = self.private_key_to_pem(cert_private_key)
+                    state['csr'] = csr_pem.decode('utf-8')
+                    state['order_uri'] = order.uri
+                    checkpoint('order_created')
+                    print("创建证书订单成功")
+                    self.notify('order_created', "创建证书订单成功")
+            
+            # 处理挑战，已添加的DNS记录保存在state['dns_records']中用于清理
+            try:
+                if order.body.status == messages.STATUS_INVALID:
+                    raise Exception("证书订单已失效，无法继续签发")
                 
-                # 等待所有DNS记录传播
-                print("等待DNS记录传播...")
-                time.sleep(30)
+                # 恢复时已通过验证的授权不需要再处理
+                pending = [authorization for authorization in order.authorizations
+                           if authorization.body.status == messages.STATUS_PENDING]
                 
-                # 响应所有挑战
-                for authorization in order.authorizations:
-                    domain_name = authorization.body.identifier.value
-                    
-                    # 找到DNS挑战
-                    dns_challenge = None
-                    for challenge in authorization.body.challenges:
-                        if isinstance(challenge.chall, DNS01):
-                            dns_challenge = challenge
-                            break
+                if pending and not reached('records_added'):
+                    for authorization in pending:
+                        domain_name = authorization.body.identifier.value
+                        print(f"处理域名 {domain_name} 的验证...")
+                        
+                        # 找到DNS挑战
+                        dns_challenge = self.find_dns_challenge(authorization)
+                        if not dns_challenge:
+                            raise Exception("未找到DNS挑战")
+                        
+                        # 获取挑战响应
+                        response, validation = dns_challenge.response_and_validation(jwk)
+                        
+                        # 恢复时跳过中断前已添加的记录
+                        if any(record['domain_name'] == domain_name and record['validation'] == validation
+                               for record in state['dns_records']):
+                            continue
+                        
+                        # 添加DNS记录
+                        with timer.phase('zone_lookup', domain=domain_name):
+                            zone_id = self.get_zone_id(domain_name)
+                        record_name = f"_acme-challenge.{domain_name}"
+                        with timer.phase('dns_record', domain=domain_name):
+                            record_id = self.add_dns_record(zone_id, record_name, validation)
+                        print(f"DNS记录添加成功: {record_name}")
+                        
+                        # 每添加一条记录就写入检查点，中断后也能清理
+                        state['dns_records'].append({
+                            'zone_id': zone_id,
+                            'record_id': record_id,
+                            'domain_name': domain_name,
+                            'validation': validation
+                        })
+                        checkpoint()
                     
-                    if dns_challenge:
-                        response, _ = dns_challenge.response_and_validation(jwk)
-                        acme_client.answer_challenge(dns_challenge, response)
-                        print(f"域名 {domain_name} 挑战响应成功")
+                    state['records_added_at'] = time.time()
+                    checkpoint('records_added')
+                    self.notify('records_added', f"已添加 {len(state['dns_records'])} 条DNS验证记录，等待传播")
+                
+                if pending and not reached('propagated'):
+                    # 等待所有DNS记录传播
+                    print("等待DNS记录传播...")
+                    with timer.phase('propagation'):
+                        self.wait_since(state['records_added_at'], 30)
+                    checkpoint('propagated')
+                    self.notify('propagated', "DNS记录传播完成，开始验证")
+                
+                if pending and not reached('challenges_answered'):
+                    # 响应所有挑战
+                    with timer.phase('challenge'):
+                        for authorization in pending:
+                            domain_name = authorization.body.identifier.value
+                            
+                            # 找到DNS挑战，恢复时已响应过的挑战不再重复提交
+                            dns_challenge = self.find_dns_challenge(authorization)
+                            if dns_challenge and dns_challenge.status == messages.STATUS_PENDING:
+                                response, _ = dns_challenge.response_and_validation(jwk)
+                                with track_acme('answer_challenge'):
+                                    acme_client.answer_challenge(dns_challenge, response)
+                                print(f"域名 {domain_name} 挑战响应成功")
+                    state['answered_at'] = time.time()
+                    checkpoint('challenges_answered')
                 
-                # 等待所有验证完成
-                print("等待验证完成...")
-                time.sleep(30)
+                if pending and not reached('validated'):
+                    # 等待所有验证完成
+                    print("等待验证完成...")
+                    with timer.phase('validation'):
+                        self.wait_since(state['answered_at'], 30)
+                    checkpoint('validated')
+                    self.notify('validated', "域名验证完成，正在签发证书")
                 
             finally:
-                # 清理所有DNS记录
-                for record_info in dns_records_to_cleanup:
-                    try:
-                        self.delete_dns_record(record_info['zone_id'], record_info['record_id'])
-                        print(f"DNS记录清理完成: _acme-challenge.{record_info['domain_name']}")
-                    except Exception as cleanup_error:
-                        print(f"清理DNS记录失败: {cleanup_error}")
+                # 清理所有DNS记录，未能清理的记录留在state中由恢复任务重试
+                if state['dns_records']:
+                    with timer.phase('cleanup'):
+                        self.cleanup_dns_records(state)
+                    checkpoint()
             
             # 完成订单并获取证书
             print("完成订单并获取证书...")
             try:
-                # 使用poll_and_finalize方法完成订单
-                finalized_order = acme_client.poll_and_finalize(order)
+                with timer.phase('finalize'), track_acme('finalize'):
+                    finalized_order = self.finalize_order(acme_client, order)
                 
                 # 获取完整证书链
                 fullchain_pem = finalized_order.fullchain_pem
@@ -256,25 +530,32 @@ class SSLCertificateGenerator:
             except Exception as e:
                 raise Exception(f"证书获取失败: {str(e)}")
             
+            state['certificate'] = fullchain_pem
+            checkpoint('finalized')
             print("证书生成成功！")
+            self.notify('finalized', "证书签发完成")
             
-            # 转换私钥为PEM格式
-            private_key_pem = cert_private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            ).decode('utf-8')
-
+            timer.finish('success')
             return {
                 'success': True,
-                'private_key': private_key_pem,
-                'certificate': fullchain_pem
+                'private_key': state['private_key'],
+                'certificate': fullchain_pem,
+                'timings': timer.spans
             }
             
         except Exception as e:
             error_msg = f"证书生成失败: {str(e)}"
             print(error_msg)
-            return {
+            timer.finish('failed')
+            result = {
                 'success': False,
-                'message': error_msg
-            }
\ No newline at end of file
+                'message': error_msg,
+                'timings': timer.spans
+            }
+            
+            # 被CA限流时返回需要等待的时间（异常可能被包装过一层）
+            rate_limited = e if isinstance(e, RateLimitedError) else e.__context__
+            if isinstance(rate_limited, RateLimitedError):
+                result['retry_after'] = rate_limited.retry_after
+            
+            return result
@@ -0,0 +1,93 @@
+# 存储后端：SQLite连接的来源
+# database.py 中用户、证书、邮件记录等全部读写函数都通过 get_connection() 打开 sqlite3 连接，
+# 这里按 DATABASE_URL 选择连接打开的SQLite数据库：
+#
+# - sqlite:///ssl_certificates.db   相对路径的SQLite文件（默认）
+# - sqlite:////var/lib/ssl/ssl.db  绝对路径的SQLite文件
+# - memory:// 或 memory://<名称>    进程内的内存数据库，用于测试和压测，进程退出后数据丢失
+#
+# 后端只决定SQLite数据库所在的位置（文件或内存），不是数据访问接口：database.py 直接执行
+# SQLite方言的SQL（触发器、FTS5全文索引、json_each、UPSERT），调用方使用 sqlite3.Connection。
+# 换用其他数据库需要先把 database.py 的查询抽象成数据访问层，不能只在 BACKENDS 中注册新协议。
+
+import sqlite3
+import uuid
+from urllib.parse import urlsplit
+
+DEFAULT_DATABASE_URL = 'sqlite:///ssl_certificates.db'
+
+class SQLiteBackend:
+    """磁盘上的SQLite数据库文件"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_url(cls, url):
+        path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else ''
+        if not path:
+            raise ValueError(f'SQLite数据库地址应为 sqlite:///相对路径 或 sqlite:////绝对路径，当前为 {url}')
+        return cls(path)
+
+    def connect(self, factory=sqlite3.Connection):
+        return sqlite3.connect(self.path, factory=factory)
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return f'SQLite {self.path}'
+
+class MemoryBackend:
+    """进程内的内存数据库
+
+    使用SQLite的memdb VFS：同一进程中按名称打开的连接共享同一个数据库，
+    与文件数据库一样按锁和busy timeout处理并发写入。保持一个连接打开，
+    避免database.py的函数关闭连接后数据库被释放。
+    """
+
+    def __init__(self, name=None):
+        self.name = name or f'ssl-certificates-{uuid.uuid4().hex}'
+        self.uri = f'file:/{self.name}?vfs=memdb'
+        self._anchor = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+
+    @classmethod
+    def from_url(cls, url):
+        return cls(urlsplit(url).netloc or None)
+
+    def connect(self, factory=sqlite3.Connection):
+        return sqlite3.connect(self.uri, uri=True, factory=factory)
+
+    def close(self):
+        self._anchor.close()
+
+    def __str__(self):
+        return f'内存数据库 {self.name}'
+
+BACKENDS = {
+    'sqlite': SQLiteBackend.from_url,
+    'memory': MemoryBackend.from_url
+}
+
+def backend_from_url(url):
+    """按DATABASE_URL创建存储后端，不支持的协议抛出ValueError"""
+    scheme = urlsplit(url).scheme
+    if scheme not in BACKENDS:
+        raise ValueError(f'不支持的数据库地址: {url}，可选协议: {", ".join(BACKENDS)}')
+    return BACKENDS[scheme](url)
+
+class Storage:
+    """当前使用的存储后端，应用启动时按配置切换"""
+
+    def __init__(self, url=DEFAULT_DATABASE_URL):
+        self.backend = backend_from_url(url)
+
+    def configure(self, url=DEFAULT_DATABASE_URL):
+        backend = backend_from_url(url)
+        previous, self.backend = self.backend, backend
+        previous.close()
+
+    def connect(self, factory=sqlite3.Connection):
+        return self.backend.connect(factory)
+
+storage = Storage()
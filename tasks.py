@@ -0,0 +1,33 @@
+# 后台定时任务
+# 以守护线程周期执行维护任务（签发订单恢复等），单次执行出错不影响后续执行。
+# 多个副本同时运行时，每个任务只在持有该任务租约的进程中执行，时间按interval划分为周期，
+# 每个周期由持有者以fencing token认领后执行一次；持有者中断后其他进程接管尚未执行的周期。
+
+import threading
+import time
+import traceback
+from lease import Lease
+
+def start_periodic_task(name, interval, func, initial_delay=0, lease_ttl=30):
+    """启动后台线程，每隔 interval 秒执行一次 func（所有副本合计），返回线程对象"""
+    lease = Lease(f'task:{name}', ttl=lease_ttl)
+
+    def loop():
+        lease.start_heartbeat()
+        time.sleep(initial_delay)
+        while True:
+            slot = int(time.time() // interval)
+            if lease.held and lease.claim_slot(slot):
+                try:
+                    func()
+                except Exception as e:
+                    print(f"后台任务 {name} 执行失败: {e}")
+                    traceback.print_exc()
+            # 等到下一个周期开始；未持有租约的进程按心跳间隔检查，以便及时接管
+            next_slot_at = (slot + 1) * interval
+            time.sleep(max(0.1, min(next_slot_at - time.time(), lease_ttl / 3)))
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    print(f"后台任务 {name} 已启动，执行间隔 {interval} 秒")
+    return thread
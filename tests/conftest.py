@@ -0,0 +1,98 @@
+# 测试公共配置
+# 测试直接导入仓库根目录下的模块；每个测试使用独立的数据库，不读写 ssl_certificates.db。
+#
+# python -m pytest -q
+
+import os
+import sys
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials import credential_cipher
+from storage import storage, DEFAULT_DATABASE_URL
+
+@pytest.fixture(autouse=True)
+def cipher():
+    """加密保存的凭据使用测试密钥"""
+    credential_cipher.configure('test-secret-key')
+    yield credential_cipher
+
+def use_database(url):
+    from database import init_db
+    storage.configure(url)
+    init_db()
+    return url
+
+@pytest.fixture
+def memory_db():
+    """进程内的内存数据库，返回DATABASE_URL"""
+    yield use_database(f'memory://test-{uuid.uuid4().hex}')
+    storage.configure(DEFAULT_DATABASE_URL)
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    """临时目录中的SQLite文件数据库，可在多个进程间共享，返回DATABASE_URL"""
+    yield use_database(f'sqlite:///{tmp_path / "ssl_certificates.db"}')
+    storage.configure(DEFAULT_DATABASE_URL)
+
+class StubServer:
+    """本地HTTP服务，代替OCSP响应者、ACME目录等外部服务
+
+    routes[(方法, 路径)] = handler(request_body) -> (状态码, 响应头, 响应体)；requests 记录收到的请求，
+    headers 按相同顺序记录各请求的请求头。
+    """
+
+    def __init__(self):
+        stub = self
+        self.routes = {}
+        self.requests = []
+        self.headers = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                stub.requests.append((method, self.path, body))
+                stub.headers.append(dict(self.headers))
+                handler = stub.routes.get((method, self.path.split('?')[0]))
+                status, headers, content = handler(body) if handler else (404, {}, b'')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def do_HEAD(self):
+                self.handle_request('HEAD')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
@@ -0,0 +1,58 @@
+# 测试用的证书：自签名CA、带OCSP地址的服务器证书、OCSP签名证书
+
+from datetime import datetime, timedelta
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import AuthorityInformationAccessOID, ExtendedKeyUsageOID, NameOID
+
+def name(common_name):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+
+def build(subject, issuer_name, public_key, signing_key, serial=None, not_before=None, not_after=None,
+          extensions=()):
+    now = datetime.utcnow()
+    builder = (x509.CertificateBuilder()
+               .subject_name(subject)
+               .issuer_name(issuer_name)
+               .public_key(public_key)
+               .serial_number(serial or x509.random_serial_number())
+               .not_valid_before(not_before or now - timedelta(days=1))
+               .not_valid_after(not_after or now + timedelta(days=90)))
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical=critical)
+    return builder.sign(signing_key, hashes.SHA256())
+
+class Authority:
+    """自签名CA"""
+
+    def __init__(self, common_name='Test CA'):
+        self.key = ec.generate_private_key(ec.SECP256R1())
+        self.certificate = build(name(common_name), name(common_name), self.key.public_key(), self.key,
+                                 extensions=[(x509.BasicConstraints(ca=True, path_length=None), True)])
+
+    def issue_leaf(self, domains, ocsp_url=None, serial=None):
+        """签发服务器证书，返回 (证书, 私钥)"""
+        key = ec.generate_private_key(ec.SECP256R1())
+        extensions = [(x509.SubjectAlternativeName([x509.DNSName(domain) for domain in domains]), False)]
+        if ocsp_url:
+            extensions.append((x509.AuthorityInformationAccess([
+                x509.AccessDescription(AuthorityInformationAccessOID.OCSP, x509.UniformResourceIdentifier(ocsp_url))
+            ]), False))
+        extensions.append((x509.AuthorityKeyIdentifier.from_issuer_public_key(self.key.public_key()), False))
+        certificate = build(name(domains[0]), self.certificate.subject, key.public_key(), self.key,
+                            serial=serial, extensions=extensions)
+        return certificate, key
+
+    def issue_ocsp_signer(self, not_before=None, not_after=None, issuer_name=None):
+        """签发带OCSP签名用途的委托响应者证书，返回 (证书, 私钥)"""
+        key = ec.generate_private_key(ec.SECP256R1())
+        certificate = build(name('Test OCSP Responder'), issuer_name or self.certificate.subject,
+                            key.public_key(), self.key, not_before=not_before, not_after=not_after,
+                            extensions=[(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.OCSP_SIGNING]), False)])
+        return certificate, key
+
+def pem(*certificates):
+    return ''.join(certificate.public_bytes(serialization.Encoding.PEM).decode('ascii')
+                   for certificate in certificates)
@@ -0,0 +1,175 @@
+# ACME续期信息（ARI）和自动续期：以本地HTTP服务代替ACME目录和renewalInfo接口
+
+import json
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import ari
+from ari import (
+    ARIClient, ari_certificate_id, parse_retry_after, fallback_window,
+    DEFAULT_POLL_INTERVAL, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL
+)
+from database import (
+    create_user, get_user_by_email, save_certificate_record, get_renewal_info, set_auto_renew,
+    get_due_renewals, save_renewal_window, get_connection
+)
+from pki import Authority, build, name, pem
+
+@pytest.fixture
+def owner(memory_db):
+    create_user('owner@example.com', 'password123')
+    return get_user_by_email('owner@example.com').id
+
+def save_certificate(user_id, certificate, authority):
+    return save_certificate_record(user_id, 'example.com', 'acme@example.com', 'cf@example.com', 'success',
+                                   certificate=pem(certificate, authority.certificate))
+
+def test_ari_certificate_id_pads_high_bit_serial():
+    # RFC 9773 附录A的示例：序列号 0x87654321 的最高位为1，DER编码需要前导零字节
+    key = ec.generate_private_key(ec.SECP256R1())
+    aki = bytes.fromhex('69885B6B87464041E1B37B847BA0AE2CDE01C8D4')
+    certificate = build(name('example.com'), name('Test CA'), key.public_key(), key, serial=0x87654321,
+                        extensions=[(x509.AuthorityKeyIdentifier(aki, None, None), False)])
+    assert ari_certificate_id(certificate) == 'aYhba4dGQEHhs3uEe6CuLN4ByNQ.AIdlQyE'
+
+def test_ari_certificate_id_without_padding():
+    key = ec.generate_private_key(ec.SECP256R1())
+    aki = bytes.fromhex('69885B6B87464041E1B37B847BA0AE2CDE01C8D4')
+    certificate = build(name('example.com'), name('Test CA'), key.public_key(), key, serial=0x7F,
+                        extensions=[(x509.AuthorityKeyIdentifier(aki, None, None), False)])
+    assert ari_certificate_id(certificate).endswith('.fw')
+
+def test_parse_retry_after_seconds():
+    now = datetime.utcnow()
+    assert parse_retry_after('3600', now) == timedelta(hours=1)
+    assert parse_retry_after('5', now) == MIN_POLL_INTERVAL
+    assert parse_retry_after(str(30 * 86400), now) == MAX_POLL_INTERVAL
+    assert parse_retry_after(None, now) == DEFAULT_POLL_INTERVAL
+    assert parse_retry_after('soon', now) == DEFAULT_POLL_INTERVAL
+
+def test_parse_retry_after_http_date():
+    now = datetime(2026, 3, 1, 12, 0, 0)
+    value = format_datetime(datetime(2026, 3, 1, 14, 30, 0).replace(tzinfo=timezone.utc), usegmt=True)
+    assert parse_retry_after(value, now) == timedelta(hours=2, minutes=30)
+    past = format_datetime(datetime(2026, 3, 1, 11, 0, 0).replace(tzinfo=timezone.utc), usegmt=True)
+    assert parse_retry_after(past, now) == MIN_POLL_INTERVAL
+
+def test_fallback_window():
+    authority = Authority()
+    certificate, _ = authority.issue_leaf(['example.com'])
+    start, end = fallback_window(certificate)
+    lifetime = certificate.not_valid_after - certificate.not_valid_before
+    assert start == certificate.not_valid_after - lifetime / 3
+    assert end == start + lifetime / 6
+    assert certificate.not_valid_before < start < end < certificate.not_valid_after
+
+def serve_directory(stub_server, renewal_info=True):
+    directory = {'newNonce': f'{stub_server.url}/new-nonce'}
+    if renewal_info:
+        directory['renewalInfo'] = f'{stub_server.url}/renewal-info'
+    stub_server.route('GET', '/directory', lambda body: (200, {'Content-Type': 'application/json'},
+                                                         json.dumps(directory).encode()))
+
+def test_update_saves_suggested_window(owner, stub_server):
+    authority = Authority()
+    certificate, _ = authority.issue_leaf(['example.com'])
+    certificate_id = save_certificate(owner, certificate, authority)
+    ari_cert_id = ari_certificate_id(certificate)
+
+    now = datetime.utcnow().replace(microsecond=0)
+    window = {
+        'suggestedWindow': {
+            'start': (now + timedelta(days=10)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'end': (now + timedelta(days=12)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        },
+        'explanationURL': 'https://ca.example/explanation'
+    }
+    serve_directory(stub_server)
+    stub_server.route('GET', f'/renewal-info/{ari_cert_id}',
+                      lambda body: (200, {'Content-Type': 'application/json', 'Retry-After': '7200'},
+                                    json.dumps(window).encode()))
+
+    client = ARIClient(directory_url=f'{stub_server.url}/directory')
+    assert client.update({'id': certificate_id, 'certificate': pem(certificate)}, now=now) == 'ari'
+
+    renewal = get_renewal_info(certificate_id)
+    assert renewal['source'] == 'ari'
+    assert renewal['ari_cert_id'] == ari_cert_id
+    assert renewal['explanation_url'] == 'https://ca.example/explanation'
+    assert renewal['next_poll_at'] == (now + timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S')
+    scheduled_at = datetime.strptime(renewal['scheduled_at'], '%Y-%m-%d %H:%M:%S')
+    assert now + timedelta(days=10) <= scheduled_at <= now + timedelta(days=12)
+
+def test_update_without_renewal_info_uses_fallback(owner, stub_server):
+    authority = Authority()
+    certificate, _ = authority.issue_leaf(['example.com'])
+    certificate_id = save_certificate(owner, certificate, authority)
+    serve_directory(stub_server, renewal_info=False)
+
+    client = ARIClient(directory_url=f'{stub_server.url}/directory')
+    assert client.update({'id': certificate_id, 'certificate': pem(certificate)}) == 'fallback'
+    assert get_renewal_info(certificate_id)['ari_cert_id'] is None
+
+def test_directory_failure_is_fetched_once_per_run(owner, stub_server):
+    authority = Authority()
+    stub_server.route('GET', '/directory', lambda body: (503, {}, b''))
+    client = ARIClient(directory_url=f'{stub_server.url}/directory')
+
+    for domain in ('a.example.com', 'b.example.com', 'c.example.com'):
+        certificate, _ = authority.issue_leaf([domain])
+        certificate_id = save_certificate(owner, certificate, authority)
+        assert client.update({'id': certificate_id, 'certificate': pem(certificate)}) == 'error'
+        assert 'ACME目录' in get_renewal_info(certificate_id)['error_message']
+
+    assert [path for method, path, _ in stub_server.requests] == ['/directory']
+
+def test_auto_renew_key_is_encrypted(owner):
+    authority = Authority()
+    certificate, _ = authority.issue_leaf(['example.com'])
+    certificate_id = save_certificate(owner, certificate, authority)
+    assert set_auto_renew(certificate_id, owner, True, cf_api_key='cloudflare-global-key')
+
+    conn = get_connection()
+    stored = conn.execute('SELECT cf_api_key FROM renewal_info WHERE certificate_id = ?',
+                          (certificate_id,)).fetchone()[0]
+    conn.close()
+    assert stored.startswith('enc:v1:') and 'cloudflare-global-key' not in stored
+
+    now = datetime.utcnow()
+    save_renewal_window(certificate_id, None, 'fallback', now - timedelta(days=1), now, None,
+                        now - timedelta(minutes=1), now + timedelta(days=1))
+    assert [renewal['cf_api_key'] for renewal in get_due_renewals(now)] == ['cloudflare-global-key']
+
+def test_renewal_wait_is_bounded(owner, monkeypatch):
+    authority = Authority()
+    certificate, _ = authority.issue_leaf(['example.com'])
+    certificate_id = save_certificate(owner, certificate, authority)
+    set_auto_renew(certificate_id, owner, True, cf_api_key='cloudflare-global-key')
+    now = datetime.utcnow()
+    save_renewal_window(certificate_id, None, 'fallback', now - timedelta(days=1), now, None,
+                        now - timedelta(minutes=1), now + timedelta(days=1))
+
+    submitted = []
+
+    def schedule_certificate(*args, **kwargs):
+        future = Future()
+        submitted.append(future)
+        return future
+    monkeypatch.setattr(ari, 'schedule_certificate', schedule_certificate)
+
+    # 签发尚未完成：等待超时后返回，不计入结果，下一次检查不重复提交
+    assert ari.renew_due_certificates(timeout=0.1) == (0, 0)
+    assert ari.renew_due_certificates(timeout=0.1) == (0, 0)
+    assert len(submitted) == 1
+
+    # 签发完成后由回调记录续期结果
+    renewed_id = save_certificate(owner, certificate, authority)
+    submitted[0].set_result({'success': True, 'certificate_id': renewed_id})
+    assert get_renewal_info(certificate_id)['renewed_certificate_id'] == renewed_id
+    assert get_renewal_info(renewed_id)['auto_renew']
+    assert certificate_id not in ari.renewals_in_flight
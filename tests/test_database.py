@@ -0,0 +1,56 @@
+# database.py 的查询函数
+
+import json
+from datetime import datetime, timedelta
+
+from database import (
+    create_user, get_user_by_email, save_certificate_record, get_certificate_by_id,
+    save_ocsp_response, set_auto_renew, create_deployment_target, init_db, get_connection
+)
+from storage import storage
+
+def test_certificate_detail_uses_one_connection(memory_db, monkeypatch):
+    create_user('owner@example.com', 'password123')
+    user_id = get_user_by_email('owner@example.com').id
+    certificate_id = save_certificate_record(user_id, 'example.com', 'acme@example.com', 'cf@example.com',
+                                             'success', san_domains=['example.com', 'www.example.com'])
+    now = datetime.utcnow()
+    save_ocsp_response(certificate_id, 'http://ocsp.example', 'good', now + timedelta(hours=12),
+                       this_update=now, next_update=now + timedelta(days=1))
+    set_auto_renew(certificate_id, user_id, True, cf_api_key='cloudflare-key')
+    create_deployment_target(certificate_id, user_id, 'web', 'webhook', {'url': 'https://deploy.example/hook'})
+
+    connections = []
+    connect = storage.connect
+
+    def counting_connect(*args, **kwargs):
+        connections.append(1)
+        return connect(*args, **kwargs)
+
+    monkeypatch.setattr(storage, 'connect', counting_connect)
+    certificate = get_certificate_by_id(certificate_id, user_id)
+
+    assert len(connections) == 1
+    assert certificate['san_domains'] == ['example.com', 'www.example.com']
+    assert certificate['ocsp']['status'] == 'good'
+    assert certificate['renewal']['auto_renew']
+    assert [target['name'] for target in certificate['deployments']] == ['web']
+    assert get_certificate_by_id(certificate_id, user_id + 1) is None
+
+def test_backfill_skips_malformed_certificates(memory_db):
+    conn = get_connection()
+    conn.execute('''
+        INSERT INTO certificates (user_id, domain, email, cf_email, status, certificate)
+        VALUES (1, '*.broken.example', 'acme@example.com', 'cf@example.com', 'success', ?)
+    ''', ('-----BEGIN CERTIFICATE-----\nnot base64\n-----END CERTIFICATE-----\n',))
+    conn.execute('UPDATE certificates SET san_domains = NULL')
+    conn.commit()
+    conn.close()
+
+    # 启动时的补充不因无法解析的证书中断，按主域名补充SAN集合
+    init_db()
+
+    conn = get_connection()
+    san_domains = conn.execute('SELECT san_domains FROM certificates').fetchone()[0]
+    conn.close()
+    assert json.loads(san_domains) == sorted(['*.broken.example', 'broken.example'])
@@ -0,0 +1,57 @@
+# 页面条件缓存：ETag和片段缓存随数据版本、模板和静态资源清单变化
+
+import pytest
+from flask import Flask
+
+import assets
+import http_cache
+from assets import asset_manifest
+from http_cache import LRUCache, conditional, cached_fragment
+
+@pytest.fixture
+def client(memory_db, monkeypatch):
+    # 测试结束后恢复应用启动时加载的资源清单
+    for attribute in ('files', 'built', 'digest'):
+        monkeypatch.setattr(asset_manifest, attribute, getattr(asset_manifest, attribute))
+    monkeypatch.setattr(http_cache, 'fragment_cache', LRUCache())
+
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.renders = []
+
+    def render():
+        app.renders.append(1)
+        return f'<link href="/assets/{asset_manifest.files.get("css/common.css")}">'
+
+    @app.route('/history')
+    @conditional(lambda: [(1, 'certificates')])
+    def history():
+        return cached_fragment('history_table', render, 1)
+
+    client = app.test_client()
+    client.application = app
+    return client
+
+def rebuild_assets(monkeypatch, files):
+    monkeypatch.setattr(assets, 'load_manifest', lambda: files)
+    asset_manifest.load()
+
+def test_unchanged_page_returns_304(client, monkeypatch):
+    rebuild_assets(monkeypatch, {'css/common.css': 'css/common.aaaaaaaaaaaa.css'})
+    response = client.get('/history')
+    assert response.status_code == 200
+    assert client.get('/history', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/history').get_data(as_text=True) == response.get_data(as_text=True)
+    assert len(client.application.renders) == 1
+
+def test_rebuilt_assets_invalidate_etag_and_fragments(client, monkeypatch):
+    rebuild_assets(monkeypatch, {'css/common.css': 'css/common.aaaaaaaaaaaa.css'})
+    before = client.get('/history')
+
+    # 模板和数据都没有变化，只重新构建了静态资源
+    rebuild_assets(monkeypatch, {'css/common.css': 'css/common.bbbbbbbbbbbb.css'})
+    after = client.get('/history', headers={'If-None-Match': before.headers['ETag']})
+    assert after.status_code == 200
+    assert after.headers['ETag'] != before.headers['ETag']
+    assert 'common.bbbbbbbbbbbb.css' in after.get_data(as_text=True)
+    assert len(client.application.renders) == 2
@@ -0,0 +1,90 @@
+# 签发请求合并：相同key的并发调用只执行一次，结果和异常分发给所有等待方
+
+import threading
+import time
+
+from issuance import SingleFlight, flight_key
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    entered = threading.Event()
+    calls = []
+    results = []
+    progress = []
+
+    def issue(notify):
+        calls.append(1)
+        entered.set()
+        release.wait(5)
+        notify('order', '创建订单')
+        return {'certificate_id': 7}
+
+    def caller(name):
+        results.append((name, flight.do('example.com', issue, listener=lambda phase, message: progress.append((name, phase)))))
+
+    leader = threading.Thread(target=caller, args=('leader',))
+    leader.start()
+    entered.wait(5)
+    followers = [threading.Thread(target=caller, args=(f'follower-{i}',)) for i in range(3)]
+    for thread in followers:
+        thread.start()
+    # 等待跟随者加入本次调用后再完成
+    while len(flight._calls['example.com'].listeners) < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(timeout=5)
+
+    assert len(calls) == 1
+    assert dict(results)['leader'] == ({'certificate_id': 7}, False)
+    assert all(dict(results)[f'follower-{i}'] == ({'certificate_id': 7}, True) for i in range(3))
+    # 进度事件转发给所有加入的调用方
+    assert sorted(name for name, phase in progress) == ['follower-0', 'follower-1', 'follower-2', 'leader']
+    assert flight._calls == {}
+
+def test_exception_is_raised_in_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+    entered = threading.Event()
+    errors = []
+
+    def issue(notify):
+        entered.set()
+        release.wait(5)
+        raise RuntimeError('ACME订单失败')
+
+    def caller():
+        try:
+            flight.do('example.com', issue, listener=lambda phase, message: None)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=caller)]
+    threads[0].start()
+    entered.wait(5)
+    threads += [threading.Thread(target=caller) for _ in range(2)]
+    for thread in threads[1:]:
+        thread.start()
+    while len(flight._calls['example.com'].listeners) < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert errors == ['ACME订单失败'] * 3
+
+    # 失败的调用不被缓存，下一次调用重新执行
+    assert flight.do('example.com', lambda notify: 'retried') == ('retried', False)
+
+def test_different_keys_run_independently():
+    flight = SingleFlight()
+    assert flight.do('a.example.com', lambda notify: 'a') == ('a', False)
+    assert flight.do('b.example.com', lambda notify: 'b') == ('b', False)
+
+def test_flight_key_separates_cloudflare_credentials():
+    identifiers = ('example.com', 'www.example.com')
+    assert flight_key(identifiers, 'ACME@example.com ', 'CF@example.com', 'key') == \
+        flight_key(identifiers, 'acme@example.com', 'cf@example.com', 'key')
+    assert flight_key(identifiers, 'acme@example.com', 'cf@example.com', 'key') != \
+        flight_key(identifiers, 'acme@example.com', 'cf@example.com', 'other-key')
@@ -0,0 +1,128 @@
+# OCSP状态检查：以本地HTTP服务代替OCSP响应者，校验响应签名、委托响应者和有效期
+
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.x509 import ReasonFlags, ocsp
+
+import ocsp as ocsp_module
+from database import create_user, get_user_by_email, save_certificate_record, get_ocsp_status
+from ocsp import OCSPClient
+from pki import Authority, name, pem
+
+@pytest.fixture
+def responder(memory_db, stub_server):
+    """CA、带OCSP地址的服务器证书和对应的证书记录；responder.respond() 设置响应者返回的响应"""
+
+    class Responder:
+        def __init__(self):
+            self.authority = Authority()
+            self.leaf, _ = self.authority.issue_leaf(['example.com'], ocsp_url=f'{stub_server.url}/ocsp')
+            create_user('owner@example.com', 'password123')
+            user_id = get_user_by_email('owner@example.com').id
+            self.record = {
+                'id': save_certificate_record(user_id, 'example.com', 'acme@example.com', 'cf@example.com',
+                                              'success', certificate=pem(self.leaf, self.authority.certificate)),
+                'certificate': pem(self.leaf, self.authority.certificate),
+                'ca_certificate': pem(self.authority.certificate)
+            }
+
+        def respond(self, status=ocsp.OCSPCertStatus.GOOD, signer=None, signer_key=None, delegate=None,
+                    this_update=None, next_update=None, revoked_at=None):
+            now = datetime.utcnow()
+            builder = ocsp.OCSPResponseBuilder().add_response(
+                cert=self.leaf,
+                issuer=self.authority.certificate,
+                algorithm=hashes.SHA1(),
+                cert_status=status,
+                this_update=this_update or now - timedelta(hours=1),
+                next_update=next_update or now + timedelta(days=3),
+                revocation_time=revoked_at,
+                revocation_reason=ReasonFlags.key_compromise if revoked_at else None
+            ).responder_id(ocsp.OCSPResponderEncoding.HASH, signer or self.authority.certificate)
+            if delegate:
+                builder = builder.certificates([delegate])
+            response = builder.sign(signer_key or self.authority.key, hashes.SHA256())
+            der = response.public_bytes(serialization.Encoding.DER)
+
+            def handler(body):
+                # 请求是对该证书的有效OCSP查询
+                assert ocsp.load_der_ocsp_request(body).serial_number == self.leaf.serial_number
+                return 200, {'Content-Type': 'application/ocsp-response'}, der
+            stub_server.route('POST', '/ocsp', handler)
+
+    return Responder()
+
+def test_good_response(responder):
+    responder.respond()
+    assert OCSPClient().check(responder.record) == 'good'
+    status = get_ocsp_status(responder.record['id'])
+    assert status['status'] == 'good'
+    assert status['error_message'] is None
+
+def test_revoked_response(responder):
+    revoked_at = datetime.utcnow().replace(microsecond=0) - timedelta(days=1)
+    responder.respond(status=ocsp.OCSPCertStatus.REVOKED, revoked_at=revoked_at)
+    assert OCSPClient().check(responder.record) == 'revoked'
+    status = get_ocsp_status(responder.record['id'])
+    assert status['status'] == 'revoked'
+    assert status['revoked_at'] == revoked_at.strftime('%Y-%m-%d %H:%M:%S')
+    assert status['revocation_reason'] == 'key_compromise'
+
+def test_delegated_responder(responder):
+    delegate, delegate_key = responder.authority.issue_ocsp_signer()
+    responder.respond(signer=delegate, signer_key=delegate_key, delegate=delegate)
+    assert OCSPClient().check(responder.record) == 'good'
+
+def test_delegate_from_other_issuer_is_rejected(responder):
+    # 其他CA签发的OCSP签名证书（名称和签名都不匹配）
+    other, other_key = Authority('Other CA').issue_ocsp_signer()
+    responder.respond(signer=other, signer_key=other_key, delegate=other)
+    assert OCSPClient().check(responder.record) == 'error'
+    assert get_ocsp_status(responder.record['id'])['error_message'] == '响应者证书不是由证书的签发者签发'
+
+def test_delegate_with_mismatched_issuer_name_is_rejected(responder):
+    # 签名由签发者的密钥生成，但证书中的签发者名称不是该CA
+    delegate, delegate_key = responder.authority.issue_ocsp_signer(issuer_name=name('Another Name'))
+    responder.respond(signer=delegate, signer_key=delegate_key, delegate=delegate)
+    assert OCSPClient().check(responder.record) == 'error'
+    assert get_ocsp_status(responder.record['id'])['error_message'] == '响应者证书不是由证书的签发者签发'
+
+def test_expired_delegate_is_rejected(responder):
+    now = datetime.utcnow()
+    delegate, delegate_key = responder.authority.issue_ocsp_signer(
+        not_before=now - timedelta(days=30), not_after=now - timedelta(days=1))
+    responder.respond(signer=delegate, signer_key=delegate_key, delegate=delegate)
+    assert OCSPClient().check(responder.record) == 'error'
+    assert get_ocsp_status(responder.record['id'])['error_message'] == '响应者证书不在有效期内'
+
+def test_invalid_signature(responder):
+    # 与签发者同名（Test CA）、但密钥不同的证书签名
+    impostor = Authority()
+    responder.respond(signer=impostor.certificate, signer_key=impostor.key)
+    assert OCSPClient().check(responder.record) == 'error'
+    assert get_ocsp_status(responder.record['id'])['error_message'] == '响应签名无效'
+
+def test_stale_next_update(responder):
+    now = datetime.utcnow()
+    responder.respond(this_update=now - timedelta(days=8), next_update=now - timedelta(days=1))
+    assert OCSPClient().check(responder.record) == 'error'
+    assert get_ocsp_status(responder.record['id'])['error_message'] == '响应已过期'
+
+@pytest.mark.parametrize('error', [
+    InvalidSignature(),
+    UnsupportedAlgorithm('unsupported signature algorithm'),
+    requests.ConnectionError('connection reset')
+])
+def test_unexpected_errors_are_saved_per_record(responder, monkeypatch, error):
+    responder.respond()
+
+    def fail(*args):
+        raise error
+    monkeypatch.setattr(ocsp_module, 'verify_response', fail)
+
+    assert OCSPClient().check(responder.record) == 'error'
+    assert get_ocsp_status(responder.record['id'])['error_message']
@@ -0,0 +1,61 @@
+# 签发进度事件流：每次请求返回已有事件后立即结束，由浏览器按retry间隔重连
+
+import time
+
+import pytest
+from flask import Flask
+from flask_login import LoginManager
+
+from database import create_user, get_user_by_email, get_user_by_id
+from progress import progress_broker
+from routes.main import main_bp
+
+@pytest.fixture
+def viewer(memory_db):
+    """已登录的测试客户端，viewer.user_id 为当前用户"""
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config['PROGRESS_RETRY_MS'] = 500
+    login_manager = LoginManager(app)
+    login_manager.user_loader(lambda user_id: get_user_by_id(int(user_id)))
+    app.register_blueprint(main_bp)
+
+    create_user('owner@example.com', 'password123')
+    client = app.test_client()
+    client.user_id = get_user_by_email('owner@example.com').id
+    with client.session_transaction() as session:
+        session['_user_id'] = str(client.user_id)
+    return client
+
+def events_url(progress_id):
+    return f'/generate/progress/{progress_id}/events'
+
+def test_returns_pending_events_without_waiting(viewer):
+    progress_id = progress_broker.create(viewer.user_id)
+    progress_broker.publish(progress_id, 'progress', {'message': '创建订单'})
+    progress_broker.publish(progress_id, 'progress', {'message': '添加TXT记录'})
+
+    response = viewer.get(events_url(progress_id))
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    assert body.startswith('retry: 500\n\n')
+    assert 'id: 1\nevent: progress\n' in body and 'id: 2\nevent: progress\n' in body
+
+    # 没有新事件时不等待，只返回重连间隔
+    started = time.monotonic()
+    response = viewer.get(events_url(progress_id), headers={'Last-Event-ID': '2'})
+    assert time.monotonic() - started < 1
+    assert response.get_data(as_text=True) == 'retry: 500\n\n'
+
+def test_closed_channel_stops_reconnects(viewer):
+    progress_id = progress_broker.create(viewer.user_id)
+    progress_broker.publish(progress_id, 'done', {'success': True}, close=True)
+
+    # 关闭前的事件仍然送达，之后返回204
+    assert 'event: done' in viewer.get(events_url(progress_id)).get_data(as_text=True)
+    assert viewer.get(events_url(progress_id), headers={'Last-Event-ID': '1'}).status_code == 204
+
+def test_other_users_channel_is_hidden(viewer):
+    progress_id = progress_broker.create(viewer.user_id + 1)
+    assert viewer.get(events_url(progress_id)).status_code == 404
@@ -0,0 +1,139 @@
+# ACME限流准入：acme_events滑动窗口统计、内存预留名额、CA的Retry-After，
+# 排队的申请交还调度器重新排队，不在签发工作线程中等待
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import issuance
+from database import get_connection, san_domains_key, format_timestamp
+from rate_limit import AdmissionScheduler, AdmissionDenied, AdmissionQueued, RateLimit
+from scheduler import Requeue
+
+def hourly_orders(limit):
+    return AdmissionScheduler(limits=[RateLimit('orders', limit, timedelta(hours=1), 'account')])
+
+def record_event(kind, email, age, domains=None, status=None):
+    """写入一条 age 之前发生的CA操作"""
+    conn = get_connection()
+    conn.execute('INSERT INTO acme_events (kind, email, san_domains, status, created_at) VALUES (?, ?, ?, ?, ?)',
+                 (kind, email, san_domains_key(domains) if domains else None, status,
+                  format_timestamp(datetime.utcnow() - age)))
+    conn.commit()
+    conn.close()
+
+def weekly_duplicates(limit):
+    return AdmissionScheduler(limits=[
+        RateLimit('duplicate_certificates', limit, timedelta(days=7), 'identifiers', status='success')
+    ])
+
+def test_sliding_window_counts_recent_events(memory_db):
+    domains = ['example.com', 'www.example.com']
+    record_event('order', 'acme@example.com', timedelta(days=6), domains, 'success')
+    record_event('order', 'acme@example.com', timedelta(days=1), domains, 'success')
+
+    with pytest.raises(AdmissionDenied) as denied:
+        weekly_duplicates(2).admit(domains, 'acme@example.com')
+    # 6天前的订单移出7天窗口后才有空位
+    assert 86400 - 60 < denied.value.retry_after <= 86400 + 1
+    assert 'duplicate_certificates' in str(denied.value)
+
+def test_events_outside_window_or_other_status_are_ignored(memory_db):
+    domains = ['example.com']
+    record_event('order', 'acme@example.com', timedelta(days=8), domains, 'success')
+    record_event('order', 'acme@example.com', timedelta(hours=1), domains, 'failed')
+    record_event('order', 'acme@example.com', timedelta(hours=1), ['other.example.com'], 'success')
+    weekly_duplicates(1).admit(domains, 'acme@example.com')
+
+def test_registered_domain_includes_subdomains(memory_db):
+    admission = AdmissionScheduler(limits=[
+        RateLimit('certificates_per_domain', 2, timedelta(days=7), 'registered_domain', status='success')
+    ])
+    record_event('order', 'one@example.com', timedelta(days=1), ['a.example.com'], 'success')
+    record_event('order', 'two@example.com', timedelta(days=1), ['*.b.example.com'], 'success')
+
+    with pytest.raises(AdmissionDenied):
+        admission.admit(['c.example.com'], 'three@example.com')
+    admission.admit(['c.example.org'], 'three@example.com')
+
+def test_reservations_count_until_released(memory_db):
+    admission = hourly_orders(2)
+    first = admission.admit(['a.example.com'], 'acme@example.com')
+    admission.admit(['b.example.com'], 'acme@example.com')
+    with pytest.raises(AdmissionDenied):
+        admission.admit(['c.example.com'], 'acme@example.com')
+
+    # 未产生订单的申请释放名额后，其他申请可以通过
+    admission.release(first)
+    admission.admit(['c.example.com'], 'acme@example.com')
+    # 其他账户不受影响
+    admission.admit(['d.example.com'], 'other@example.com')
+
+def test_registration_limit_applies_only_when_registering(memory_db):
+    admission = AdmissionScheduler(limits=[
+        RateLimit('new_registrations', 1, timedelta(hours=3), 'global', kind='registration')
+    ])
+    record_event('registration', 'first@example.com', timedelta(hours=1))
+
+    admission.admit(['example.com'], 'first@example.com', registering=False)
+    with pytest.raises(AdmissionDenied) as denied:
+        admission.admit(['example.com'], 'second@example.com', registering=True)
+    assert 'new_registrations' in str(denied.value)
+
+def test_ca_retry_after_blocks_account_and_registered_domain(memory_db):
+    admission = hourly_orders(100)
+    admission.block(['www.example.com'], 'acme@example.com', 120)
+
+    for domains, email in ((['other.example.net'], 'acme@example.com'), (['api.example.com'], 'other@example.com')):
+        with pytest.raises(AdmissionDenied) as denied:
+            admission.admit(domains, email)
+        assert 'ca_retry_after' in str(denied.value)
+        assert 115 <= denied.value.retry_after <= 121
+
+    admission.admit(['example.org'], 'other@example.com')
+
+    # 较短的Retry-After不会缩短已有的等待
+    admission.block(['www.example.com'], 'acme@example.com', 10)
+    with pytest.raises(AdmissionDenied) as denied:
+        admission.admit(['www.example.com'], 'acme@example.com')
+    assert denied.value.retry_after > 100
+
+def test_admit_queues_without_waiting(memory_db):
+    admission = hourly_orders(1)
+    admission.admit(['example.com'], 'acme@example.com')
+
+    started = time.monotonic()
+    with pytest.raises(AdmissionQueued) as queued:
+        admission.admit(['example.com'], 'acme@example.com', max_wait=7200)
+    assert time.monotonic() - started < 1
+    assert queued.value.reason == 'orders'
+    assert 3590 < queued.value.wait <= 3600
+
+    with pytest.raises(AdmissionDenied) as denied:
+        admission.admit(['example.com'], 'acme@example.com', max_wait=60)
+    assert denied.value.retry_after == 3600
+
+def test_queued_issuance_is_requeued(memory_db, monkeypatch):
+    calls = []
+
+    def admit(domains, email, max_wait=0, registering=False):
+        calls.append(max_wait)
+        if len(calls) == 1:
+            raise AdmissionQueued('触发限流规则 orders，排队等待 40 秒', 40, 'orders')
+        raise AdmissionDenied('触发限流规则 orders', 30)
+
+    monkeypatch.setattr(issuance.admission_scheduler, 'admit', admit)
+    progress = []
+
+    with pytest.raises(Requeue) as requeue:
+        issuance.issue_certificate(1, ['example.com'], 'acme@example.com', 'cf@example.com', 'key',
+                                   on_progress=lambda phase, message: progress.append(phase),
+                                   admission_max_wait=60)
+    assert requeue.value.delay == 40
+    assert progress == ['queued']
+
+    # 重新执行时剩余的排队时间为 60 - 40 秒
+    result = requeue.value.fn()
+    assert calls == [60, 20]
+    assert not result['success'] and result['retry_after'] == 30
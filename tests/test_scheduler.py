@@ -0,0 +1,232 @@
+# 签发任务公平调度：加权公平排队、交互优先、并发上限、每日配额、延后重新排队和各租户排队情况
+
+import threading
+import time
+
+import pytest
+from flask import Flask
+from flask_login import LoginManager
+
+import routes.metrics
+from database import create_user, get_user_by_email, get_user_by_id
+from profiling import settings
+from routes.metrics import metrics_bp
+from scheduler import FairScheduler, SchedulePolicy, QuotaExceeded, Requeue
+
+def quota_policy(daily_quota):
+    return lambda user_id: SchedulePolicy(max_concurrent=8, daily_quota=daily_quota)
+
+def run_after_gate(scheduler, submissions):
+    """唯一的工作线程执行阻塞任务期间提交全部任务，返回放开后的执行顺序
+
+    submissions为 [(user_id, kind, 任务数)]，执行顺序中的每一项为user_id。
+    """
+    order = []
+    release = threading.Event()
+    started = threading.Event()
+
+    def gate():
+        started.set()
+        release.wait(5)
+
+    futures = [scheduler.submit(0, 'gate@example.com', gate)]
+    started.wait(5)
+    for user_id, kind, count in submissions:
+        futures += [scheduler.submit(user_id, 'cf@example.com', lambda user_id=user_id: order.append(user_id), kind=kind)
+                    for _ in range(count)]
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    return order
+
+def test_large_batch_does_not_starve_other_tenants():
+    scheduler = FairScheduler(workers=1, policy_loader=lambda user_id: SchedulePolicy(max_concurrent=8))
+    order = run_after_gate(scheduler, [(1, 'bulk', 10), (2, 'bulk', 2)])
+    # 后提交的租户与大批量租户交替执行，不排在整批之后
+    assert order[:4] == [1, 2, 1, 2]
+    assert order[4:] == [1] * 8
+
+def test_weight_gives_proportional_share():
+    policies = {1: SchedulePolicy(weight=1.0), 2: SchedulePolicy(weight=3.0)}
+    scheduler = FairScheduler(workers=1, policy_loader=lambda user_id: policies.get(user_id, SchedulePolicy()))
+    order = run_after_gate(scheduler, [(1, 'bulk', 6), (2, 'bulk', 6)])
+    assert order[:8].count(2) == 6
+
+def test_interactive_jobs_are_boosted_over_bulk():
+    scheduler = FairScheduler(workers=1, interactive_boost=4.0,
+                              policy_loader=lambda user_id: SchedulePolicy(max_concurrent=8))
+    order = run_after_gate(scheduler, [(1, 'bulk', 10), (2, 'interactive', 3)])
+    assert sorted(order[:4]) == [1, 2, 2, 2]
+
+def test_max_concurrent_limits_one_tenant_only():
+    scheduler = FairScheduler(workers=4, policy_loader=lambda user_id: SchedulePolicy(max_concurrent=1 if user_id == 1 else 4))
+    lock = threading.Lock()
+    running = {1: 0, 2: 0}
+    peak = {1: 0, 2: 0}
+    both_running = threading.Barrier(2)
+
+    def job(user_id):
+        with lock:
+            running[user_id] += 1
+            peak[user_id] = max(peak[user_id], running[user_id])
+        try:
+            time.sleep(0.05)
+            if user_id == 2:
+                # 用户1的任务执行期间，用户2仍然可以使用其余的工作线程
+                both_running.wait(timeout=5)
+        finally:
+            with lock:
+                running[user_id] -= 1
+
+    futures = [scheduler.submit(1, 'cf@example.com', lambda: job(1)) for _ in range(3)]
+    futures += [scheduler.submit(2, 'cf@example.com', lambda: job(2)) for _ in range(2)]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert peak == {1: 1, 2: 2}
+
+def test_usage_is_loaded_outside_the_lock():
+    scheduler = FairScheduler(workers=1, policy_loader=quota_policy(5), usage_loader=None)
+    blocked = []
+
+    def usage_loader(user_id, since):
+        # 查询用量期间其他线程可以获取调度器锁
+        thread = threading.Thread(target=scheduler.queue_depth)
+        thread.start()
+        thread.join(timeout=2)
+        blocked.append(thread.is_alive())
+        return 0
+
+    scheduler.usage_loader = usage_loader
+    assert scheduler.submit(1, 'cf@example.com', lambda: 'ok').result(timeout=5) == 'ok'
+    assert blocked == [False]
+
+def test_concurrent_submits_do_not_exceed_quota():
+    release = threading.Event()
+    barrier = threading.Barrier(6)
+
+    def usage_loader(user_id, since):
+        # 所有提交都在读取用量之后才进入加锁的检查
+        barrier.wait(timeout=5)
+        return 1
+
+    scheduler = FairScheduler(workers=8, policy_loader=quota_policy(3), usage_loader=usage_loader)
+    accepted, rejected = [], []
+
+    def submit():
+        try:
+            accepted.append(scheduler.submit(1, 'cf@example.com', lambda: release.wait(5)))
+        except QuotaExceeded as e:
+            rejected.append(e.retry_after)
+
+    threads = [threading.Thread(target=submit) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    release.set()
+
+    assert len(accepted) == 2
+    assert len(rejected) == 4 and all(0 < retry_after <= 86401 for retry_after in rejected)
+
+def test_job_finishing_during_usage_query_is_counted():
+    recorded = []
+    proceed = threading.Event()
+    scheduler = FairScheduler(workers=1, policy_loader=quota_policy(1))
+
+    def issue():
+        proceed.wait(5)
+        recorded.append('certificate')
+
+    def usage_loader(user_id, since):
+        # 读取到的用量不包含在查询期间执行完的任务
+        used = len(recorded)
+        if scheduler._submitted.get(user_id):
+            proceed.set()
+            deadline = time.monotonic() + 5
+            while not scheduler._finished.get(user_id) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        return used
+
+    scheduler.usage_loader = usage_loader
+    first = scheduler.submit(1, 'cf@example.com', issue)
+    with pytest.raises(QuotaExceeded):
+        scheduler.submit(1, 'cf@example.com', issue)
+    first.result(timeout=5)
+    assert recorded == ['certificate']
+
+@pytest.fixture
+def admin(memory_db, monkeypatch):
+    """管理员登录的测试客户端"""
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    login_manager = LoginManager(app)
+    login_manager.user_loader(lambda user_id: get_user_by_id(int(user_id)))
+    app.register_blueprint(metrics_bp)
+    monkeypatch.setattr(settings, 'admin_emails', {'admin@example.com'})
+
+    create_user('admin@example.com', 'password123')
+    create_user('user@example.com', 'password123')
+    client = app.test_client()
+
+    def login(email):
+        with client.session_transaction() as session:
+            session['_user_id'] = str(get_user_by_email(email).id)
+    client.login = login
+    return client
+
+def test_issuance_queue_lists_deepest_tenants(admin, monkeypatch):
+    scheduler = FairScheduler(workers=1, policy_loader=lambda user_id: SchedulePolicy(max_concurrent=1))
+    monkeypatch.setattr(routes.metrics, 'issuance_scheduler', scheduler)
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+
+    futures = [scheduler.submit(1, 'cf@example.com', blocking)]
+    started.wait(5)
+    for user_id, count in ((2, 3), (3, 1), (4, 2)):
+        futures += [scheduler.submit(user_id, 'CF@example.com', lambda: None, kind='bulk') for _ in range(count)]
+
+    try:
+        admin.login('user@example.com')
+        assert admin.get('/metrics/issuance-queue').status_code == 404
+
+        admin.login('admin@example.com')
+        tenants = admin.get('/metrics/issuance-queue?limit=2').get_json()['tenants']
+        assert tenants == [
+            {'user_id': 2, 'cf_email': 'cf@example.com', 'kind': 'bulk', 'queued': 3},
+            {'user_id': 4, 'cf_email': 'cf@example.com', 'kind': 'bulk', 'queued': 2}
+        ]
+    finally:
+        release.set()
+        for future in futures:
+            future.result(timeout=5)
+
+def test_requeued_job_does_not_hold_the_worker():
+    scheduler = FairScheduler(workers=1)
+    order = []
+
+    def deferred():
+        order.append('deferred')
+
+        def retry():
+            order.append('retried')
+            return 'deferred'
+        raise Requeue(0.2, retry)
+
+    def other():
+        order.append('other')
+        return 'other'
+
+    first = scheduler.submit(1, 'cf@example.com', deferred)
+    second = scheduler.submit(2, 'cf@example.com', other)
+
+    # 唯一的工作线程在等待期间执行其他用户的任务，Future在重新执行后完成
+    assert second.result(timeout=5) == 'other'
+    assert not first.done()
+    assert first.result(timeout=5) == 'deferred'
+    assert order == ['deferred', 'other', 'retried']
+    assert scheduler.queue_depth() == {}
@@ -0,0 +1,147 @@
+# 后台任务和租约：多个进程共用一个SQLite文件时，每个周期只执行一次；
+# 持有者中断后其他进程接管，已被接管的旧持有者以过期的fencing token认领周期会被拒绝。
+
+import multiprocessing
+import sqlite3
+import time
+
+from database import acquire_lease, claim_lease_slot, get_connection
+from lease import Lease
+
+INTERVAL = 1.0
+LEASE_TTL = 1.5
+
+def run_replica(database_url, duration):
+    """一个副本进程：启动与应用相同的周期任务，每次执行写入一行（周期编号、进程号）"""
+    import os
+    from credentials import credential_cipher
+    from storage import storage
+    import lease
+    import tasks
+
+    credential_cipher.configure('test-secret-key')
+    storage.configure(database_url)
+
+    # 记录本线程最后一次认领成功的周期，任务执行时写入，避免按执行时刻推算周期
+    claimed = {}
+    claim_slot = lease.Lease.claim_slot
+
+    def recording_claim_slot(self, slot):
+        if claim_slot(self, slot):
+            claimed['slot'] = slot
+            return True
+        return False
+
+    lease.Lease.claim_slot = recording_claim_slot
+
+    def record_execution():
+        conn = sqlite3.connect(storage.backend.path, timeout=10)
+        conn.execute('INSERT INTO task_executions (slot, pid) VALUES (?, ?)', (claimed['slot'], os.getpid()))
+        conn.commit()
+        conn.close()
+
+    tasks.start_periodic_task('replicated', INTERVAL, record_execution, lease_ttl=LEASE_TTL)
+    time.sleep(duration)
+
+def executions(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute('SELECT slot, pid FROM task_executions ORDER BY slot').fetchall()
+    conn.close()
+    return rows
+
+def lease_holder_pid(path):
+    conn = sqlite3.connect(path)
+    row = conn.execute("SELECT holder FROM leases WHERE name = 'task:replicated'").fetchone()
+    conn.close()
+    return int(row[0].split(':')[1]) if row else None
+
+def test_replicas_execute_each_interval_once(sqlite_db):
+    path = sqlite_db[len('sqlite:///'):]
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE task_executions (slot INTEGER, pid INTEGER)')
+    conn.commit()
+    conn.close()
+
+    context = multiprocessing.get_context('spawn')
+    replicas = [context.Process(target=run_replica, args=(sqlite_db, 12)) for _ in range(3)]
+    for replica in replicas:
+        replica.start()
+
+    try:
+        # 等持有者执行几个周期后强制结束它（不释放租约，与进程崩溃相同）
+        deadline = time.time() + 30
+        while len(executions(path)) < 3 and time.time() < deadline:
+            time.sleep(0.2)
+        leader = lease_holder_pid(path)
+        assert leader is not None
+        next(replica for replica in replicas if replica.pid == leader).kill()
+        killed_at = time.time()
+    finally:
+        for replica in replicas:
+            replica.join(timeout=30)
+            if replica.is_alive():
+                replica.kill()
+
+    rows = executions(path)
+    slots = [slot for slot, _ in rows]
+    # 每个周期恰好一行
+    assert len(slots) == len(set(slots))
+    assert len(slots) >= 5
+    # 持有者中断后由其他副本接管
+    successors = {pid for slot, pid in rows if slot * INTERVAL > killed_at + LEASE_TTL}
+    assert successors and leader not in successors
+
+def test_slot_is_claimed_once(memory_db):
+    token = acquire_lease('task:once', 'replica-a', ttl=30)
+    assert claim_lease_slot('task:once', 'replica-a', token, 10)
+    assert not claim_lease_slot('task:once', 'replica-a', token, 10)
+    # 已执行过的周期之前的周期同样拒绝
+    assert not claim_lease_slot('task:once', 'replica-a', token, 9)
+    assert claim_lease_slot('task:once', 'replica-a', token, 11)
+
+def test_expired_lease_is_taken_over(memory_db):
+    first = Lease('task:takeover', ttl=0.3, holder='replica-a')
+    second = Lease('task:takeover', ttl=30, holder='replica-b')
+
+    assert first.renew()
+    assert not second.renew()
+    stale_token = first.token
+
+    time.sleep(0.4)
+    assert not first.held
+    assert second.renew()
+    assert second.token == stale_token + 1
+
+    # 被接管的旧持有者以过期的token认领周期被拒绝，新持有者可以认领
+    assert not claim_lease_slot('task:takeover', 'replica-a', stale_token, 1)
+    assert second.claim_slot(1)
+
+    # 旧持有者续约失败并放弃租约
+    assert not first.renew()
+    assert first.token is None
+    assert not first.claim_slot(2)
+
+def test_reacquired_lease_rejects_previous_token(memory_db):
+    token = acquire_lease('task:reacquire', 'replica-a', ttl=0.2)
+    time.sleep(0.3)
+    # 同一持有者在过期后重新获取，token递增，过期前的token不再有效
+    new_token = acquire_lease('task:reacquire', 'replica-a', ttl=30)
+    assert new_token == token + 1
+    assert not claim_lease_slot('task:reacquire', 'replica-a', token, 1)
+    assert claim_lease_slot('task:reacquire', 'replica-a', new_token, 1)
+
+def test_released_lease_is_taken_over_immediately(memory_db):
+    first = Lease('task:release', ttl=30, holder='replica-a')
+    second = Lease('task:release', ttl=30, holder='replica-b')
+
+    assert first.renew()
+    stale_token = first.token
+    first.release()
+    assert second.renew()
+    assert not claim_lease_slot('task:release', 'replica-a', stale_token, 1)
+    assert second.claim_slot(1)
+
+    conn = get_connection()
+    holder = conn.execute("SELECT holder FROM leases WHERE name = 'task:release'").fetchone()[0]
+    conn.close()
+    assert holder == 'replica-b'